@@ -9,7 +9,7 @@ from django.conf import settings
 #from tegaki.character import Stroke, Point, Writing
 from tegaki import character
 
-from tegaki.recognizer import Recognizer
+from tegaki.recognizer import RecognizerRegistry
 
 from tegakidb.hwdb.models import *
 from tegakidb.hwdb.forms import *
@@ -249,9 +249,9 @@ def recognize_submit(request):
         xml = request.POST['xml']
     char = character.Character()
     char.read_string(xml)
-    klass = Recognizer.get_available_recognizers()['zinnia']
-    rec = klass()
-    rec.set_model('Simplified Chinese')
+    # the model is opened once and shared by all requests
+    rec = RecognizerRegistry.get_default().get_recognizer('zinnia',
+                                                          'Simplified Chinese')
     writing = char.get_writing()
     #writing = writing.copy()
     results = rec.recognize(writing) 
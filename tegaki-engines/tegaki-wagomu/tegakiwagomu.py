@@ -21,9 +21,15 @@
 
 VERSION = '0.3.1'
 
+import io
 import os
+import zlib
 import struct
+import hashlib
+import sqlite3
+import multiprocessing
 from array import array
+from collections import deque
 
 from tegaki.recognizer import Results, Recognizer, RecognizerError
 from tegaki.trainer import Trainer, TrainerError
@@ -34,8 +40,35 @@ from tegaki.mathutils import euclidean_distance
 VECTOR_DIMENSION_MAX = 4
 INT_SIZE = 4
 FLOAT_SIZE = 4
+# v1 models are written in the byte order of the machine which built them
 MAGIC_NUMBER = 0x77778888
 
+# v2 models are little-endian. They start with a header of HEADER_SIZE
+# bytes: MAGIC_NUMBER_V2, the version, the header size, the number of
+# sections, the number of characters, the number of groups, the vector
+# dimension, the downsample threshold, the model size and the CRC-32 of
+# the model (this field excepted), padded with zeros. The section table
+# follows, with (type, offset, size, 0) for each section. Sections and
+# templates are aligned on MODEL_ALIGN bytes so that the model can be used
+# from a memory-mapped file as is.
+MAGIC_NUMBER_V2 = 0x4F474157 # "WAGO"
+MODEL_VERSION = 2
+HEADER_SIZE = 64
+CRC_OFFSET = 36
+SECTION_CHARACTERS = 1 # (unicode, n_vectors) of each template
+SECTION_GROUPS = 2 # (n_strokes, n_chars, offset, 0) of each group
+SECTION_TEMPLATES = 3 # feature vectors
+MODEL_ALIGN = 64
+
+# Templates can be added to or deleted from a model without rewriting it:
+# records are appended after the stroke data (the "overlay"), where they
+# are ignored by older versions. Each record is made of OVERLAY_MAGIC_NUMBER,
+# the operation, the unicode value, the number of strokes and the number of
+# vectors, followed by the vectors (for OVERLAY_ADD only).
+OVERLAY_MAGIC_NUMBER = 0x77779999
+OVERLAY_ADD = 1
+OVERLAY_DELETE = 2
+
 # Features
 
 FEATURE_EXTRACTION_FUNCTIONS = ["get_xy_features", "get_delta_features"]
@@ -71,96 +104,360 @@ get_delta_features.DIMENSION = 2
 
 # DTW
 
-class DtwMatrix:
-    # we use 1d-vector V instead of a n*m 2d-matrix M
-    # M[i,j] can be accessed by V[k], k = j*n + i
-
-    def __init__(self, n, m):
-        self.a = array("f", [0.0] * (n*m))
-        self.n = n
-        self.m = m
-
-    def __getitem__(self, p):
-        return self.a[p[1] * self.n + p[0]]
+DTW_INFINITY = 4294967296 # 2^32
 
-    def __setitem__(self, p, value):
-        self.a[p[1] * self.n + p[0]] = value
-
-def dtw(s, t, d, f=euclidean_distance):
+def dtw(s, t, d, f=euclidean_distance, window=None):
     """
     s; first sequence
     t: second sequence
     d: vector dimension
     f: distance function
+    window: Sakoe-Chiba band width (None means no constraint)
 
     s and t are flat sequences of feature vectors of dimension d, so 
     their length should be multiple of d
+
+    Cells (i,j) such that |i - j| > window are not computed. The window
+    is widened to |n - m| if needed so that the last cell can be reached.
     """    
     assert(len(s) % d == 0)
     assert(len(t) % d == 0)
 
-    n = len(s) / d
-    m = len(t) / d
-   
-    DTW = DtwMatrix(n, m)
-   
-    infinity = 4294967296 # 2^32
-    
-    for i in range(1, m):
-        DTW[(0, i)] = infinity
-        
-    for i in range(1, n):
-        DTW[(i, 0)] = infinity
+    n = len(s) // d
+    m = len(t) // d
+
+    if window is not None:
+        window = max(window, abs(n - m))
+
+    # Only two columns of the n*m matrix are needed at any given time.
+    # They are stored as single-precision floats, like in the C++ version.
+    prev = array("f", [DTW_INFINITY] * m)
+    curr = array("f", [DTW_INFINITY] * m)
+    prev[0] = 0.0
 
-    DTW[(0, 0)] = 0.0
-       
     for i in range(1, n):
         # retrieve 1st d-dimension vector
         v1 = s[i*d:i*d+d]
 
-        for j in range(1, m):
+        curr[0] = DTW_INFINITY
+
+        if window is None:
+            jmin, jmax = 1, m
+        else:
+            jmin, jmax = max(1, i - window), min(m, i + window + 1)
+            for j in range(1, jmin):
+                curr[j] = DTW_INFINITY
+
+        for j in range(jmin, jmax):
             # retrieve 2nd d-dimension vector
             v2 = t[j*d:j*d+d]
             # distance function
             cost = f(v1, v2)
             # DTW recursion step
-            DTW[(i, j)] = cost + min(DTW[(i-1, j)],
-                                     DTW[(i-1, j-1)],
-                                     DTW[(i, j-1)])
-       
-    return DTW[(n-1, m-1)]
+            curr[j] = cost + min(prev[j], prev[j-1], curr[j-1])
+
+        for j in range(jmax, m):
+            curr[j] = DTW_INFINITY
+
+        prev, curr = curr, prev
+
+    return prev[m-1]
+
+try:
+    import numpy
+
+    # maximum number of cells in the DTW matrices of a batch
+    DTW_BATCH_CELLS = 1 << 22
+
+    def _dtw_batch(s, ts, d, window):
+        n = len(s)
+        sizes = numpy.array([len(t) // d for t in ts])
+        n_seqs = len(ts)
+        m = sizes.max()
+
+        t = numpy.zeros((n_seqs, m, d))
+        for k in range(n_seqs):
+            t[k,:sizes[k]] = numpy.reshape(ts[k], (-1, d))
+
+        diff = s[numpy.newaxis,:,numpy.newaxis,:] - t[:,numpy.newaxis,:,:]
+        cost = numpy.sqrt((diff * diff).sum(axis=3))
+
+        mat = numpy.empty((n_seqs, n, m), dtype=numpy.float32)
+        mat.fill(DTW_INFINITY)
+        mat[:,0,0] = 0.0
+
+        if window is not None:
+            windows = numpy.maximum(window, numpy.abs(n - sizes))
+            wmax = windows.max()
+
+        # Cells on the same anti-diagonal i + j = k don't depend on each
+        # other so they are computed at once, for all sequences
+        for k in range(2, n + m - 1):
+            imin, imax = max(1, k - m + 1), min(n - 1, k - 1)
+
+            if window is not None:
+                imin = max(imin, (k - wmax + 1) // 2)
+                imax = min(imax, (k + wmax) // 2)
+
+            if imin > imax:
+                continue
+
+            i = numpy.arange(imin, imax + 1)
+            j = k - i
+
+            best = numpy.minimum(numpy.minimum(mat[:,i-1,j], mat[:,i-1,j-1]),
+                                 mat[:,i,j-1])
+            # sum in double precision then round, like dtw()
+            values = (cost[:,i,j] + best).astype(numpy.float32)
+
+            if window is not None:
+                outside = numpy.abs(i - j)[numpy.newaxis,:] > \
+                              windows[:,numpy.newaxis]
+                values[outside] = DTW_INFINITY
+
+            mat[:,i,j] = values
+
+        return mat[numpy.arange(n_seqs), n - 1, sizes - 1].tolist()
+
+    def dtw_many(s, ts, d, window=None):
+        """
+        Return [dtw(s, t, d, window=window) for t in ts].
+
+        The euclidean distance is used. Results are identical to the ones
+        of dtw() but all the sequences are processed at the same time,
+        one anti-diagonal of the DTW matrices at a time.
+        """
+        if len(ts) == 0:
+            return []
+
+        s = numpy.reshape(numpy.asarray(s, dtype=numpy.float64), (-1, d))
+        n = len(s)
+        m = max([len(t) for t in ts]) // d
+        batch_size = max(1, DTW_BATCH_CELLS // (n * m * d or 1))
+
+        ret = []
+        for start in range(0, len(ts), batch_size):
+            ret += _dtw_batch(s, ts[start:start+batch_size], d, window)
+        return ret
+
+except ImportError:
+
+    def dtw_many(s, ts, d, window=None):
+        """
+        Return [dtw(s, t, d, window=window) for t in ts].
+        """
+        return [dtw(s, t, d, window=window) for t in ts]
+
+def _dtw_rows(args):
+    """
+    Compute the DTW distances between the samples i in [start, end) and all
+    the samples j > i. Used by the trainer worker processes.
+    """
+    features, start, end, d, window = args
+    return [dtw_many(features[i], features[i+1:], d, window) \
+                for i in range(start, end)]
+
+def _split_rows(n, block_size):
+    """
+    Split the rows of the upper triangle of a n*n matrix into blocks
+    of about block_size pairs.
+    """
+    blocks = []
+    start = 0
+    n_pairs = 0
+
+    for i in range(n):
+        n_pairs += n - i - 1
+        if n_pairs >= block_size:
+            blocks.append((start, i+1))
+            start = i + 1
+            n_pairs = 0
+
+    if start < n:
+        blocks.append((start, n))
+
+    return blocks
 
 # Small utils
 
 def argmin(arr):
     return arr.index(min(arr))
 
+def _to_text(utf8):
+    if isinstance(utf8, bytes):
+        utf8 = utf8.decode("utf8")
+    return utf8
+
+def _to_unicode(utf8):
+    return ord(_to_text(utf8))
+
 # File utils
 
-def read_uints(f, n):
-    return struct.unpack("@%dI" % n, f.read(n*4))
+def read_uints(f, n, byteorder="@"):
+    data = f.read(n*4)
+    if len(data) < n*4:
+        raise ValueError("Truncated model")
+    return struct.unpack("%s%dI" % (byteorder, n), data)
 
-def read_uint(f):
-    return read_uints(f, 1)[0]
+def read_uint(f, byteorder="@"):
+    return read_uints(f, 1, byteorder)[0]
 
-def write_uints(f, *args):
-    f.write(struct.pack("@%dI" % len(args), *args))
+def write_uints(f, *args, **kw):
+    f.write(struct.pack("%s%dI" % (kw.get("byteorder", "@"), len(args)),
+                        *args))
 write_uint = write_uints
 
-def read_floats(f, n):
-    return struct.unpack("@%df" % n, f.read(n*4))
+def read_floats(f, n, byteorder="@"):
+    data = f.read(n*4)
+    if len(data) < n*4:
+        raise ValueError("Truncated model")
+    return struct.unpack("%s%df" % (byteorder, n), data)
 
-def read_float(f):
-    return read_floats(f, 1)[0]
+def read_float(f, byteorder="@"):
+    return read_floats(f, 1, byteorder)[0]
 
-def write_floats(f, *args):
-    f.write(struct.pack("@%df" % len(args), *args))
+def write_floats(f, *args, **kw):
+    f.write(struct.pack("%s%df" % (kw.get("byteorder", "@"), len(args)),
+                        *args))
 write_float = write_floats    
 
 def get_padded_offset(offset, align):
-    padding = (align - (offset % align)) % align
     return offset + ((align - (offset % align)) % align)
 
+def read_model_header(f):
+    """
+    Return a dictionary describing a model: version, n_characters,
+    n_groups, dimension, downsample_threshold, byteorder (struct format
+    character), offsets of the characters and groups tables, offset of the
+    stroke data and overlay_offset, where the overlay starts.
+    """
+    f.seek(0)
+    magic = read_uint(f, "<")
+
+    if magic == MAGIC_NUMBER_V2:
+        f.seek(0)
+        header = read_uints(f, HEADER_SIZE // INT_SIZE, "<")
+
+        if header[1] != MODEL_VERSION:
+            raise ValueError("Unsupported model version")
+
+        info = {"version" : header[1], "byteorder" : "<",
+                "n_characters" : header[4], "n_groups" : header[5],
+                "dimension" : header[6], "downsample_threshold" : header[7],
+                "crc" : header[9], "overlay_offset" : header[8]}
+
+        f.seek(header[2])
+        sections = read_uints(f, header[3] * 4, "<")
+        names = {SECTION_CHARACTERS : "characters_offset",
+                 SECTION_GROUPS : "groups_offset",
+                 SECTION_TEMPLATES : "templates_offset"}
+
+        for i in range(0, len(sections), 4):
+            if sections[i] in names:
+                info[names[sections[i]]] = sections[i+1]
+
+        for name in names.values():
+            if not name in info:
+                raise ValueError("Corrupted model")
+
+        info["header_size"] = header[2]
+        return info
+
+    # v1 models may come from a machine with another byte order
+    for byteorder in ("<", ">"):
+        f.seek(0)
+        header = read_uints(f, 5, byteorder)
+        if header[0] == MAGIC_NUMBER:
+            break
+    else:
+        raise ValueError("Not a valid file")
+
+    n_chars, n_groups = header[1:3]
+    info = {"version" : 1, "byteorder" : byteorder,
+            "n_characters" : n_chars, "n_groups" : n_groups,
+            "dimension" : header[3], "downsample_threshold" : header[4],
+            "characters_offset" : 5 * INT_SIZE,
+            "groups_offset" : (5 + n_chars * 2) * INT_SIZE}
+
+    charinfo = read_uints(f, n_chars * 2, byteorder)
+    # the offset of the first group is the start of the stroke data
+    offset = read_uints(f, 4, byteorder)[2] if n_groups > 0 else f.tell()
+    n_vectors = sum(charinfo[1::2])
+
+    info["templates_offset"] = offset
+    info["overlay_offset"] = offset + \
+                             n_vectors * VECTOR_DIMENSION_MAX * FLOAT_SIZE
+
+    return info
+
+def read_templates(f, info):
+    """
+    Return the templates of a model, in model order, as a list of
+    (unicode, n_strokes, features). info is from read_model_header().
+    """
+    byteorder = info["byteorder"]
+
+    if info["version"] >= 2:
+        f.seek(0)
+        data = f.read(info["overlay_offset"])
+        crc = zlib.crc32(data[CRC_OFFSET+INT_SIZE:],
+                         zlib.crc32(data[:CRC_OFFSET]))
+        if crc & 0xffffffff != info["crc"]:
+            raise ValueError("Corrupted model (bad checksum)")
+        align = MODEL_ALIGN
+    else:
+        align = VECTOR_DIMENSION_MAX * FLOAT_SIZE
+
+    f.seek(info["characters_offset"])
+    charinfo = read_uints(f, info["n_characters"] * 2, byteorder)
+    f.seek(info["groups_offset"])
+    groups = read_uints(f, info["n_groups"] * 4, byteorder)
+
+    templates = []
+    for i in range(info["n_groups"]):
+        n_strokes, n_group_chars, offset = groups[i*4:i*4+3]
+        for j in range(len(templates), len(templates) + n_group_chars):
+            n_floats = charinfo[j*2+1] * VECTOR_DIMENSION_MAX
+            if n_floats == 0:
+                raise ValueError("Empty template")
+            f.seek(offset)
+            templates.append((charinfo[j*2], n_strokes,
+                              read_floats(f, n_floats, byteorder)))
+            offset = get_padded_offset(offset + n_floats * FLOAT_SIZE, align)
+
+    return templates
+
+def read_overlay(f, offset, byteorder="@"):
+    """
+    Yield (op, unicode, n_strokes, features, end) for each complete record
+    of the overlay starting at offset. end is the offset of the next record.
+    The overlay is in the byte order of the model.
+
+    An incomplete record, for example being written, ends the overlay.
+    """
+    f.seek(offset)
+
+    while True:
+        data = f.read(5 * INT_SIZE)
+        if len(data) < 5 * INT_SIZE:
+            return
+
+        magic, op, unicode, n_strokes, n_vectors = \
+            struct.unpack("%s5I" % byteorder, data)
+
+        if magic != OVERLAY_MAGIC_NUMBER:
+            raise ValueError("Invalid overlay record")
+
+        size = n_vectors * VECTOR_DIMENSION_MAX * FLOAT_SIZE
+        data = f.read(size)
+        if len(data) < size:
+            return
+        features = array("f", struct.unpack("%s%df" % (byteorder,
+                                            size // FLOAT_SIZE), data))
+
+        offset += 5 * INT_SIZE + size
+        yield op, unicode, n_strokes, features, offset
+
 class _WagomuBase(object):
 
     def __init__(self):
@@ -178,12 +475,30 @@ class _WagomuBase(object):
         else:
             self._error = TrainerError
 
-    def get_features(self, writing):
+    def get_features(self, writing, downsample_threshold=None):
+        if downsample_threshold is None:
+            downsample_threshold = self._downsample_threshold
         writing.normalize()
-        writing.downsample_threshold(self._downsample_threshold)
+        writing.downsample_threshold(downsample_threshold)
         flat = array_flatten(self._feature_extraction_function(writing))
         return [float(f) for f in flat]
 
+    def get_feature_array(self, writing, points=None):
+        """
+        Like get_features() but append single-precision floats to points,
+        an array("f"), which is returned. The array can be passed as is
+        to the wagomu module.
+        """
+        if points is None:
+            points = array("f")
+
+        writing.normalize()
+        writing.downsample_threshold(self._downsample_threshold)
+        for vector in self._feature_extraction_function(writing):
+            points.extend(vector)
+
+        return points
+
     def set_options(self, opt):
         if "downsample_threshold" in opt:
             try:
@@ -201,6 +516,32 @@ class _WagomuBase(object):
                 self._vector_dimension = \
                     self._feature_extraction_function.DIMENSION
 
+        if "dtw_window" in opt:
+            try:
+                self._dtw_window = int(opt["dtw_window"])
+                if self._dtw_window < 0: raise ValueError
+            except ValueError:
+                raise self._error("dtw_window must be a positive integer")
+
+        if "template_cache" in opt:
+            self._template_cache = opt["template_cache"]
+
+        if "model_version" in opt:
+            try:
+                self._model_version = int(opt["model_version"])
+                if not self._model_version in (1, MODEL_VERSION):
+                    raise ValueError
+            except ValueError:
+                raise self._error("model_version must be 1 or %d" % \
+                                  MODEL_VERSION)
+
+        if "n_processes" in opt:
+            try:
+                self._n_processes = int(opt["n_processes"])
+                if self._n_processes < 1: raise ValueError
+            except ValueError:
+                raise self._error("n_processes must be a positive integer")
+
         if "window_size" in opt:
             try:
                 ws = int(opt["window_size"])
@@ -209,6 +550,21 @@ class _WagomuBase(object):
                     self._recognizer.set_window_size(ws)
             except ValueError:
                 raise self._error("window_size must be a positive integer")    
+
+        if "n_threads" in opt:
+            try:
+                n_threads = int(opt["n_threads"])
+                if n_threads < 1: raise ValueError
+                if isinstance(self, Recognizer):
+                    self._recognizer.set_n_threads(n_threads)
+            except ValueError:
+                raise self._error("n_threads must be a positive integer")
+
+        # "scalar", "sse", "avx2" or "avx512" (by default the fastest one
+        # supported by the CPU)
+        if "dtw_kernel" in opt and isinstance(self, Recognizer):
+            if not self._recognizer.set_kernel(opt["dtw_kernel"]):
+                raise self._error(self._recognizer.get_error_message())
        
 
 # Recognizer
@@ -226,25 +582,134 @@ try:
 
             self._recognizer = wagomu.Recognizer()
 
+            # path of the model and overlay position, to apply new
+            # records in refresh()
+            self._path = None
+            self._inode = None
+            self._overlay_offset = None
+            self._byteorder = None
+
         def open(self, path):
             ret = self._recognizer.open(path)
             if not ret: 
                 raise RecognizerError(self._recognizer.get_error_message())
 
+            f = open(path, "rb")
+            try:
+                self._inode = os.fstat(f.fileno()).st_ino
+                info = read_model_header(f)
+                self._overlay_offset = info["overlay_offset"]
+                self._byteorder = info["byteorder"]
+                self._path = path
+                self._apply_overlay(f)
+            except ValueError as e:
+                raise RecognizerError(str(e))
+            finally:
+                f.close()
+
+        def refresh(self):
+            """
+            Apply the templates added to or deleted from the model since it
+            was opened or last refreshed, without reloading the model.
+
+            If the model was rewritten (e.g. compacted), it is reopened.
+            Recognition may go on in other threads in the meantime.
+
+            Return the number of changes applied.
+            """
+            if self._path is None:
+                raise RecognizerError("No model opened")
+
+            try:
+                f = open(self._path, "rb")
+            except IOError as e:
+                raise RecognizerError(str(e))
+
+            try:
+                if os.fstat(f.fileno()).st_ino != self._inode:
+                    recognizer = wagomu.Recognizer()
+                    recognizer.set_window_size(
+                        self._recognizer.get_window_size())
+                    recognizer.set_n_threads(self._recognizer.get_n_threads())
+                    recognizer.set_kernel(self._recognizer.get_kernel())
+                    if not recognizer.open(self._path):
+                        raise RecognizerError(recognizer.get_error_message())
+
+                    self._inode = os.fstat(f.fileno()).st_ino
+                    info = read_model_header(f)
+                    self._overlay_offset = info["overlay_offset"]
+                    self._byteorder = info["byteorder"]
+                    n_changes = self._apply_overlay(f, recognizer)
+                    # threads still using the previous one can finish
+                    self._recognizer = recognizer
+                    return n_changes + 1
+                else:
+                    return self._apply_overlay(f)
+            except ValueError as e:
+                raise RecognizerError(str(e))
+            finally:
+                f.close()
+
+        def _apply_overlay(self, f, recognizer=None):
+            if recognizer is None:
+                recognizer = self._recognizer
+
+            n_changes = 0
+
+            for op, unicode, n_strokes, features, end in \
+                    read_overlay(f, self._overlay_offset,
+                                 self._byteorder):
+                if op == OVERLAY_ADD:
+                    if not recognizer.add_template(unicode, n_strokes,
+                                                   features):
+                        raise RecognizerError(
+                                    recognizer.get_error_message())
+                elif op == OVERLAY_DELETE:
+                    recognizer.remove_templates(unicode)
+                else:
+                    raise RecognizerError("Invalid overlay operation")
+
+                self._overlay_offset = end
+                n_changes += 1
+
+            return n_changes
+
         def _recognize(self, writing, n=10):
             n_strokes = writing.get_n_strokes()
-            feat = self.get_features(writing)
-            nfeat = len(feat) 
-            nvectors = nfeat / VECTOR_DIMENSION_MAX
+            ch = wagomu.Character(self.get_feature_array(writing), n_strokes)
+            res = self._recognizer.recognize(ch, n)
 
-            ch = wagomu.Character(nvectors, n_strokes)
-            for i in range(nfeat):
-                ch.set_value(i, feat[i])
+            return self._get_results(res, 0, res.get_size())
 
-            res = self._recognizer.recognize(ch, n)
+        def _recognize_batch(self, writings, n=10):
+            # features of all the writings are packed in one buffer and
+            # processed in a single call, without holding the GIL
+            points = array("f")
+            sizes = array("I")
+
+            for writing in writings:
+                n_strokes = writing.get_n_strokes()
+                n_floats = len(points)
+                self.get_feature_array(writing, points)
+                sizes.append((len(points) - n_floats) // VECTOR_DIMENSION_MAX)
+                sizes.append(n_strokes)
+
+            res = self._recognizer.recognize_batch(points, sizes, n)
+            if res is None:
+                raise RecognizerError(self._recognizer.get_error_message())
+
+            # n is at most the number of templates
+            if len(writings) > 0:
+                n = res.get_size() // len(writings)
 
+            return [self._get_results(res, i * n, n) \
+                        for i in range(len(writings))]
+
+        def _get_results(self, res, start, size):
             candidates = []
-            for i in range(res.get_size()):
+            for i in range(start, start + size):
+                # unused entries of batch results
+                if res.get_unicode(i) == 0: break
                 utf8 = chr(res.get_unicode(i)).encode("utf8")
                 candidates.append((utf8, res.get_distance(i)))
 
@@ -258,14 +723,83 @@ except ImportError:
 
 # Trainer
 
+class _TemplateCache(object):
+    """
+    SQLite db of set templates, used to rebuild models incrementally.
+    """
+
+    def __init__(self, path):
+        self._con = sqlite3.connect(path)
+        self._con.execute("""CREATE TABLE IF NOT EXISTS templates(
+  key        TEXT PRIMARY KEY,
+  utf8       TEXT,
+  n_strokes  INTEGER,
+  features   BLOB
+)""")
+
+    def get(self, key):
+        row = self._con.execute("""SELECT utf8, n_strokes, features
+FROM templates WHERE key=?""", (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        features = array("f")
+        features.frombytes(row[2])
+        return row[0], row[1], features
+
+    def set(self, key, utf8, n_strokes, features):
+        self._con.execute("INSERT OR REPLACE INTO templates VALUES(?,?,?,?)",
+                          (key, utf8, n_strokes,
+                           sqlite3.Binary(array("f", features).tobytes())))
+
+    def prune(self, keys):
+        """
+        Delete the templates whose key is not in keys.
+        """
+        self._con.execute("CREATE TEMP TABLE used(key TEXT PRIMARY KEY)")
+        self._con.executemany("INSERT OR IGNORE INTO used VALUES(?)",
+                              [(key,) for key in keys])
+        self._con.execute("""DELETE FROM templates
+WHERE key NOT IN (SELECT key FROM used)""")
+        self._con.execute("DROP TABLE used")
+
+    def close(self):
+        self._con.commit()
+        self._con.close()
+
 class WagomuTrainer(_WagomuBase, Trainer):
 
     TRAINER_NAME = "wagomu"
 
+    # number of DTW distances computed by a worker in one task
+    DTW_BLOCK_SIZE = 2000
+
+    # to be increased when templates are computed differently
+    TEMPLATE_CACHE_VERSION = 1
+
+    # latest model format version
+    MODEL_VERSION = MODEL_VERSION
+
     def __init__(self):
         Trainer.__init__(self)
         _WagomuBase.__init__(self)
 
+        # Sakoe-Chiba band width used when comparing samples
+        self._dtw_window = None
+
+        # path of the template cache db (None if no cache)
+        self._template_cache = None
+
+        # format of the models written
+        self._model_version = MODEL_VERSION
+
+        # number of worker processes used to find set representatives
+        try:
+            self._n_processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self._n_processes = 1
+
     def train(self, charcol, meta, path=None):
         self._check_meta(meta)
 
@@ -289,23 +823,163 @@ class WagomuTrainer(_WagomuBase, Trainer):
         self._write_meta_file(meta, meta_file)
 
     def _get_representative_writing(self, writings):
-        n_writings = len(writings)
-        sum_ = [0] * n_writings
         features = [self.get_features(w) for w in writings]
+        rows = _dtw_rows((features, 0, len(features), self._vector_dimension,
+                          self._dtw_window))
+        return writings[self._get_representative_index(rows)]
 
+    def _get_representative_index(self, rows):
+        # rows[i][k] is the distance between samples i and j = i + k + 1
         # dtw is a symmetric distance so d(i,j) = d(j,i)
         # we only need to compute the values on the right side of the
         # diagonale
+        n_writings = len(rows)
+        sum_ = [0] * n_writings
+
         for i in range(n_writings):
-            for j in range (i+1, n_writings):
-                distance = dtw(features[i], features[j],
-                                self._vector_dimension)
+            for k, distance in enumerate(rows[i]):
                 sum_[i] += distance
-                sum_[j] += distance
-        
-        i = argmin(sum_)
+                sum_[i+k+1] += distance
+
+        return argmin(sum_)
+
+    def _get_pool(self):
+        if self._n_processes <= 1:
+            return None
+
+        # workers need the engine module, which is not importable by name
+        # (see tegaki.engine._load_engine_module), so they must be forked
+        if not "fork" in multiprocessing.get_all_start_methods():
+            return None
+
+        return multiprocessing.get_context("fork").Pool(self._n_processes)
+
+    def _get_templates(self, charcol, set_list):
+        """
+        Yield (utf8, writing) for each set, in set_list order.
+
+        Representatives of several sets are computed at the same time
+        by the worker pool. The DTW distances of large sets are split
+        in blocks of rows so that they are also spread across workers.
+        Distances are summed in the same order as in the serial case
+        so the output doesn't depend on the number of processes.
+        """
+        pool = self._get_pool()
+        pending = deque()
+        max_pending = 2 * self._n_processes
+
+        try:
+            for set_name in set_list:
+                chars = charcol.get_characters(set_name, read_only=True)
+                utf8 = chars[0].get_utf8()
+                writings = [c.get_writing() for c in chars]
 
-        return writings[i]
+                if len(writings) <= 2:
+                    # take the first one if only 1 or 2 samples available
+                    pending.append((utf8, writings, None))
+                else:
+                    features = [self.get_features(w) for w in writings]
+                    blocks = _split_rows(len(features),
+                                         self.DTW_BLOCK_SIZE)
+                    tasks = [(features, start, end, self._vector_dimension,
+                              self._dtw_window)
+                             for start, end in blocks]
+
+                    if pool is None:
+                        results = [_dtw_rows(t) for t in tasks]
+                    else:
+                        results = [pool.apply_async(_dtw_rows, (t,))
+                                   for t in tasks]
+
+                    pending.append((utf8, writings, results))
+
+                while len(pending) > max_pending:
+                    yield self._get_template(*pending.popleft())
+
+            while len(pending) > 0:
+                yield self._get_template(*pending.popleft())
+
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _get_template(self, utf8, writings, results):
+        if results is None:
+            return utf8, writings[0]
+
+        rows = []
+        for res in results:
+            if not isinstance(res, list):
+                res = res.get()
+            rows += res
+
+        return utf8, writings[self._get_representative_index(rows)]
+
+    def _get_template_features(self, writing, downsample_threshold=None):
+        # artificially increase the number of points
+        # this is useful when training data is made of straight lines
+        # and thus has very few points
+        writing.upsample_threshold(10)
+
+        return writing.get_n_strokes(), \
+               self.get_features(writing, downsample_threshold)
+
+    def _get_cache_key(self, digest):
+        # options which affect templates
+        options = "%d %d %s %s" % (self.TEMPLATE_CACHE_VERSION,
+                                   self._downsample_threshold,
+                                   self._feature_extraction_function.__name__,
+                                   self._dtw_window)
+        return hashlib.sha1(("%s %s" % (options, digest)).encode("ascii")) \
+                      .hexdigest()
+
+    def _get_all_template_features(self, charcol, set_list):
+        """
+        Yield (utf8, n_strokes, features) for each set, in set_list order.
+
+        If a template cache is set, only the templates of sets whose
+        contents changed since they were cached are computed. Once all
+        the templates are computed, the ones which were not used (sets
+        since modified or deleted, other options) are deleted from the
+        cache, which is therefore meant to be used for a single model.
+        """
+        if self._template_cache is None:
+            for utf8, writing in self._get_templates(charcol, set_list):
+                yield (utf8,) + self._get_template_features(writing)
+            return
+
+        cache = _TemplateCache(self._template_cache)
+
+        try:
+            digests = charcol.get_set_digests()
+            keys = dict((set_name, self._get_cache_key(digests[set_name])) \
+                            for set_name in set_list)
+            cached = {}
+            for set_name in set_list:
+                template = cache.get(keys[set_name])
+                if template is not None:
+                    cached[set_name] = template
+
+            missing = [set_name for set_name in set_list \
+                            if not set_name in cached]
+            templates = self._get_templates(charcol, missing)
+
+            for set_name in set_list:
+                if set_name in cached:
+                    yield cached[set_name]
+                else:
+                    # templates are yielded in missing order
+                    utf8, writing = next(templates)
+                    n_strokes, feat = self._get_template_features(writing)
+                    cache.set(keys[set_name], utf8, n_strokes, feat)
+                    yield utf8, n_strokes, feat
+
+            cache.prune(keys.values())
+        finally:
+            cache.close()
 
     def _save_model_from_charcol(self, charcol, output_path):
         chargroups = {} 
@@ -315,7 +989,7 @@ class WagomuTrainer(_WagomuBase, Trainer):
         # get non-empty set list
         set_list = []
         for set_name in charcol.get_set_list():
-            chars = charcol.get_characters(set_name)
+            chars = charcol.get_characters(set_name, limit=1, read_only=True)
             if len(chars) == 0: continue # empty set
 
             utf8 = chars[0].get_utf8()
@@ -327,41 +1001,44 @@ class WagomuTrainer(_WagomuBase, Trainer):
         # but we only need one ("the template") so we find the set
         # representative,  which we define as the sample which is, on
         # average, the closest to the other samples of that set
-        for set_name in set_list:
-            chars = charcol.get_characters(set_name)
-            if len(chars) == 0: continue # empty set
-
-            utf8 = chars[0].get_utf8()
-            if utf8 is None: continue
-
-            if len(chars) == 1 or len(chars) == 2:
-                # take the first one if only 1 or 2 samples available
-                writing = chars[0].get_writing()
-            else:
-                # we need to find the set representative
-                writings = [c.get_writing() for c in chars]
-                writing = self._get_representative_writing(writings)
-
-            # artificially increase the number of points
-            # this is useful when training data is made of straight lines
-            # and thus has very few points
-            writing.upsample_threshold(10)
-
-            feat = self.get_features(writing)
-            n_strokes = writing.get_n_strokes()
-
+        for utf8, n_strokes, feat in \
+                self._get_all_template_features(charcol, set_list):
             if not n_strokes in chargroups: chargroups[n_strokes] = []
             chargroups[n_strokes].append((utf8, feat))
 
-            print("%s (%d/%d)" % (utf8, n_chars+1, len(set_list)))
+            print("%s (%d/%d)" % (_to_text(utf8), n_chars+1,
+                                  len(set_list)))
             n_chars += 1
 
+        self._write_model(chargroups, output_path)
+
+    def _write_model(self, chargroups, output_path, dimension=None,
+                     downsample_threshold=None):
+        """
+        Write a model made of the templates in chargroups, a dictionary
+        which maps a number of strokes to a list of (utf8, features).
+        The vector dimension and the downsample threshold of the model
+        are the ones of the trainer by default.
+        """
+        if dimension is None:
+            dimension = self._vector_dimension
+        if downsample_threshold is None:
+            downsample_threshold = self._downsample_threshold
+
+        n_chars = sum([len(templates) for templates in chargroups.values()])
+
         stroke_counts = list(chargroups.keys())
         stroke_counts.sort()
 
         # Sort templates in stroke groups by length
         for sc in stroke_counts:
-            chargroups[sc].sort(lambda x,y: cmp(len(x[1]),len(y[1])))
+            chargroups[sc].sort(key=lambda x: len(x[1]))
+
+        if self._model_version >= 2:
+            self._write_model_v2(chargroups, stroke_counts, n_chars,
+                                 dimension, downsample_threshold,
+                                 output_path)
+            return
 
         # save model in binary format
         # this file is architecture dependent
@@ -377,10 +1054,10 @@ class WagomuTrainer(_WagomuBase, Trainer):
         write_uint(f, len(chargroups))
 
         # vector dimensionality
-        write_uint(f, self._vector_dimension)
+        write_uint(f, dimension)
 
         # downsample threshold
-        write_uint(f, self._downsample_threshold)
+        write_uint(f, downsample_threshold)
 
         strokedatasize = {}
 
@@ -390,10 +1067,10 @@ class WagomuTrainer(_WagomuBase, Trainer):
 
             for utf8, feat in chargroups[sc]:
                 # unicode integer
-                write_uint(f, ord(str(utf8, "utf-8")))
+                write_uint(f, _to_unicode(utf8))
                 
                 # n_vectors
-                write_uint(f, len(feat) / VECTOR_DIMENSION_MAX)
+                write_uint(f, len(feat) // VECTOR_DIMENSION_MAX)
 
                 strokedatasize[sc] += len(feat) * FLOAT_SIZE
 
@@ -415,13 +1092,13 @@ class WagomuTrainer(_WagomuBase, Trainer):
             write_uint(f, poffset)
 
             # padding
-            f.write("".join(["\0"] * 4))
+            f.write(b"\0" * 4)
 
             poffset += strokedatasize[sc] 
 
         # padding
         if pad > 0:
-            f.write("".join(["\0"] * pad))
+            f.write(b"\0" * pad)
 
         assert(f.tell() % (VECTOR_DIMENSION_MAX * FLOAT_SIZE) == 0)
 
@@ -435,6 +1112,205 @@ class WagomuTrainer(_WagomuBase, Trainer):
                 write_floats(f, *feat)
 
         f.close()
+
+    def _write_model_v2(self, chargroups, stroke_counts, n_chars, dimension,
+                        downsample_threshold, output_path):
+        # the model, except the header, is built in memory for the checksum
+        buf = io.BytesIO()
+
+        def pad_to(offset):
+            buf.write(b"\0" * (offset - HEADER_SIZE - buf.tell()))
+
+        chars_offset = get_padded_offset(HEADER_SIZE + 3 * 4 * INT_SIZE,
+                                         MODEL_ALIGN)
+        groups_offset = get_padded_offset(chars_offset +
+                                          n_chars * 2 * INT_SIZE,
+                                          MODEL_ALIGN)
+        templates_offset = get_padded_offset(groups_offset +
+                                             len(chargroups) * 4 * INT_SIZE,
+                                             MODEL_ALIGN)
+
+        # template sizes, padded
+        group_offsets = {}
+        offset = templates_offset
+        for sc in stroke_counts:
+            group_offsets[sc] = offset
+            for utf8, feat in chargroups[sc]:
+                offset = get_padded_offset(offset + len(feat) * FLOAT_SIZE,
+                                           MODEL_ALIGN)
+        model_size = offset
+
+        # section table
+        write_uints(buf,
+                    SECTION_CHARACTERS, chars_offset, n_chars * 2 * INT_SIZE,
+                    0,
+                    SECTION_GROUPS, groups_offset,
+                    len(chargroups) * 4 * INT_SIZE, 0,
+                    SECTION_TEMPLATES, templates_offset,
+                    model_size - templates_offset, 0,
+                    byteorder="<")
+
+        # character information
+        pad_to(chars_offset)
+        for sc in stroke_counts:
+            for utf8, feat in chargroups[sc]:
+                write_uints(buf, _to_unicode(utf8),
+                            len(feat) // VECTOR_DIMENSION_MAX, byteorder="<")
+
+        # character group information
+        pad_to(groups_offset)
+        for sc in stroke_counts:
+            write_uints(buf, sc, len(chargroups[sc]), group_offsets[sc], 0,
+                        byteorder="<")
+
+        # stroke data
+        for sc in stroke_counts:
+            for utf8, feat in chargroups[sc]:
+                pad_to(get_padded_offset(HEADER_SIZE + buf.tell(),
+                                                MODEL_ALIGN))
+                write_floats(buf, *feat, byteorder="<")
+        pad_to(model_size)
+
+        header = [MAGIC_NUMBER_V2, MODEL_VERSION, HEADER_SIZE, 3, n_chars,
+                  len(chargroups), dimension, downsample_threshold,
+                  model_size]
+        header = struct.pack("<%dI" % len(header), *header)
+        header += b"\0" * (HEADER_SIZE - INT_SIZE - len(header))
+        data = buf.getvalue()
+        crc = zlib.crc32(header[CRC_OFFSET:], zlib.crc32(header[:CRC_OFFSET]))
+        crc = zlib.crc32(data, crc) & 0xffffffff
+
+        f = open(output_path, "wb")
+        f.write(header[:CRC_OFFSET])
+        write_uint(f, crc, byteorder="<")
+        f.write(header[CRC_OFFSET:])
+        f.write(data)
+        f.close()
+
+    def get_model_version(self, path):
+        """
+        Return the format version of a model.
+        """
+        f = open(path, "rb")
+        try:
+            return read_model_header(f)["version"]
+        except ValueError as e:
+            raise TrainerError(str(e))
+        finally:
+            f.close()
+
+    def update(self, path, add=None, replace=None, delete=None):
+        """
+        Add, replace or delete templates of an existing model, without
+        rewriting it. Recognizers which have the model opened see the
+        changes after calling their refresh() method.
+
+        @type path: str
+        @param path: model path
+        @type add: list of (utf8, L{Writing})
+        @param add: templates to add to the existing ones
+        @type replace: list of (utf8, L{Writing})
+        @param replace: templates which replace all the existing ones of
+                        the same character
+        @type delete: list of str
+        @param delete: characters whose templates are deleted
+
+        Templates are computed with the options of the trainer (see
+        set_options()), except for the downsample threshold which is
+        the one of the model. A model can be updated by one process
+        at a time.
+        """
+        records = []
+
+        for utf8 in (delete or []):
+            records.append((OVERLAY_DELETE, _to_unicode(utf8), 0, []))
+
+        replaced = set()
+        for utf8, writing in (replace or []):
+            unicode = _to_unicode(utf8)
+            if not unicode in replaced:
+                records.append((OVERLAY_DELETE, unicode, 0, []))
+                replaced.add(unicode)
+
+        f = open(path, "r+b")
+
+        try:
+            info = read_model_header(f)
+            byteorder = info["byteorder"]
+            offset = info["overlay_offset"]
+            threshold = info["downsample_threshold"]
+
+            for utf8, writing in (add or []) + (replace or []):
+                n_strokes, feat = self._get_template_features(writing,
+                                                              threshold)
+                records.append((OVERLAY_ADD, _to_unicode(utf8), n_strokes,
+                                feat))
+
+            # drop a record left incomplete by an interrupted update
+            for record in read_overlay(f, offset, byteorder):
+                offset = record[-1]
+            f.truncate(offset)
+            f.seek(offset)
+
+            for op, unicode, n_strokes, feat in records:
+                write_uints(f, OVERLAY_MAGIC_NUMBER, op, unicode, n_strokes,
+                            len(feat) // VECTOR_DIMENSION_MAX,
+                            byteorder=byteorder)
+                write_floats(f, *feat, byteorder=byteorder)
+        except ValueError as e:
+            raise TrainerError(str(e))
+        finally:
+            f.close()
+
+    def compact(self, path, output_path=None):
+        """
+        Rewrite a model with its overlay merged into the stroke data.
+
+        @type path: str
+        @param path: model path
+        @type output_path: str
+        @param output_path: path of the new model (default: replace path)
+
+        When path is replaced, recognizers which have the model opened
+        reopen it on their next refresh().
+
+        The new model is written in the format set by the model_version
+        option, the latest one by default: this converts older models.
+        """
+        f = open(path, "rb")
+
+        try:
+            info = read_model_header(f)
+            templates = read_templates(f, info)
+
+            for op, unicode, n_strokes, feat, end in \
+                    read_overlay(f, info["overlay_offset"],
+                                 info["byteorder"]):
+                if op == OVERLAY_ADD:
+                    templates.append((unicode, n_strokes, feat))
+                elif op == OVERLAY_DELETE:
+                    templates = [t for t in templates if t[0] != unicode]
+                else:
+                    raise ValueError("Invalid overlay operation")
+        except ValueError as e:
+            raise TrainerError(str(e))
+        finally:
+            f.close()
+
+        chargroups = {}
+        for unicode, n_strokes, feat in templates:
+            chargroups.setdefault(n_strokes, []).append((chr(unicode),
+                                                         list(feat)))
+
+        if output_path is None:
+            # recognizers keep the old file mapped until they reopen it
+            tmp_path = path + ".tmp"
+            self._write_model(chargroups, tmp_path, info["dimension"],
+                              info["downsample_threshold"])
+            os.replace(tmp_path, path)
+        else:
+            self._write_model(chargroups, output_path, info["dimension"],
+                              info["downsample_threshold"])
             
 TRAINER_CLASS = WagomuTrainer
 
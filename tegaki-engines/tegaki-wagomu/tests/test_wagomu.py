@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest
+import io
+import os
+import random
+import sys
+import shutil
+import tempfile
+from array import array
+
+from tegaki.character import Character, Writing
+from tegaki.charcol import CharacterCollection
+
+import tegakiwagomu
+from tegakiwagomu import WagomuTrainer, read_model_header, read_templates, \
+                         dtw, dtw_many
+
+try:
+    import wagomu
+except ImportError:
+    wagomu = None
+
+META = {"name" : "Test", "shortname" : "test"}
+
+def get_collection():
+    """
+    Return a collection of a few characters, made of horizontal lines.
+    """
+    charcol = CharacterCollection()
+    charcol.WRITE_BACK = False
+
+    for i, uni in enumerate(["一", "二", "三", "十"]):
+        charcol.add_set(uni)
+
+        for k in range(3):
+            writing = Writing()
+            for j in range(min(i + 1, 3)):
+                writing.move_to(100 + 10 * k, 100 + 300 * j)
+                writing.line_to(900 - 10 * k, 100 + 300 * j + 20 * k)
+            if uni == "十":
+                writing.move_to(500, 100)
+                writing.line_to(500 + 10 * k, 900)
+
+            char = Character()
+            # labels are stored as utf-8 encoded bytes
+            char.set_unicode(uni)
+            char.set_writing(writing)
+            charcol.append_character(uni, char)
+
+    return charcol
+
+class DTWTest(unittest.TestCase):
+
+    def _get_sequence(self, d):
+        return [random.uniform(0, 100)
+                for i in range(random.randint(1, 30) * d)]
+
+    def testDTWMany(self):
+        random.seed(0)
+        for i in range(100):
+            d = random.choice((1, 2, 4))
+            window = random.choice((None, 0, 1, 3, 10))
+            s = self._get_sequence(d)
+            ts = [self._get_sequence(d) for k in range(3)]
+            self.assertEqual(dtw_many(s, ts, d, window),
+                             [dtw(s, t, d, window=window) for t in ts])
+        self.assertEqual(dtw_many(s, [], d), [])
+
+    def testDTWManyBatches(self):
+        if not hasattr(tegakiwagomu, "DTW_BATCH_CELLS"):
+            self.skipTest("numpy is not installed")
+
+        random.seed(1)
+        s = self._get_sequence(2)
+        ts = [self._get_sequence(2) for k in range(20)]
+        batch_cells = tegakiwagomu.DTW_BATCH_CELLS
+        tegakiwagomu.DTW_BATCH_CELLS = 1000
+        try:
+            self.assertEqual(dtw_many(s, ts, 2),
+                             [dtw(s, t, 2) for t in ts])
+        finally:
+            tegakiwagomu.DTW_BATCH_CELLS = batch_cells
+
+    def testWindow(self):
+        # the best path goes far from the diagonal
+        s = [0, 0, 10, 10, 10, 10, 10, 10]
+        t = [0, 0, 0, 0, 0, 0, 10, 10]
+        for window, distance in ((None, 0), (0, 40), (1, 30), (3, 10),
+                                 (4, 0), (7, 0)):
+            self.assertEqual(dtw(s, t, 1, window=window), distance)
+            self.assertEqual(dtw_many(s, [t], 1, window), [distance])
+
+        # the window is widened to the length difference
+        self.assertEqual(dtw(s, t[:4], 1, window=0),
+                         dtw(s, t[:4], 1, window=4))
+
+class TrainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.charcol = get_collection()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _train(self, trainer=None, **options):
+        path = os.path.join(self.tmpdir, "test.model")
+        options.setdefault("n_processes", 1)
+        if trainer is None:
+            trainer = WagomuTrainer()
+        trainer.set_options(options)
+        trainer.train(self.charcol, META, path)
+        return path
+
+    def _read_templates(self, path):
+        f = open(path, "rb")
+        try:
+            return read_templates(f, read_model_header(f))
+        finally:
+            f.close()
+
+    def testTrainV1(self):
+        path = self._train(model_version=1)
+        templates = self._read_templates(path)
+        self.assertEqual(sorted([(chr(t[0]), t[1]) for t in templates]),
+                         [("一", 1), ("三", 3), ("二", 2), ("十", 4)])
+
+    def testTrainV2(self):
+        path = self._train()
+        f = open(path, "rb")
+        try:
+            info = read_model_header(f)
+            templates = read_templates(f, info)
+        finally:
+            f.close()
+        self.assertEqual(info["version"], 2)
+        self.assertEqual(sorted([(chr(t[0]), t[1]) for t in templates]),
+                         [("一", 1), ("三", 3), ("二", 2), ("十", 4)])
+
+        # same templates as in a v1 model
+        path_v1 = os.path.join(self.tmpdir, "test_v1.model")
+        os.rename(self._train(model_version=1), path_v1)
+        self.assertEqual(self._read_templates(path_v1), templates)
+
+    def testTrainParallel(self):
+        # more samples per set, so that representatives are not obvious
+        random.seed(0)
+        for uni in ["一", "二", "三", "十"]:
+            for k in range(6):
+                char = self.charcol.get_characters(uni)[k % 3].copy()
+                writing = char.get_writing()
+                for stroke in writing.get_strokes(full=True):
+                    for point in stroke:
+                        point.x += random.randint(-30, 30)
+                        point.y += random.randint(-30, 30)
+                char.set_writing(writing)
+                self.charcol.append_character(uni, char)
+
+        path = self._train()
+        model = open(path, "rb").read()
+
+        # DTW distances of a set are split across workers
+        trainer = WagomuTrainer()
+        trainer.DTW_BLOCK_SIZE = 4
+        self._train(trainer, n_processes=3)
+        self.assertEqual(open(path, "rb").read(), model)
+
+    def testProgress(self):
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            self._train()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue("一 (1/4)" in output.splitlines())
+
+    def _count_cached(self, path):
+        import sqlite3
+        con = sqlite3.connect(path)
+        try:
+            return con.execute("SELECT COUNT(*) FROM templates").fetchone()[0]
+        finally:
+            con.close()
+
+    def testTemplateCache(self):
+        cache = os.path.join(self.tmpdir, "test.templates")
+        path = self._train(template_cache=cache)
+        model = open(path, "rb").read()
+        self.assertEqual(self._count_cached(cache), 4)
+
+        # same model with the templates from the cache
+        self._train(template_cache=cache)
+        self.assertEqual(open(path, "rb").read(), model)
+
+        # templates of modified or deleted sets are not kept
+        char = self.charcol.get_characters("一")[0]
+        self.charcol.append_character("二", char)
+        self.charcol.remove_set("三")
+        self._train(template_cache=cache)
+        self.assertEqual(self._count_cached(cache), 3)
+        self._train(template_cache=cache, downsample_threshold=30)
+        self.assertEqual(self._count_cached(cache), 3)
+
+    def testUpdate(self):
+        path = self._train(model_version=1, downsample_threshold=30)
+        writing = self.charcol.get_characters("十")[0].get_writing()
+
+        trainer = WagomuTrainer()
+        trainer.set_options({"model_version" : 1, "n_processes" : 1,
+                             "downsample_threshold" : 40})
+        trainer.update(path, add=[("口".encode("utf8"), writing.copy())],
+                       delete=["一".encode("utf8")])
+        f = open(path, "rb")
+        try:
+            info = read_model_header(f)
+            records = list(tegakiwagomu.read_overlay(f,
+                                                     info["overlay_offset"]))
+        finally:
+            f.close()
+        self.assertEqual([(r[0], chr(r[1])) for r in records],
+                         [(tegakiwagomu.OVERLAY_DELETE, "一"),
+                          (tegakiwagomu.OVERLAY_ADD, "口")])
+
+        # the new template is computed like the ones of the model
+        n_strokes, features = trainer._get_template_features(writing.copy(),
+                                                             30)
+        self.assertEqual(records[1][2], n_strokes)
+        self.assertEqual(records[1][3], array("f", features))
+
+        output_path = os.path.join(self.tmpdir, "compact.model")
+        trainer.compact(path, output_path)
+        f = open(output_path, "rb")
+        try:
+            info = read_model_header(f)
+            templates = read_templates(f, info)
+        finally:
+            f.close()
+        self.assertEqual(info["downsample_threshold"], 30)
+        self.assertEqual(sorted([chr(t[0]) for t in templates]),
+                         ["三", "二", "十", "口"])
+
+        # the options of the trainer are unchanged
+        trainer.train(self.charcol, META, output_path)
+        f = open(output_path, "rb")
+        try:
+            self.assertEqual(read_model_header(f)["downsample_threshold"], 40)
+        finally:
+            f.close()
+
+    def testSwappedModel(self):
+        # v1 model built on a machine with the other byte order
+        path = self._train(model_version=1)
+        templates = self._read_templates(path)
+        data = array("I")
+        data.frombytes(open(path, "rb").read())
+        data.byteswap()
+        f = open(path, "wb")
+        f.write(data.tobytes())
+        f.close()
+
+        trainer = WagomuTrainer()
+        trainer.set_options({"model_version" : 1})
+        trainer.update(path, delete=["一".encode("utf8")])
+        self.assertEqual(self._read_templates(path), templates)
+
+        trainer = WagomuTrainer()
+        self.assertEqual(trainer.get_model_version(path), 1)
+        trainer.compact(path)
+        self.assertEqual(trainer.get_model_version(path), 2)
+        self.assertEqual(self._read_templates(path),
+                         [t for t in templates if t[0] != ord("一")])
+
+def to_float32(x):
+    return array("f", [x])[0]
+
+FLT_MAX = to_float32(3.4028234663852886e+38)
+
+def local_distance(v1, v2):
+    # L1 distance of 2d vectors, in single precision like wagomu.cpp
+    return to_float32(to_float32(abs(v1[0] - v2[0])) +
+                      to_float32(abs(v1[1] - v2[1])))
+
+def get_features(n_vectors):
+    # random 2d vectors, padded to VECTOR_DIMENSION_MAX
+    return [v for i in range(n_vectors)
+              for v in (random.uniform(0, 60), random.uniform(0, 60), 0, 0)]
+
+class RecognizerTest(unittest.TestCase):
+
+    KERNELS = ("scalar", "sse", "avx2", "avx512")
+
+    def setUp(self):
+        if wagomu is None:
+            self.skipTest("the wagomu module is not built")
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "test.model")
+
+        random.seed(0)
+        # groups whose size is or isn't a multiple of the block widths, and
+        # larger than a range of templates
+        chargroups = {}
+        unicode = 0x4e00
+        for n_strokes, n_chars in ((1, 3), (2, 16), (3, 37), (5, 150)):
+            chargroups[n_strokes] = []
+            for i in range(n_chars):
+                chargroups[n_strokes].append((chr(unicode),
+                    get_features(random.randint(1, 40))))
+                unicode += 1
+        WagomuTrainer()._write_model(chargroups, self.path)
+
+        self.inputs = [(array("f", get_features(random.randint(1, 40))),
+                        random.randint(1, 6)) for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _recognize(self, recognizer, n_results):
+        results = []
+        for points, n_strokes in self.inputs:
+            res = recognizer.recognize(wagomu.Character(points, n_strokes),
+                                       n_results)
+            results.append([(res.get_unicode(i), res.get_distance(i))
+                            for i in range(res.get_size())])
+        return results
+
+    def _get_reference_results(self, points, n_strokes, n_results,
+                               window_size=3):
+        # full DTW against all the templates of the model, then full sort
+        f = open(self.path, "rb")
+        try:
+            templates = read_templates(f, read_model_header(f))
+        finally:
+            f.close()
+
+        results = []
+        for unicode, t_n_strokes, features in templates:
+            if n_strokes > window_size and \
+               abs(t_n_strokes - n_strokes) > window_size:
+                continue
+            dist = dtw(points, features, 4, local_distance)
+            # cells which can't be reached
+            if dist >= tegakiwagomu.DTW_INFINITY:
+                dist = FLT_MAX
+            results.append((dist, unicode))
+
+        results.sort()
+        return [(unicode, dist) for dist, unicode in results[:n_results]]
+
+    def testReference(self):
+        recognizers = self._get_recognizers()
+        # the pure Python DTW is slow
+        for points, n_strokes in self.inputs[:6]:
+            expected = self._get_reference_results(points, n_strokes, 10)
+            self.assertEqual(len(expected), 10)
+            for kernel, recognizer in recognizers.items():
+                res = recognizer.recognize(wagomu.Character(points,
+                                                            n_strokes), 10)
+                self.assertEqual(res.get_size(), 10)
+                for i in range(10):
+                    self.assertEqual(res.get_unicode(i), expected[i][0],
+                                     kernel)
+                    self.assertEqual(res.get_distance(i), expected[i][1],
+                                     kernel)
+
+    def _get_recognizers(self):
+        recognizers = {}
+        for kernel in self.KERNELS:
+            recognizer = wagomu.Recognizer()
+            self.assertTrue(recognizer.open(self.path))
+            # kernels not supported by the CPU are not tested
+            if recognizer.set_kernel(kernel):
+                recognizers[kernel] = recognizer
+        return recognizers
+
+    def _assertSameResults(self, recognizers):
+        for n_results in (10, 300):
+            expected = self._recognize(recognizers["scalar"], n_results)
+            for kernel, recognizer in recognizers.items():
+                self.assertEqual(self._recognize(recognizer, n_results),
+                                 expected, kernel)
+
+    def testKernels(self):
+        recognizers = self._get_recognizers()
+        self._assertSameResults(recognizers)
+
+        for recognizer in recognizers.values():
+            recognizer.set_n_threads(3)
+        self._assertSameResults(recognizers)
+
+    def testKernelsUpdate(self):
+        recognizers = self._get_recognizers()
+        self._assertSameResults(recognizers)
+
+        # templates added to existing and new groups, then removed
+        random.seed(1)
+        templates = [(0x9000 + i, random.choice((2, 3, 4, 5)),
+                      array("f", get_features(random.randint(1, 40))))
+                     for i in range(20)]
+        for recognizer in recognizers.values():
+            for unicode, n_strokes, points in templates:
+                self.assertTrue(recognizer.add_template(unicode, n_strokes,
+                                                        points))
+        self._assertSameResults(recognizers)
+
+        for recognizer in recognizers.values():
+            for unicode in (0x4e00, 0x4e05, 0x4e20, 0x9003, 0x9004):
+                self.assertEqual(recognizer.remove_templates(unicode), 1)
+        self._assertSameResults(recognizers)
+
+        # the kernel can be changed once the model is opened
+        for kernel, recognizer in recognizers.items():
+            recognizer.set_kernel("scalar")
+            recognizer.set_kernel(kernel)
+        self._assertSameResults(recognizers)
+
+    def _get_batch(self, inputs):
+        points = array("f")
+        sizes = array("I")
+        for input_points, n_strokes in inputs:
+            points.extend(input_points)
+            sizes.extend((len(input_points) // 4, n_strokes))
+        return points, sizes
+
+    def testBatchManyResults(self):
+        recognizer = wagomu.Recognizer()
+        self.assertTrue(recognizer.open(self.path))
+        inputs = self.inputs * 4
+        points, sizes = self._get_batch(inputs)
+
+        # n_results * len(inputs) doesn't fit in an unsigned int
+        res = recognizer.recognize_batch(points, sizes, 2**26 + 1)
+        n = res.get_size() // len(inputs)
+        self.assertEqual(n, recognizer.get_n_characters())
+
+        expected = self._recognize(recognizer, 1000) * 4
+        for k in range(len(inputs)):
+            results = [(res.get_unicode(i), res.get_distance(i))
+                       for i in range(k * n, k * n + n)]
+            self.assertEqual([r for r in results if r[0] != 0], expected[k])
+
+    def testManyResults(self):
+        recognizer = wagomu.Recognizer()
+        self.assertTrue(recognizer.open(self.path))
+        expected = self._recognize(recognizer, recognizer.get_n_characters())
+        self.assertEqual(self._recognize(recognizer, 2**32 - 1), expected)
+
+    def testBufferTypes(self):
+        points = [0.5] * 8
+        self.assertEqual(wagomu.Character(array("f", points), 1)
+                         .get_n_vectors(), 2)
+        # other types are not reinterpreted as floats or unsigned ints
+        for buf in (array("d", points), array("i", [0] * 8),
+                    array("f", points).tobytes()):
+            self.assertRaises(TypeError, wagomu.Character, buf, 1)
+
+        recognizer = wagomu.Recognizer()
+        self.assertTrue(recognizer.open(self.path))
+        points, sizes = self._get_batch(self.inputs[:2])
+        self.assertEqual(recognizer.recognize_batch(points, sizes, 1)
+                         .get_size(), 2)
+        self.assertRaises(TypeError, recognizer.recognize_batch,
+                          array("d", points), sizes, 1)
+        self.assertRaises(TypeError, recognizer.recognize_batch,
+                          points, array("q", sizes), 1)
+        self.assertRaises(TypeError, recognizer.add_template,
+                          0x9000, 1, array("d", points))
+
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        points = numpy.zeros((2, 4), dtype=numpy.float32)
+        self.assertEqual(wagomu.Character(points, 1).get_n_vectors(), 2)
+        self.assertRaises(TypeError, wagomu.Character,
+                          points.astype(numpy.float64), 1)
+        self.assertRaises(TypeError, wagomu.Character,
+                          points.astype(">f4"), 1)
+
+    def testThreads(self):
+        recognizer = wagomu.Recognizer()
+        self.assertTrue(recognizer.open(self.path))
+        expected = self._recognize(recognizer, 10)
+        # the worker threads are kept between recognitions
+        for n_threads in (4, 4, 1, 2, 8):
+            recognizer.set_n_threads(n_threads)
+            self.assertEqual(recognizer.get_n_threads(), n_threads)
+            self.assertEqual(self._recognize(recognizer, 10), expected)
@@ -25,8 +25,11 @@
 #include <stdio.h>
 #include <string.h>
 #include <float.h>
+#include <limits.h>
 #include <math.h>
 
+#include <algorithm>
+
 #ifdef HAVE_MEMALIGN
 #include <malloc.h>
 #else
@@ -35,8 +38,32 @@
 
 #include "wagomu.h"
 
+/* v1 models are written in the byte order of the machine which built them */
 #define MAGIC_NUMBER 0x77778888
-#define VEC_DIM_MAX 4
+
+/* v2 models are little-endian, see tegakiwagomu.py for the layout */
+#define MAGIC_NUMBER_V2 0x4f474157 /* "WAGO" */
+#define MODEL_VERSION 2
+#define HEADER_SIZE 64
+#define CRC_OFFSET 36
+#define SECTION_ENTRY_SIZE 16
+#define SECTION_CHARACTERS 1
+#define SECTION_GROUPS 2
+#define SECTION_TEMPLATES 3
+#define MODEL_ALIGN 64
+
+/* number of templates compared by a thread in one go (multiple of 16) */
+#define RANGE_SIZE 64
+
+/* DTW implementations, by number of templates compared at once */
+#define KERNEL_SCALAR 0
+#define KERNEL_SSE 1 /* 4 templates */
+#define KERNEL_AVX2 2 /* 8 templates */
+#define KERNEL_AVX512 3 /* 16 templates */
+#define N_KERNELS 4
+
+static const char *kernel_names[N_KERNELS] = {"scalar", "sse", "avx2",
+                                              "avx512"};
 
 #undef MIN
 #define MIN(a,b) ((a) < (b) ? (a) : (b))
@@ -68,9 +95,67 @@
 
 namespace wagomu {
 
+static bool kernel_supported(unsigned int kernel) {
+    switch (kernel) {
+        case KERNEL_SCALAR:
+            return true;
+#ifdef __SSE__
+        case KERNEL_SSE:
+            return true;
+#endif
+#ifdef WG_WIDE_KERNELS
+        /* the cpuid instruction, the OS must save the registers too */
+        case KERNEL_AVX2:
+            return __builtin_cpu_supports("avx2");
+        case KERNEL_AVX512:
+            return __builtin_cpu_supports("avx512f");
+#endif
+        default:
+            return false;
+    }
+}
+
+static guint32 read_le32(const char *p) {
+    guint32 v;
+    memcpy(&v, p, sizeof(guint32));
+    return GUINT32_FROM_LE(v);
+}
+
+static guint32 crc32(const unsigned char *buf, gsize len, guint32 crc) {
+    /* CRC-32 of ISO 3309, the one of zlib.crc32(buf, crc) */
+    guint32 table[256], c;
+    unsigned int i, k;
+    gsize n;
+
+    for (i=0; i < 256; i++) {
+        for (k=0, c=i; k < 8; k++)
+            c = (c & 1) ? 0xedb88320 ^ (c >> 1) : c >> 1;
+        table[i] = c;
+    }
+
+    for (n=0, c=crc ^ 0xffffffff; n < len; n++)
+        c = table[(c ^ buf[n]) & 0xff] ^ (c >> 8);
+
+    return c ^ 0xffffffff;
+}
+
 Character::Character(unsigned int n_vec, unsigned int n_stro) {
+    allocate(n_vec, n_stro);
+}
+
+Character::Character(float *buffer, unsigned int buffer_size,
+                     unsigned int n_stro) {
+    /* buffer may come from anywhere (e.g. a Python array), so the
+       points are copied to memory aligned as required by SSE */
+    allocate(buffer_size / VEC_DIM_MAX, n_stro);
+    if (n_vectors > 0)
+        memcpy(points, buffer, n_vectors * VEC_DIM_MAX * sizeof(float));
+}
+
+void Character::allocate(unsigned int n_vec, unsigned int n_stro) {
     n_vectors = n_vec;
     n_strokes = n_stro;
+    points = NULL;
     if (n_vec > 0)
         /*
         ptr = malloc(size+align+1);
@@ -141,13 +226,56 @@ unsigned int Results::get_size() {
 
 Recognizer::Recognizer() {
     window_size = 3;
+    n_threads = 1;
+    workers = NULL;
+    for (kernel=N_KERNELS-1; !kernel_supported(kernel); kernel--);
+    file = NULL;
+    data = NULL;
+    data_size = 0;
+    n_characters = 0;
+    n_groups = 0;
+    max_n_vectors = 0;
+    capacity = 0;
+    characters = NULL;
+    groups = NULL;
+    templates = NULL;
+    packed = NULL;
+    packed_width = 0;
+    error_msg = NULL;
+    g_rw_lock_init(&lock);
+    g_mutex_init(&pack_lock);
 }
 
 Recognizer::~Recognizer() {
+    if (workers) g_thread_pool_free(workers, FALSE, TRUE);
+    free_model();
+    g_rw_lock_clear(&lock);
+    g_mutex_clear(&pack_lock);
+}
+
+void Recognizer::free_model() {
+    unsigned int i;
+
+    free_packed();
+
+    if (templates)
+        for (i=0; i < n_characters; i++)
+            free_template(templates[i]);
+
     if (file) g_mapped_file_free(file);
-    if (distm) free(distm);
-    if (dtw1) free(dtw1);
-    if (dtw2) free(dtw2);
+    if (templates) free(templates);
+    if (characters) free(characters);
+    if (groups) free(groups);
+
+    file = NULL;
+    data = NULL;
+    data_size = 0;
+    templates = NULL;
+    characters = NULL;
+    groups = NULL;
+    n_characters = 0;
+    n_groups = 0;
+    capacity = 0;
 }
 
 unsigned int Recognizer::get_window_size() {
@@ -158,10 +286,67 @@ void Recognizer::set_window_size(unsigned int size) {
     window_size = size;
 }
 
+unsigned int Recognizer::get_n_threads() {
+    return n_threads;
+}
+
+void Recognizer::set_n_threads(unsigned int n) {
+    /*
+    Set the number of threads used by one recognition, the calling thread
+    included. The other threads are started once and reused.
+    */
+    n = n > 0 ? n : 1;
+
+    g_rw_lock_writer_lock(&lock);
+
+    if (n == 1 && workers) {
+        g_thread_pool_free(workers, FALSE, TRUE);
+        workers = NULL;
+    }
+    else if (n > 1 && !workers)
+        workers = g_thread_pool_new(scan_worker, NULL, n - 1, TRUE, NULL);
+    else if (n > 1)
+        g_thread_pool_set_max_threads(workers, n - 1, NULL);
+
+    n_threads = n;
+
+    g_rw_lock_writer_unlock(&lock);
+}
+
+char *Recognizer::get_kernel() {
+    return (char *) kernel_names[kernel];
+}
+
+bool Recognizer::set_kernel(char *name) {
+    /*
+    Select the DTW implementation: "scalar", "sse", "avx2" or "avx512".
+    By default, the fastest one supported by the CPU is used. The results
+    don't depend on the implementation.
+    */
+    unsigned int i;
+
+    for (i=0; i < N_KERNELS; i++) {
+        if (strcmp(name, kernel_names[i]) == 0) {
+            if (!kernel_supported(i)) {
+                error_msg = (char *) "DTW implementation not supported";
+                return false;
+            }
+            g_rw_lock_writer_lock(&lock);
+            kernel = i;
+            init_packed();
+            g_rw_lock_writer_unlock(&lock);
+            return true;
+        }
+    }
+
+    error_msg = (char *) "Unknown DTW implementation";
+    return false;
+}
+
 bool Recognizer::open(char *path) {
-    unsigned int *header;
-    char *cursor;
-    unsigned int max_n_vectors;
+    bool ok;
+
+    free_model();
 
     file = g_mapped_file_new(path, FALSE, NULL);
 
@@ -171,14 +356,49 @@ bool Recognizer::open(char *path) {
     }
 
     data = g_mapped_file_get_contents(file);
+    data_size = g_mapped_file_get_length(file);
 
-    header = (unsigned int *)data;
+    if (data_size >= sizeof(guint32) && read_le32(data) == MAGIC_NUMBER_V2)
+        ok = load_v2();
+    else
+        ok = load_v1();
 
-    if (header[0] != MAGIC_NUMBER) {
+    if (ok && (dimension == 0 || dimension > VEC_DIM_MAX)) {
+        error_msg = (char *) "Corrupted model";
+        ok = false;
+    }
+
+    if (!ok) {
+        free_model();
+        return false;
+    }
+
+    strokedata = templates[0];
+    max_n_vectors = get_max_n_vectors();
+    init_packed();
+
+    return true;
+}
+
+bool Recognizer::load_v1() {
+    unsigned int *header = (unsigned int *)data;
+    char *cursor;
+    guint64 size;
+
+    if (data_size < 5 * sizeof(unsigned int)) {
         error_msg = (char *) "Not a valid file";
         return false;
     }
 
+    if (header[0] != MAGIC_NUMBER) {
+        if (header[0] == GUINT32_SWAP_LE_BE(MAGIC_NUMBER))
+            error_msg = (char *) "Model built for another byte order "
+                                 "(use tegaki-upgrade to convert it)";
+        else
+            error_msg = (char *) "Not a valid file";
+        return false;
+    }
+
     n_characters =  header[1];
     n_groups = header[2];
     dimension = header[3];
@@ -188,60 +408,554 @@ bool Recognizer::open(char *path) {
         error_msg = (char *) "No characters in this model";
         return false;
     }
+
+    size = 5 * sizeof(unsigned int) +
+           (guint64) n_characters * sizeof(CharacterInfo) +
+           (guint64) n_groups * sizeof(CharacterGroup);
+
+    if (size > data_size) {
+        error_msg = (char *) "Truncated model";
+        return false;
+    }
     
     cursor = data + 5 * sizeof(unsigned int);
-    characters = (CharacterInfo *)cursor;
+    characters = (CharacterInfo *) malloc(n_characters *
+                                          sizeof(CharacterInfo));
+    memcpy(characters, cursor, n_characters * sizeof(CharacterInfo));
 
     cursor += n_characters * sizeof(CharacterInfo);
-    groups = (CharacterGroup *)cursor;
+    groups = (CharacterGroup *) malloc(n_groups * sizeof(CharacterGroup));
+    memcpy(groups, cursor, n_groups * sizeof(CharacterGroup));
+
+    return load_templates(size, data_size, VEC_DIM_MAX * sizeof(float),
+                          false);
+}
+
+bool Recognizer::load_v2() {
+    /*
+    The tables are copied and converted to the host byte order. On
+    little-endian hosts, the templates are used from the mapped file as is.
+    */
+    guint32 header[HEADER_SIZE / sizeof(guint32)];
+    guint32 n_sections, header_size, model_size, type, offset, size;
+    guint32 chars_offset = 0, groups_offset = 0;
+    guint32 templates_offset = 0, templates_size = 0;
+    unsigned int i, found = 0;
+    char *cursor;
+
+    if (data_size < HEADER_SIZE) {
+        error_msg = (char *) "Truncated model";
+        return false;
+    }
+
+    for (i=0; i < HEADER_SIZE / sizeof(guint32); i++)
+        header[i] = read_le32(data + i * sizeof(guint32));
+
+    if (header[1] != MODEL_VERSION) {
+        error_msg = (char *) "Unsupported model version";
+        return false;
+    }
+
+    header_size = header[2];
+    n_sections = header[3];
+    n_characters = header[4];
+    n_groups = header[5];
+    dimension = header[6];
+    downsample_threshold = header[7];
+    model_size = header[8];
+
+    /* the overlay, if any, follows the model */
+    if (model_size > data_size) {
+        error_msg = (char *) "Truncated model";
+        return false;
+    }
+
+    if (header_size < HEADER_SIZE ||
+        (guint64) header_size + (guint64) n_sections * SECTION_ENTRY_SIZE >
+            model_size) {
+        error_msg = (char *) "Corrupted model";
+        return false;
+    }
+
+    /* the checksum covers the whole model but itself */
+    if (crc32((unsigned char *) data + CRC_OFFSET + sizeof(guint32),
+              model_size - CRC_OFFSET - sizeof(guint32),
+              crc32((unsigned char *) data, CRC_OFFSET, 0)) != header[9]) {
+        error_msg = (char *) "Corrupted model (bad checksum)";
+        return false;
+    }
+
+    /* unknown sections are skipped */
+    for (i=0, cursor=data + header_size; i < n_sections;
+         i++, cursor += SECTION_ENTRY_SIZE) {
+        type = read_le32(cursor);
+        offset = read_le32(cursor + 4);
+        size = read_le32(cursor + 8);
+
+        if ((guint64) offset + size > model_size) {
+            error_msg = (char *) "Corrupted model";
+            return false;
+        }
+
+        if ((type == SECTION_CHARACTERS &&
+             size != (guint64) n_characters * 2 * sizeof(guint32)) ||
+            (type == SECTION_GROUPS &&
+             size != (guint64) n_groups * 4 * sizeof(guint32))) {
+            error_msg = (char *) "Corrupted model";
+            return false;
+        }
+
+        switch (type) {
+            case SECTION_CHARACTERS:
+                chars_offset = offset;
+                break;
+            case SECTION_GROUPS:
+                groups_offset = offset;
+                break;
+            case SECTION_TEMPLATES:
+                templates_offset = offset;
+                templates_size = size;
+                break;
+            default:
+                continue;
+        }
+
+        found |= 1 << type;
+    }
+
+    if (found != ((1 << SECTION_CHARACTERS) | (1 << SECTION_GROUPS) |
+                  (1 << SECTION_TEMPLATES))) {
+        error_msg = (char *) "Corrupted model";
+        return false;
+    }
+
+    if (n_characters == 0 || n_groups == 0) {
+        error_msg = (char *) "No characters in this model";
+        return false;
+    }
+
+    characters = (CharacterInfo *) malloc(n_characters *
+                                          sizeof(CharacterInfo));
+
+    for (i=0, cursor=data + chars_offset; i < n_characters; i++) {
+        characters[i].unicode = read_le32(cursor);
+        characters[i].n_vectors = read_le32(cursor + 4);
+        cursor += 2 * sizeof(guint32);
+    }
+
+    groups = (CharacterGroup *) malloc(n_groups * sizeof(CharacterGroup));
+
+    for (i=0, cursor=data + groups_offset; i < n_groups; i++) {
+        groups[i].n_strokes = read_le32(cursor);
+        groups[i].n_chars = read_le32(cursor + 4);
+        groups[i].offset = read_le32(cursor + 8);
+        cursor += 4 * sizeof(guint32);
+    }
+
+    return load_templates(templates_offset,
+                          (guint64) templates_offset + templates_size,
+                          MODEL_ALIGN, G_BYTE_ORDER == G_BIG_ENDIAN);
+}
+
+bool Recognizer::load_templates(guint64 start, guint64 end,
+                                unsigned int align, bool swap) {
+    /*
+    Find the start of each template in the stroke data, between the
+    offsets start and end. Templates of a group follow each other, each
+    one starting on an align boundary.
+
+    If swap is true, templates are copied in the host byte order.
+    */
+    unsigned int group_id, char_id, i, k;
+    guint64 offset, size;
+    float *points;
+
+    templates = (float **) malloc(n_characters * sizeof(float *));
+    capacity = n_characters;
+
+    for (group_id=0, char_id=0; group_id < n_groups; group_id++) {
+        offset = groups[group_id].offset;
+
+        if (offset < start || offset % align != 0 ||
+            groups[group_id].n_chars > n_characters - char_id) {
+            /* only the templates set so far are freed */
+            n_characters = char_id;
+            error_msg = (char *) "Corrupted model";
+            return false;
+        }
+
+        for (i=0; i < groups[group_id].n_chars; i++, char_id++) {
+            if (characters[char_id].n_vectors == 0) {
+                n_characters = char_id;
+                error_msg = (char *) "Empty template";
+                return false;
+            }
+
+            size = (guint64) characters[char_id].n_vectors * VEC_DIM_MAX *
+                   sizeof(float);
+
+            if (offset + size > end) {
+                n_characters = char_id;
+                error_msg = (char *) "Truncated model";
+                return false;
+            }
+
+            if (swap) {
+#ifdef HAVE_POSIX_MEMALIGN
+                posix_memalign((void**)&points, 16, size);
+#else
+                points = (float *) memalign(16, size);
+#endif
+                for (k=0; k < size / sizeof(float); k++) {
+                    guint32 v = read_le32(data + offset + k * sizeof(float));
+                    memcpy(points + k, &v, sizeof(float));
+                }
+                templates[char_id] = points;
+            }
+            else
+                templates[char_id] = (float *) (data + offset);
+
+            offset += (size + align - 1) / align * align;
+        }
+    }
+
+    if (char_id != n_characters) {
+        n_characters = char_id;
+        error_msg = (char *) "Corrupted model";
+        return false;
+    }
+
+    return true;
+}
+
+unsigned int Recognizer::get_max_n_vectors() {
+    unsigned int i, max_n_vectors;
+
+    for (i=0, max_n_vectors=0; i < n_characters; i++)
+        if (characters[i].n_vectors > max_n_vectors)
+            max_n_vectors = characters[i].n_vectors;
+
+    return max_n_vectors;
+}
+
+void Recognizer::free_template(float *points) {
+    /* only added templates were allocated */
+    if ((char *) points < data || (char *) points >= data + data_size)
+        free(points);
+}
+
+void Recognizer::init_packed() {
+    /*
+    Drop the blocks of templates and select the block width of the
+    current kernel. Groups are packed the first time they are compared
+    with an input, see get_packed_group(), so that opening a model
+    doesn't copy its templates.
+    */
+    free_packed();
 
-    strokedata = (float *)(data + groups[0].offset);
+    if (kernel == KERNEL_AVX512)
+        packed_width = 16;
+    else if (kernel == KERNEL_AVX2)
+        packed_width = 8;
+    else
+        packed_width = 0;
 
-    distm = (CharDist *) malloc(n_characters * sizeof(CharDist));
+    packed = (PackedGroup *) calloc(n_groups + 1, sizeof(PackedGroup));
+}
+
+void Recognizer::free_packed() {
+    unsigned int group_id;
+
+    if (packed) {
+        for (group_id=0; group_id < n_groups; group_id++)
+            unpack_group(&packed[group_id]);
+        free(packed);
+    }
+
+    packed = NULL;
+    packed_width = 0;
+}
+
+PackedGroup *Recognizer::get_packed_group(unsigned int group_id,
+                                          unsigned int first) {
+    /*
+    Return the blocks of a group, whose first template is first, and
+    build them if needed. Called by the recognition threads, with the
+    reader lock held.
+    */
+    PackedGroup *pg = &packed[group_id];
+
+    if (!g_atomic_int_get(&pg->ready)) {
+        g_mutex_lock(&pack_lock);
+        if (!pg->ready) {
+            pack_group(pg, group_id, first);
+            g_atomic_int_set(&pg->ready, 1);
+        }
+        g_mutex_unlock(&pack_lock);
+    }
+
+    return pg;
+}
+
+void Recognizer::pack_group(PackedGroup *pg,
+                            unsigned int group_id,
+                            unsigned int first) {
+    /*
+    Build the blocks of templates of a group used by the AVX2 and AVX-512
+    kernels.
+
+    The templates of the group are split in blocks of packed_width
+    templates, from the first one (the remaining ones are compared with
+    the other kernels). For the j-th vector of the templates of a block,
+    the first component of each template is stored, then the second one
+    and so on: the first component of template k is at
+    (j * dimension) * packed_width + k. Templates shorter than the longest
+    one are padded with their last vector.
+    */
+    unsigned int b, c, i, j, k, d, m, n;
+    float *points;
+
+    pg->n_blocks = groups[group_id].n_chars / packed_width;
+    pg->blocks = (PackedBlock *) malloc((pg->n_blocks + 1) *
+                                        sizeof(PackedBlock));
+
+    for (b=0, c=first; b < pg->n_blocks; b++, c += packed_width) {
+        for (k=0, m=0; k < packed_width; k++)
+            m = MAX(m, characters[c+k].n_vectors);
+
+        n = m * dimension * packed_width;
+#ifdef HAVE_POSIX_MEMALIGN
+        posix_memalign((void**)&points, 64, n * sizeof(float));
+#else
+        points = (float *) memalign(64, n * sizeof(float));
+#endif
 
+        for (k=0; k < packed_width; k++) {
+            for (j=0; j < m; j++) {
+                i = MIN(j, characters[c+k].n_vectors - 1);
+                for (d=0; d < dimension; d++)
+                    points[(j * dimension + d) * packed_width + k] =
+                        templates[c+k][i * VEC_DIM_MAX + d];
+            }
+        }
+
+        pg->blocks[b].points = points;
+        pg->blocks[b].n_vectors = m;
+    }
+}
+
+void Recognizer::unpack_group(PackedGroup *pg) {
+    /* the group will be packed again when needed */
+    unsigned int b;
+
+    if (pg->blocks) {
+        for (b=0; b < pg->n_blocks; b++)
+            free(pg->blocks[b].points);
+        free(pg->blocks);
+    }
+
+    pg->blocks = NULL;
+    pg->n_blocks = 0;
+    pg->ready = 0;
+}
+
+bool Recognizer::add_template(unsigned int unicode,
+                              unsigned int n_strokes,
+                              float *buffer,
+                              unsigned int buffer_size) {
+    /*
+    Add a template to the model, in memory.
+
+    buffer: the feature vectors of the template
+    buffer_size: number of floats in buffer
+
+    The template is compared with the input after the other templates of
+    its group (same number of strokes).
+    */
+    unsigned int group_id, char_id, n_vectors = buffer_size / VEC_DIM_MAX;
+    float *points;
+
+    if (!file) {
+        error_msg = (char *) "No model opened";
+        return false;
+    }
+
+    if (n_vectors == 0) {
+        error_msg = (char *) "Empty template";
+        return false;
+    }
+
+#ifdef HAVE_POSIX_MEMALIGN
+    posix_memalign((void**)&points, 16, buffer_size * sizeof(float));
+#else
+    points = (float *) memalign(16, buffer_size * sizeof(float));
+#endif
+    memcpy(points, buffer, buffer_size * sizeof(float));
+
+    g_rw_lock_writer_lock(&lock);
+
+    /* groups are sorted by number of strokes */
+    for (group_id=0, char_id=0; group_id < n_groups &&
+         groups[group_id].n_strokes < n_strokes; group_id++)
+        char_id += groups[group_id].n_chars;
+
+    if (group_id == n_groups || groups[group_id].n_strokes != n_strokes) {
+        groups = (CharacterGroup *) realloc(groups, (n_groups + 1) *
+                                                    sizeof(CharacterGroup));
+        memmove(groups + group_id + 1, groups + group_id,
+                (n_groups - group_id) * sizeof(CharacterGroup));
+        groups[group_id].n_strokes = n_strokes;
+        groups[group_id].n_chars = 0;
+        groups[group_id].offset = 0;
+
+        packed = (PackedGroup *) realloc(packed, (n_groups + 1) *
+                                                 sizeof(PackedGroup));
+        memmove(packed + group_id + 1, packed + group_id,
+                (n_groups - group_id) * sizeof(PackedGroup));
+        memset(packed + group_id, 0, sizeof(PackedGroup));
+
+        n_groups++;
+    }
+    else {
+        /* only the group of the template has to be packed again */
+        unpack_group(&packed[group_id]);
+    }
+
+    char_id += groups[group_id].n_chars;
+
+    if (n_characters == capacity) {
+        capacity = capacity * 2 + 16;
+        characters = (CharacterInfo *) realloc(characters, capacity *
+                                               sizeof(CharacterInfo));
+        templates = (float **) realloc(templates, capacity *
+                                                  sizeof(float *));
+    }
+
+    memmove(characters + char_id + 1, characters + char_id,
+            (n_characters - char_id) * sizeof(CharacterInfo));
+    memmove(templates + char_id + 1, templates + char_id,
+            (n_characters - char_id) * sizeof(float *));
+
+    characters[char_id].unicode = unicode;
+    characters[char_id].n_vectors = n_vectors;
+    templates[char_id] = points;
+
+    groups[group_id].n_chars++;
+    n_characters++;
+    if (n_vectors > max_n_vectors)
+        max_n_vectors = n_vectors;
+
+    g_rw_lock_writer_unlock(&lock);
+
+    return true;
+}
+
+unsigned int Recognizer::remove_templates(unsigned int unicode) {
+    /*
+    Remove the templates of a character from the model, in memory.
+    Return the number of templates removed.
+    */
+    unsigned int group_id, i, j, k, n_kept, n_removed = 0;
+
+    g_rw_lock_writer_lock(&lock);
+
+    for (group_id=0, i=0, j=0; group_id < n_groups; group_id++) {
+        for (k=0, n_kept=0; k < groups[group_id].n_chars; k++, i++) {
+            if (characters[i].unicode == unicode) {
+                free_template(templates[i]);
+                n_removed++;
+            }
+            else {
+                characters[j] = characters[i];
+                templates[j] = templates[i];
+                j++;
+                n_kept++;
+            }
+        }
+        /* only the groups which changed have to be packed again */
+        if (n_kept < groups[group_id].n_chars)
+            unpack_group(&packed[group_id]);
+        groups[group_id].n_chars = n_kept;
+    }
+
+    n_characters = j;
+
+    /* remove empty groups */
+    for (group_id=0, j=0; group_id < n_groups; group_id++) {
+        if (groups[group_id].n_chars > 0) {
+            groups[j] = groups[group_id];
+            packed[j] = packed[group_id];
+            j++;
+        }
+        else
+            unpack_group(&packed[group_id]);
+    }
+
+    n_groups = j;
     max_n_vectors = get_max_n_vectors();
 
+    g_rw_lock_writer_unlock(&lock);
+
+    return n_removed;
+}
+
+Scratch *Recognizer::new_scratch(unsigned int n_results,
+                                 bool with_distances) {
+    Scratch *scratch = (Scratch *) malloc(sizeof(Scratch));
+
+    /* no more results than templates, so that the heap size can't wrap */
+    n_results = MIN(n_results, n_characters);
+
+    scratch->max_best = n_results;
+    scratch->n_best = 0;
+    scratch->best = (float *) malloc((n_results + 1) * sizeof(float));
+
+    if (with_distances)
+        scratch->distm = (CharDist *) malloc(n_characters * sizeof(CharDist));
+    else
+        scratch->distm = NULL;
+
 #ifdef __SSE__
+    /* room for the 16 distances of one cell for the AVX-512 kernel,
+       64-byte aligned */
 #ifdef HAVE_POSIX_MEMALIGN
-    posix_memalign((void**)&dtw1v, 16, max_n_vectors * VEC_DIM_MAX *
+    posix_memalign((void**)&scratch->dtw1v, 64, max_n_vectors * VEC_DIM_MAX *
 #else
-    dtw1v = (wg_v4sf *) memalign(16, max_n_vectors * VEC_DIM_MAX *
+    scratch->dtw1v = (wg_v4sf *) memalign(64, max_n_vectors * VEC_DIM_MAX *
 #endif
-                                     sizeof(wg_v4sf));
+                                              sizeof(wg_v4sf));
 #ifdef HAVE_POSIX_MEMALIGN
-    posix_memalign((void**)&dtw2v, 16, max_n_vectors * VEC_DIM_MAX *
+    posix_memalign((void**)&scratch->dtw2v, 64, max_n_vectors * VEC_DIM_MAX *
 #else
-    dtw2v = (wg_v4sf *) memalign(16, max_n_vectors * VEC_DIM_MAX *
+    scratch->dtw2v = (wg_v4sf *) memalign(64, max_n_vectors * VEC_DIM_MAX *
 #endif
-                                     sizeof(wg_v4sf));
-    dtw1 = (float *) dtw1v;
-    dtw2 = (float *) dtw2v;
+                                              sizeof(wg_v4sf));
+    scratch->dtw1 = (float *) scratch->dtw1v;
+    scratch->dtw2 = (float *) scratch->dtw2v;
 #else
 #ifdef HAVE_POSIX_MEMALIGN
-    posix_memalign((void**)&dtw1, 16, max_n_vectors * VEC_DIM_MAX *
+    posix_memalign((void**)&scratch->dtw1, 16, max_n_vectors * VEC_DIM_MAX *
 #else
-    dtw1 = (float *) memalign(16, max_n_vectors * VEC_DIM_MAX *
+    scratch->dtw1 = (float *) memalign(16, max_n_vectors * VEC_DIM_MAX *
 #endif
-                                  sizeof(float));
+                                           sizeof(float));
 #ifdef HAVE_POSIX_MEMALIGN
-    posix_memalign((void**)&dtw2, 16, max_n_vectors * VEC_DIM_MAX *
+    posix_memalign((void**)&scratch->dtw2, 16, max_n_vectors * VEC_DIM_MAX *
 #else
-    dtw2 = (float *) memalign(16, max_n_vectors * VEC_DIM_MAX *
+    scratch->dtw2 = (float *) memalign(16, max_n_vectors * VEC_DIM_MAX *
 #endif
-                                  sizeof(float));
+                                           sizeof(float));
 #endif
 
-    return true;
+    return scratch;
 }
 
-unsigned int Recognizer::get_max_n_vectors() {
-    unsigned int i, max_n_vectors;
-
-    for (i=0, max_n_vectors=0; i < n_characters; i++)
-        if (characters[i].n_vectors > max_n_vectors)
-            max_n_vectors = characters[i].n_vectors;
-
-    return max_n_vectors;
+void Recognizer::free_scratch(Scratch *scratch) {
+    if (scratch->distm) free(scratch->distm);
+    free(scratch->best);
+    free(scratch->dtw1);
+    free(scratch->dtw2);
+    free(scratch);
 }
 
 unsigned int Recognizer::get_n_characters() {
@@ -306,8 +1020,10 @@ A cell can thus be calculated as follows:
 
 */
 
-inline float Recognizer::dtw(float *s, unsigned int n, 
-                             float *t, unsigned int m) {
+inline float Recognizer::dtw(Scratch *scratch,
+                             float *s, unsigned int n, 
+                             float *t, unsigned int m,
+                             float bound) {
     /*
     Compare an input sequence with a reference sequence.
 
@@ -316,10 +1032,14 @@ inline float Recognizer::dtw(float *s, unsigned int n,
 
     t: reference sequence
     m: number of vectors in t
+
+    bound: if the distance is known to be greater than bound,
+           the computation is abandoned and FLT_MAX is returned
     */
     unsigned int i, j;
-    float cost;
+    float cost, colmin;
     float *t_start, *tmp;
+    float *dtw1 = scratch->dtw1, *dtw2 = scratch->dtw2;
 
     t_start = t;
 
@@ -335,16 +1055,24 @@ inline float Recognizer::dtw(float *s, unsigned int n,
     /* Iterate over columns */
     for (i=1; i < n; i++) {
         t = t_start + VEC_DIM_MAX;
+        colmin = FLT_MAX;
 
         /* Iterate over cells of that column */
         for (j=1; j < m; j++) {
             cost = local_distance(s, t);
             /* Inductive step */
             dtw2[j] = cost + MIN3(dtw2[j-1],dtw1[j],dtw1[j-1]);
+            colmin = MIN(colmin, dtw2[j]);
 
             t += VEC_DIM_MAX;
         }
 
+        /* Early abandoning: every path goes through this column and
+           costs are positive so the distance can't be smaller than
+           the smallest cell of the column */
+        if (colmin > bound)
+            return FLT_MAX;
+
         SWAP(dtw1,dtw2,tmp);
         *dtw2 = FLT_MAX;
 
@@ -385,15 +1113,18 @@ do { \
         dtw2v[j].s[n] = costf + MIN3(dtw2v[j-1].s[n], \
                                      dtw1v[j].s[n], \
                                      dtw1v[j-1].s[n]); \
+        colmin.s[n] = MIN(colmin.s[n], dtw2v[j].s[n]); \
         t += VEC_DIM_MAX; \
     } \
 } while(0)
 
-inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n, 
+inline wg_v4sf Recognizer::dtw4(Scratch *scratch,
+                                float *s, unsigned int n, 
                                 float *t0, unsigned int m0,
                                 float *t1, unsigned int m1,
                                 float *t2, unsigned int m2,
-                                float *t3, unsigned int m3) {
+                                float *t3, unsigned int m3,
+                                float bound) {
     /*
     Compare an input sequence with 4 reference sequences.
 
@@ -406,13 +1137,17 @@ inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n,
 
     t0..t3: reference sequences
     m0..m3: number of vectors in the sequence
+
+    bound: see dtw(), the computation is abandoned when the four
+           distances are known to be greater than bound
     */
     unsigned int i, j, common;
-    wg_v4sf cost;
+    wg_v4sf cost, colmin;
     float costf;
     float *t_start0, *t_start1, *t_start2, *t_start3;
     wg_v4sf *tmp;
     wg_v4sf res;
+    wg_v4sf *dtw1v = scratch->dtw1v, *dtw2v = scratch->dtw2v;
 
     t_start0 = t0; t_start1 = t1; t_start2 = t2; t_start3 = t3;
 
@@ -431,6 +1166,7 @@ inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n,
     for (i=1; i < n; i++) {
         t0 = t_start0 + VEC_DIM_MAX; t1 = t_start1 + VEC_DIM_MAX;
         t2 = t_start2 + VEC_DIM_MAX; t3 = t_start3 + VEC_DIM_MAX;
+        colmin.v = _mm_set_ps1(FLT_MAX);
 
         /* Iterate over cells of that column */
         /* Process 4 cells at a time in parallel */
@@ -439,6 +1175,7 @@ inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n,
             /* Inductive step */
             dtw2v[j].v = _mm_add_ps(cost.v,
                                 MIN3VEC(dtw2v[j-1].v,dtw1v[j].v,dtw1v[j-1].v));
+            colmin.v = _mm_min_ps(colmin.v, dtw2v[j].v);
 
             t0 += VEC_DIM_MAX; t1 += VEC_DIM_MAX;
             t2 += VEC_DIM_MAX; t3 += VEC_DIM_MAX;
@@ -450,6 +1187,12 @@ inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n,
         DTW4_PROCESS_REMAINING(2, m2, t2);
         DTW4_PROCESS_REMAINING(3, m3, t3);
 
+        /* Early abandoning, see dtw() */
+        if (MIN4(colmin.s[0], colmin.s[1], colmin.s[2], colmin.s[3]) > bound) {
+            res.v = _mm_set_ps1(FLT_MAX);
+            return res;
+        }
+
         SWAP(dtw1v,dtw2v,tmp);
         dtw2v[0].v = _mm_set_ps1(FLT_MAX);
 
@@ -463,10 +1206,149 @@ inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n,
 }
 #endif
 
-static int char_dist_cmp(CharDist *a, CharDist *b) {
-    if (a->dist < b->dist) return -1;
-    if (a->dist > b->dist) return 1;
-    return  0;
+#ifdef WG_WIDE_KERNELS
+
+/*
+The AVX2 and AVX-512 kernels compare the input with 8 and 16 templates
+at once. They use blocks of templates packed by pack_group(): each
+component of the vectors of the templates is loaded in one register and
+the costs are computed without shuffling, like in dtw4() (components are
+summed in the same order so that the distances are the same).
+
+Templates shorter than the longest one of their block are padded with
+their last vector. The cells past their end don't change their distance,
+they only make early abandoning less likely.
+*/
+
+#define DTW_WIDE(SUFFIX, WIDTH, TYPE, PREFIX, SET1, ANDNOT) \
+static void dtw##SUFFIX(Scratch *scratch, \
+                        float *s, unsigned int n, \
+                        PackedBlock *block, unsigned int *lengths, \
+                        unsigned int dimension, float bound, \
+                        float *res) { \
+    unsigned int i, j, k, d, m = block->n_vectors; \
+    unsigned int stride = dimension * WIDTH; \
+    TYPE *dtw1v = (TYPE *) scratch->dtw1v; \
+    TYPE *dtw2v = (TYPE *) scratch->dtw2v; \
+    TYPE *tmp, cost, colmin, sv[VEC_DIM_MAX]; \
+    TYPE inf = SET1(FLT_MAX), mask = SET1(-0.0); \
+    float *t; \
+    float colmins[WIDTH] __attribute__((aligned(WIDTH * 4))); \
+\
+    /* Initialize the edge cells */ \
+    dtw1v[0] = SET1(0); \
+    dtw2v[0] = inf; \
+\
+    for (j=1; j < m; j++) \
+        dtw1v[j] = inf; \
+\
+    s += VEC_DIM_MAX; \
+\
+    /* Iterate over columns */ \
+    for (i=1; i < n; i++) { \
+        for (d=0; d < dimension; d++) \
+            sv[d] = SET1(s[d]); \
+\
+        colmin = inf; \
+        t = block->points + stride; \
+\
+        /* Iterate over cells of that column, for all the templates */ \
+        for (j=1; j < m; j++, t += stride) { \
+            d = dimension - 1; \
+            cost = PREFIX##_sub_ps(PREFIX##_load_ps(t + d * WIDTH), sv[d]); \
+            cost = ANDNOT(mask, cost); /* absolute value */ \
+\
+            while (d-- > 0) \
+                cost = PREFIX##_add_ps(cost, \
+                           ANDNOT(mask, \
+                               PREFIX##_sub_ps( \
+                                   PREFIX##_load_ps(t + d * WIDTH), \
+                                   sv[d]))); \
+\
+            /* Inductive step */ \
+            dtw2v[j] = PREFIX##_add_ps(cost, \
+                           PREFIX##_min_ps(dtw2v[j-1], \
+                                           PREFIX##_min_ps(dtw1v[j], \
+                                                           dtw1v[j-1]))); \
+            colmin = PREFIX##_min_ps(colmin, dtw2v[j]); \
+        } \
+\
+        /* Early abandoning, see dtw() */ \
+        PREFIX##_store_ps(colmins, colmin); \
+        for (k=0; k < WIDTH && colmins[k] > bound; k++); \
+\
+        if (k == WIDTH) { \
+            for (k=0; k < WIDTH; k++) \
+                res[k] = FLT_MAX; \
+            return; \
+        } \
+\
+        SWAP(dtw1v,dtw2v,tmp); \
+        dtw2v[0] = inf; \
+\
+        s += VEC_DIM_MAX; \
+    } \
+\
+    for (k=0; k < WIDTH; k++) \
+        res[k] = ((float *) &dtw1v[lengths[k] - 1])[k]; \
+}
+
+/* AVX-512F has no andnot for floats */
+__attribute__((target("avx512f")))
+static inline __m512 wg_mm512_andnot_ps(__m512 a, __m512 b) {
+    return _mm512_castsi512_ps(_mm512_andnot_si512(_mm512_castps_si512(a),
+                                                   _mm512_castps_si512(b)));
+}
+
+__attribute__((target("avx2")))
+DTW_WIDE(8, 8, __m256, _mm256, _mm256_set1_ps, _mm256_andnot_ps)
+
+__attribute__((target("avx512f")))
+DTW_WIDE(16, 16, __m512, _mm512, _mm512_set1_ps, wg_mm512_andnot_ps)
+
+#endif /* WG_WIDE_KERNELS */
+
+static bool char_dist_less(const CharDist &a, const CharDist &b) {
+    if (a.dist != b.dist) return a.dist < b.dist;
+    return a.unicode < b.unicode;
+}
+
+/* The n best distances found so far are kept in a max-heap.
+   A template can be abandoned as soon as it is known to be worse
+   than the worst of them. */
+
+static inline float best_bound(Scratch *scratch) {
+    if (scratch->max_best == 0 || scratch->n_best < scratch->max_best)
+        return FLT_MAX;
+    return scratch->best[0];
+}
+
+static inline void best_add(Scratch *scratch, float dist) {
+    float *best = scratch->best;
+    unsigned int i, child;
+
+    if (scratch->n_best < scratch->max_best) {
+        /* sift up */
+        i = scratch->n_best++;
+        while (i > 0 && best[(i - 1) / 2] < dist) {
+            best[i] = best[(i - 1) / 2];
+            i = (i - 1) / 2;
+        }
+        best[i] = dist;
+    }
+    else if (scratch->max_best > 0 && dist < best[0]) {
+        /* replace the root and sift down */
+        i = 0;
+        while ((child = 2 * i + 1) < scratch->n_best) {
+            if (child + 1 < scratch->n_best && best[child + 1] > best[child])
+                child++;
+            if (best[child] <= dist)
+                break;
+            best[i] = best[child];
+            i = child;
+        }
+        best[i] = dist;
+    }
 }
 
 
@@ -477,22 +1359,158 @@ static void assert_aligned16(char *p) {
 }
 #endif
 
-Results *Recognizer::recognize(Character *ch, unsigned int n_results) {
-
-    unsigned int group_id, i, size, n_chars, char_id, n_group_chars;
-    unsigned int n_vectors, n_strokes;
-    float *cursor = strokedata;
-    float *input;
-
-    n_vectors = ch->get_n_vectors();
-    n_strokes = ch->get_n_strokes();
-    input = ch->get_points();
+void Recognizer::compare_templates(Scratch *scratch,
+                                   float *input,
+                                   unsigned int n_vectors,
+                                   TemplateRange *range,
+                                   CharDist *distm) {
+    /*
+    Compare the input with the templates of a range, which must belong
+    to the same group, and store the distances in distm.
+    */
+    unsigned int i = range->first, last = range->last;
 
     #if 0
     assert_aligned16((char *) input);
     #endif
 
-    for (group_id=0, n_chars=0, char_id=0; group_id < n_groups; group_id++) {
+#ifdef WG_WIDE_KERNELS
+    unsigned int b = 0, k, lengths[16];
+    float res[16];
+    PackedGroup *pg = NULL;
+
+    /* Process 8 or 16 reference characters at a time, see pack_group().
+       Ranges start on a block boundary since RANGE_SIZE is a multiple of
+       the block width. */
+    if (packed_width > 0) {
+        pg = get_packed_group(range->group_id, range->group_first);
+        b = (i - range->group_first) / packed_width;
+    }
+
+    for (; pg && b < pg->n_blocks && i + packed_width <= last;
+         b++, i += packed_width) {
+        for (k=0; k < packed_width; k++)
+            lengths[k] = characters[i+k].n_vectors;
+
+        if (packed_width == 16)
+            dtw16(scratch, input, n_vectors, pg->blocks + b, lengths,
+                  dimension, best_bound(scratch), res);
+        else
+            dtw8(scratch, input, n_vectors, pg->blocks + b, lengths,
+                 dimension, best_bound(scratch), res);
+
+        for (k=0; k < packed_width; k++) {
+            distm->unicode = characters[i+k].unicode;
+            distm->dist = res[k];
+            best_add(scratch, distm->dist);
+            distm++;
+        }
+    }
+#endif
+
+#ifdef __SSE__
+    wg_v4sf dtwres4;
+
+    /* Process 4 reference characters at a time */
+    for (; kernel >= KERNEL_SSE && i + 4 <= last; i += 4) {
+        dtwres4 = dtw4(scratch, input, n_vectors, 
+                       templates[i], characters[i].n_vectors,
+                       templates[i+1], characters[i+1].n_vectors,
+                       templates[i+2], characters[i+2].n_vectors,
+                       templates[i+3], characters[i+3].n_vectors,
+                       best_bound(scratch));
+
+        for (unsigned int k=0; k < 4; k++) {
+            distm->unicode = characters[i+k].unicode;
+            distm->dist = dtwres4.s[k];
+            best_add(scratch, distm->dist);
+            distm++;
+        }
+    }
+
+    /* Process the remaining of references */
+#endif
+
+    for (; i < last; i++) {
+        distm->unicode = characters[i].unicode;
+        distm->dist = dtw(scratch, input, n_vectors, 
+                          templates[i], characters[i].n_vectors,
+                          best_bound(scratch));
+        best_add(scratch, distm->dist);
+        distm++;
+    }
+}
+
+void Recognizer::unref_scan_job(ScanJob *job) {
+    if (g_atomic_int_dec_and_test(&job->ref_count)) {
+        g_mutex_clear(&job->mutex);
+        g_cond_clear(&job->cond);
+        free(job);
+    }
+}
+
+void Recognizer::scan_worker(gpointer data, gpointer user_data) {
+    ScanJob *job = (ScanJob *) data;
+    Recognizer *self = job->recognizer;
+    Scratch *scratch;
+    unsigned int i;
+    TemplateRange *range;
+    bool started;
+
+    /* the job may be over if the pool was busy with other recognitions */
+    g_mutex_lock(&job->mutex);
+    started = !job->finished;
+    if (started) job->n_active++;
+    g_mutex_unlock(&job->mutex);
+
+    if (started) {
+        scratch = self->new_scratch(job->n_results, false);
+
+        /* take the next range of templates until there is none left */
+        while ((i = (unsigned int) g_atomic_int_add(&job->next, 1)) <
+               job->n_ranges) {
+            range = &job->ranges[i];
+            self->compare_templates(scratch, job->input, job->n_vectors,
+                                    range, job->distm + range->offset);
+        }
+
+        self->free_scratch(scratch);
+
+        g_mutex_lock(&job->mutex);
+        job->n_active--;
+        g_cond_signal(&job->cond);
+        g_mutex_unlock(&job->mutex);
+    }
+
+    unref_scan_job(job);
+}
+
+unsigned int Recognizer::compute_distances(Scratch *scratch,
+                                           float *input,
+                                           unsigned int n_vectors,
+                                           unsigned int n_strokes,
+                                           unsigned int n_results) {
+    /*
+    Compare the input with the templates and store the distances in
+    scratch->distm. Return the number of templates compared.
+
+    Templates are split in ranges of at most RANGE_SIZE templates, which
+    are spread across n_threads threads: the calling thread and threads
+    of the worker pool. The distance of a template is stored at the same
+    place whatever the number of threads.
+
+    Only the n_results best distances are exact: templates known to be
+    worse may be given a distance of FLT_MAX.
+    */
+    unsigned int group_id, i, n_chars, char_id, first, n_ranges, n_workers;
+    TemplateRange *ranges;
+    ScanJob *job;
+
+    ranges = (TemplateRange *) malloc((n_characters / RANGE_SIZE + n_groups) *
+                                      sizeof(TemplateRange));
+
+    for (group_id=0, n_chars=0, char_id=0, n_ranges=0; group_id < n_groups;
+         group_id++) {
         /* Only compare the input with templates which have
            +- window_size the same number of strokes as the input */
         if (n_strokes > window_size) {
@@ -505,80 +1523,196 @@ Results *Recognizer::recognize(Character *ch, unsigned int n_results) {
             }
         }
 
-        cursor = (float *) (data + groups[group_id].offset);
-
-#ifdef __SSE__
-        float *ref1, *ref2, *ref3, *ref4;
-        unsigned int size1, size2, size3, size4;
-        wg_v4sf dtwres4;
-
-        /* Process 4 reference characters at a time */
-        for (i=0; i < (groups[group_id].n_chars / 4); i++) {
-            distm[n_chars].unicode = characters[char_id].unicode;
-            ref1 = cursor;
-            size1 = characters[char_id].n_vectors;
-            ref2 = ref1 + characters[char_id].n_vectors * VEC_DIM_MAX;
-            char_id++;
-
-            distm[n_chars+1].unicode = characters[char_id].unicode;
-            size2 = characters[char_id].n_vectors;
-            ref3 = ref2 + characters[char_id].n_vectors * VEC_DIM_MAX;
-            char_id++;
-
-            distm[n_chars+2].unicode = characters[char_id].unicode;
-            size3 = characters[char_id].n_vectors;
-            ref4 = ref3 + characters[char_id].n_vectors * VEC_DIM_MAX;
-            char_id++;
-
-            distm[n_chars+3].unicode = characters[char_id].unicode;            
-            size4 = characters[char_id].n_vectors;
-            cursor = ref4 + characters[char_id].n_vectors *
-                     VEC_DIM_MAX;
-            char_id++;
-
-            dtwres4 = dtw4(input, n_vectors, 
-                           ref1, size1, 
-                           ref2, size2, 
-                           ref3, size3, 
-                           ref4, size4);
-
-            distm[n_chars++].dist = dtwres4.s[0];
-            distm[n_chars++].dist = dtwres4.s[1];
-            distm[n_chars++].dist = dtwres4.s[2];
-            distm[n_chars++].dist = dtwres4.s[3];
+        for (first=0; first < groups[group_id].n_chars; first += RANGE_SIZE) {
+            ranges[n_ranges].first = char_id + first;
+            ranges[n_ranges].last = char_id + MIN(first + RANGE_SIZE,
+                                                  groups[group_id].n_chars);
+            ranges[n_ranges].offset = n_chars + first;
+            ranges[n_ranges].group_id = group_id;
+            ranges[n_ranges].group_first = char_id;
+            n_ranges++;
         }
 
-        /* Process the remaining of references */
-        n_group_chars = (groups[group_id].n_chars % 4);
-#else
-        /* SSE not available, we need to process references sequentially */
-        n_group_chars = groups[group_id].n_chars;
-#endif
+        char_id += groups[group_id].n_chars;
+        n_chars += groups[group_id].n_chars;
+    }
 
-        for (i=0; i < n_group_chars; i++) {
-            distm[n_chars].unicode = characters[char_id].unicode;
-            distm[n_chars].dist = dtw(input, n_vectors, 
-                                      cursor, characters[char_id].n_vectors);
-            cursor += characters[char_id].n_vectors * VEC_DIM_MAX;
-            char_id++;
-            n_chars++;
-        }
+    /* the calling thread is one of the n_threads threads */
+    n_workers = MIN(n_threads, n_ranges);
+    n_workers = n_workers > 0 ? n_workers - 1 : 0;
+
+    /* the job is freed by the last of the calling thread and the workers
+       to be done with it */
+    job = (ScanJob *) malloc(sizeof(ScanJob));
+    job->recognizer = this;
+    job->input = input;
+    job->n_vectors = n_vectors;
+    job->ranges = ranges;
+    job->n_ranges = n_ranges;
+    job->next = 0;
+    job->distm = scratch->distm;
+    job->n_results = n_results;
+    g_mutex_init(&job->mutex);
+    g_cond_init(&job->cond);
+    job->n_active = 0;
+    job->finished = false;
+    job->ref_count = n_workers + 1;
+
+    scratch->n_best = 0;
+
+    for (i=0; i < n_workers; i++)
+        g_thread_pool_push(workers, job, NULL);
+
+    while ((i = (unsigned int) g_atomic_int_add(&job->next, 1)) < n_ranges)
+        compare_templates(scratch, input, n_vectors, &ranges[i],
+                          job->distm + ranges[i].offset);
+
+    /* wait for the workers which took a range, the others will find
+       the job finished */
+    g_mutex_lock(&job->mutex);
+    job->finished = true;
+    while (job->n_active > 0)
+        g_cond_wait(&job->cond, &job->mutex);
+    g_mutex_unlock(&job->mutex);
+
+    unref_scan_job(job);
+    free(ranges);
+
+    return n_chars;
+}
 
-    }
+unsigned int Recognizer::select_best(CharDist *distm,
+                                     unsigned int n_chars,
+                                     unsigned int n_results) {
+    /*
+    Move the n_results best templates, sorted, to the start of distm.
+    Return their number.
+    */
+    unsigned int size = MIN(n_chars, n_results);
+
+    std::partial_sort(distm, distm + size, distm + n_chars, char_dist_less);
+
+    return size;
+}
+
+Results *Recognizer::recognize(Character *ch, unsigned int n_results) {
+    unsigned int i, size, n_chars;
+
+    g_rw_lock_reader_lock(&lock);
+
+    n_results = MIN(n_results, n_characters);
 
-    /* sort the results with glibc's quicksort */
-    qsort ((void *) distm, 
-           (size_t) n_chars, 
-           sizeof (CharDist), 
-           (int (*) (const void *, const void*)) char_dist_cmp);
+    Scratch *scratch = new_scratch(n_results);
+    CharDist *distm = scratch->distm;
 
-    size = MIN(n_chars, n_results);
+    n_chars = compute_distances(scratch,
+                                ch->get_points(),
+                                ch->get_n_vectors(),
+                                ch->get_n_strokes(),
+                                n_results);
+
+    size = select_best(distm, n_chars, n_results);
 
     Results *results = new Results(size);
 
     for(i=0; i < size; i++)
         results->add(i, distm[i].unicode, distm[i].dist);
 
+    free_scratch(scratch);
+
+    g_rw_lock_reader_unlock(&lock);
+
+    return results;
+}
+
+Results *Recognizer::recognize_batch(float *buffer, unsigned int buffer_size,
+                                     unsigned int *sizes,
+                                     unsigned int sizes_size,
+                                     unsigned int n_results) {
+    /*
+    Recognize several characters at once.
+
+    buffer: the feature vectors of all the characters, one after the other
+    buffer_size: number of floats in buffer
+    sizes: (n_vectors, n_strokes) of each character
+    sizes_size: number of unsigned ints in sizes
+
+    The results of the k-th character are stored from index k * n, where
+    n is n_results or the number of templates if it is smaller (n is the
+    size of the results divided by the number of characters). If fewer
+    than n templates were compared, the remaining entries have a unicode
+    value of 0.
+    */
+    unsigned int i, k, size, n_chars, n_inputs, n_floats;
+    float *points, *input;
+
+    if (sizes_size % 2 != 0) {
+        error_msg = (char *) "Invalid size information";
+        return NULL;
+    }
+
+    n_inputs = sizes_size / 2;
+
+    for (k=0, n_floats=0; k < n_inputs; k++) {
+        if (sizes[k * 2] > (buffer_size - n_floats) / VEC_DIM_MAX)
+            break;
+        n_floats += sizes[k * 2] * VEC_DIM_MAX;
+    }
+
+    if (k < n_inputs || n_floats != buffer_size) {
+        error_msg = (char *) "Buffer size doesn't match character sizes";
+        return NULL;
+    }
+
+    /* the buffer may not be aligned as required by SSE instructions */
+    if (buffer_size > 0) {
+#ifdef HAVE_POSIX_MEMALIGN
+        posix_memalign((void**)&points, 16, buffer_size * sizeof(float));
+#else
+        points = (float *) memalign(16, buffer_size * sizeof(float));
+#endif
+        memcpy(points, buffer, buffer_size * sizeof(float));
+    }
+    else
+        points = NULL;
+
+    g_rw_lock_reader_lock(&lock);
+
+    n_results = MIN(n_results, n_characters);
+
+    if (n_inputs > 0 && n_results > UINT_MAX / n_inputs) {
+        g_rw_lock_reader_unlock(&lock);
+        if (points) free(points);
+        error_msg = (char *) "Too many results";
+        return NULL;
+    }
+
+    Scratch *scratch = new_scratch(n_results);
+    CharDist *distm = scratch->distm;
+    Results *results = new Results(n_inputs * n_results);
+
+    for (k=0, input=points; k < n_inputs; k++) {
+        n_chars = compute_distances(scratch, input,
+                                    sizes[k * 2], sizes[k * 2 + 1],
+                                    n_results);
+        input += sizes[k * 2] * VEC_DIM_MAX;
+
+        size = select_best(distm, n_chars, n_results);
+
+        for (i=0; i < n_results; i++) {
+            if (i < size)
+                results->add(k * n_results + i, distm[i].unicode,
+                             distm[i].dist);
+            else
+                results->add(k * n_results + i, 0, FLT_MAX);
+        }
+    }
+
+    if (points) free(points);
+    free_scratch(scratch);
+
+    g_rw_lock_reader_unlock(&lock);
+
     return results;
 }
 
@@ -31,12 +31,25 @@
 #include <xmmintrin.h>
 #endif
 
+/* The AVX2 and AVX-512 kernels are built whatever the compiler flags and
+   are used if the CPU supports them */
+#if defined(__SSE__) && defined(__GNUC__) && \
+    (defined(__x86_64__) || defined(__i386__))
+#define WG_WIDE_KERNELS
+#include <immintrin.h>
+#endif
+
+/* number of floats per vector, including padding */
+#define VEC_DIM_MAX 4
+
 namespace wagomu {
 
 class Character {
 
 public:
     Character(unsigned int n_vectors, unsigned int n_strokes);
+    Character(float *buffer, unsigned int buffer_size,
+              unsigned int n_strokes);
     ~Character();
 
     float *get_points();
@@ -48,6 +61,8 @@ private:
     float *points;
     unsigned int n_vectors;
     unsigned int n_strokes;
+
+    void allocate(unsigned int n_vectors, unsigned int n_strokes);
 };
 
 class Results {
@@ -88,6 +103,19 @@ typedef struct {
     char pad[4];
 } CharacterGroup;
 
+/* see Recognizer::pack_group() */
+typedef struct {
+    float *points;
+    unsigned int n_vectors; /* of the longest template */
+} PackedBlock;
+
+/* the blocks of a group, built the first time they are needed */
+typedef struct {
+    PackedBlock *blocks;
+    unsigned int n_blocks;
+    volatile gint ready;
+} PackedGroup;
+
 #ifdef __SSE__
 typedef union {
     __m128 v;
@@ -95,8 +123,54 @@ typedef union {
 } wg_v4sf;
 #endif
 
+/* Memory needed by one recognition. It is allocated for each call so
+   that several threads can use the same Recognizer at the same time. */
+typedef struct {
+#ifdef __SSE__
+    wg_v4sf *dtw1v;
+    wg_v4sf *dtw2v;
+#endif
+    float *dtw1;
+    float *dtw2;
+    CharDist *distm;
+    float *best; /* max-heap of the best distances */
+    unsigned int n_best;
+    unsigned int max_best;
+} Scratch;
+
+typedef struct {
+    unsigned int first; /* first template */
+    unsigned int last; /* last template + 1 */
+    unsigned int offset; /* where to store the distances */
+    unsigned int group_id;
+    unsigned int group_first; /* first template of the group */
+} TemplateRange;
+
+class Recognizer;
+
+/* Shared by the threads of a recognition */
+typedef struct {
+    Recognizer *recognizer;
+    float *input;
+    unsigned int n_vectors;
+    TemplateRange *ranges;
+    unsigned int n_ranges;
+    volatile gint next; /* next range to process */
+    CharDist *distm;
+    unsigned int n_results;
+    /* workers still comparing templates, see compute_distances() */
+    GMutex mutex;
+    GCond cond;
+    unsigned int n_active;
+    bool finished;
+    volatile gint ref_count;
+} ScanJob;
+
 #endif /* SWIG */
 
+/* Once a model is opened, recognize() and recognize_batch() may be called
+   concurrently from several threads. Templates may be added or removed
+   at any time: such changes wait for running recognitions to finish. */
 class Recognizer {
 
 public:
@@ -105,15 +179,29 @@ public:
 
     bool open(char *path);
     Results *recognize(Character *ch, unsigned int n_results);
+    Results *recognize_batch(float *buffer, unsigned int buffer_size,
+                             unsigned int *sizes, unsigned int sizes_size,
+                             unsigned int n_results);
+    bool add_template(unsigned int unicode, unsigned int n_strokes,
+                      float *buffer, unsigned int buffer_size);
+    unsigned int remove_templates(unsigned int unicode);
     unsigned int get_n_characters();
     unsigned int get_dimension();
     unsigned int get_window_size();
     void set_window_size(unsigned int size);
+    unsigned int get_n_threads();
+    void set_n_threads(unsigned int n);
+    char *get_kernel();
+    bool set_kernel(char *name);
     char *get_error_message();
 
 private:
     GMappedFile *file;
     char *data;
+    gsize data_size;
+
+    /* protects the template tables below */
+    GRWLock lock;
 
     unsigned int n_characters;
     unsigned int n_groups;
@@ -123,29 +211,77 @@ private:
     unsigned int dimension;
     unsigned int downsample_threshold;
 
+    /* Template tables are copied from the model so that templates can be
+       added and removed. The points of added templates are allocated
+       separately, those of the model stay in the mapped file. */
     CharacterInfo *characters;
     CharacterGroup *groups;
     float *strokedata;
+    float **templates;
+    unsigned int capacity; /* number of templates allocated */
 
-#ifdef __SSE__
-    wg_v4sf *dtw1v;
-    wg_v4sf *dtw2v;
-#endif
+    /* blocks of templates for the AVX2 and AVX-512 kernels, one entry
+       per group */
+    PackedGroup *packed;
+    unsigned int packed_width; /* number of templates per block */
+    /* serializes the packing of groups during recognitions */
+    GMutex pack_lock;
 
-    float *dtw1;
-    float *dtw2;
+    unsigned int max_n_vectors;
 
     char *error_msg;
 
-    CharDist *distm;
-
     unsigned int window_size;
+    unsigned int n_threads;
+    /* n_threads - 1 threads kept between recognitions (NULL if none) */
+    GThreadPool *workers;
+    unsigned int kernel; /* DTW implementation */
 
     unsigned int get_max_n_vectors();
 
+    void free_template(float *points);
+    void free_model();
+
+    PackedGroup *get_packed_group(unsigned int group_id,
+                                  unsigned int first);
+    void pack_group(PackedGroup *pg, unsigned int group_id,
+                    unsigned int first);
+    void unpack_group(PackedGroup *pg);
+    void init_packed();
+    void free_packed();
+
+    bool load_v1();
+    bool load_v2();
+    bool load_templates(guint64 start, guint64 end, unsigned int align,
+                        bool swap);
+
+    Scratch *new_scratch(unsigned int n_results, bool with_distances=true);
+    void free_scratch(Scratch *scratch);
+
+    static void scan_worker(gpointer data, gpointer user_data);
+    static void unref_scan_job(ScanJob *job);
+
+    void compare_templates(Scratch *scratch,
+                           float *input,
+                           unsigned int n_vectors,
+                           TemplateRange *range,
+                           CharDist *distm);
+
+    unsigned int compute_distances(Scratch *scratch,
+                                   float *input,
+                                   unsigned int n_vectors,
+                                   unsigned int n_strokes,
+                                   unsigned int n_results);
+
+    unsigned int select_best(CharDist *distm,
+                             unsigned int n_chars,
+                             unsigned int n_results);
+
     inline float local_distance(float *v1, float *v2);
 
-    inline float dtw(float *s, unsigned int n, float *t, unsigned int m);
+    inline float dtw(Scratch *scratch,
+                     float *s, unsigned int n, float *t, unsigned int m,
+                     float bound);
 
 #ifdef __SSE__
     inline wg_v4sf local_distance4(float *s,
@@ -154,11 +290,13 @@ private:
                                    float *t2,
                                    float *t3);
 
-    inline wg_v4sf dtw4(float *s, unsigned int n, 
+    inline wg_v4sf dtw4(Scratch *scratch,
+                        float *s, unsigned int n, 
                         float *t0, unsigned int m0,
                         float *t1, unsigned int m1,
                         float *t2, unsigned int m2,
-                        float *t3, unsigned int m3);
+                        float *t3, unsigned int m3,
+                        float bound);
 #endif
 
 };
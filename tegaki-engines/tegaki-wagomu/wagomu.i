@@ -3,6 +3,84 @@
 #include "wagomu.h"
 %}
 
+/* Any C-contiguous buffer (array, numpy array, ...) of items of the
+   right type can be passed where a (buffer, buffer_size) pair of
+   arguments is expected: array("f") for floats and array("I") for
+   unsigned ints. buffer_size is the number of elements in the buffer. */
+%{
+static int buffer_has_format(Py_buffer *view, char format,
+                             Py_ssize_t itemsize) {
+    const char *f = view->format ? view->format : "B";
+
+    /* native byte order only */
+#if G_BYTE_ORDER == G_LITTLE_ENDIAN
+    if (*f == '@' || *f == '=' || *f == '<') f++;
+#else
+    if (*f == '@' || *f == '=' || *f == '>' || *f == '!') f++;
+#endif
+
+    return f[0] == format && f[1] == '\0' && view->itemsize == itemsize;
+}
+%}
+
+%define BUFFER_TYPEMAP(TYPE, FORMAT)
+%typemap(in) (TYPE *buffer, unsigned int buffer_size) (Py_buffer view = {0}) {
+    if (PyObject_GetBuffer($input, &view,
+                           PyBUF_FORMAT | PyBUF_C_CONTIGUOUS) != 0)
+        SWIG_fail;
+    if (!buffer_has_format(&view, FORMAT, sizeof(TYPE))) {
+        PyErr_Format(PyExc_TypeError,
+                     "expected a buffer of '%c' items of %d bytes",
+                     FORMAT, (int) sizeof(TYPE));
+        SWIG_fail;
+    }
+    $1 = (TYPE *) view.buf;
+    $2 = (unsigned int) (view.len / sizeof(TYPE));
+}
+%typemap(typecheck, precedence=SWIG_TYPECHECK_POINTER)
+    (TYPE *buffer, unsigned int buffer_size) {
+    $1 = PyObject_CheckBuffer($input) ? 1 : 0;
+}
+%typemap(freearg) (TYPE *buffer, unsigned int buffer_size) {
+    if (view$argnum.obj) PyBuffer_Release(&view$argnum);
+}
+%enddef
+
+BUFFER_TYPEMAP(float, 'f')
+BUFFER_TYPEMAP(unsigned int, 'I')
+
+/* Feature vectors are made of VEC_DIM_MAX floats. */
+%typemap(check) (float *buffer, unsigned int buffer_size) {
+    if ($2 % VEC_DIM_MAX != 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "buffer size is not a multiple of VEC_DIM_MAX");
+        SWIG_fail;
+    }
+}
+
+%apply (unsigned int *buffer, unsigned int buffer_size) {
+    (unsigned int *sizes, unsigned int sizes_size)
+}
+
+/* Recognition doesn't use any Python object and may take a while:
+   let other Python threads run, possibly with the same Recognizer. */
+%define RELEASE_GIL(FUNCTION)
+%exception FUNCTION {
+    Py_BEGIN_ALLOW_THREADS
+    $action
+    Py_END_ALLOW_THREADS
+}
+%enddef
+
+RELEASE_GIL(wagomu::Recognizer::recognize)
+RELEASE_GIL(wagomu::Recognizer::recognize_batch)
+/* may wait for recognitions running in other threads */
+RELEASE_GIL(wagomu::Recognizer::add_template)
+RELEASE_GIL(wagomu::Recognizer::remove_templates)
+RELEASE_GIL(wagomu::Recognizer::set_kernel)
+RELEASE_GIL(wagomu::Recognizer::set_n_threads)
+
 %newobject recognize;
+%newobject recognize_batch;
 
-%include "wagomu.h"
\ No newline at end of file
+%include "wagomu.h"
@@ -20,6 +20,11 @@
 # - Mathieu Blondel
 
 import os
+import sys
+import time
+import threading
+import traceback
+from collections import OrderedDict, deque
 from configparser import SafeConfigParser, NoSectionError, NoOptionError
 
 import gtk
@@ -47,6 +52,7 @@ class RecognizerWidgetBase(gtk.HBox):
 
         self._recognizer = None
         self._search_on_stroke = True
+        self._worker = RecognizerWorker()
 
         self._create_ui()
         self.clear_canvas()
@@ -225,6 +231,8 @@ class RecognizerWidgetBase(gtk.HBox):
             r_name, model_name, meta = Recognizer.get_all_available_models()[i]
 
             klass = Recognizer.get_available_recognizers()[r_name]
+            # results of the previous model are not wanted anymore
+            self._worker.cancel()
             self._recognizer = klass()
             self._recognizer.set_model(meta["name"])
             self._models_button.set_label(meta["shortname"])
@@ -238,6 +246,14 @@ class RecognizerWidgetBase(gtk.HBox):
     def get_toolbar_vbox(self):
         return self._toolbar
 
+    def get_recognition_stats(self):
+        """
+        Return statistics about recognitions done in the background.
+
+        @rtype: dict
+        """
+        return self._worker.get_stats()
+
 class SimpleRecognizerWidget(RecognizerWidgetBase):
 
     def __init__(self):
@@ -287,6 +303,7 @@ class SimpleRecognizerWidget(RecognizerWidgetBase):
         self.emit("commit-string", chars[selected])
 
     def clear_canvas(self):
+        self._worker.cancel()
         self._canvas.clear()
         self.clear_characters()
 
@@ -318,9 +335,14 @@ class SimpleRecognizerWidget(RecognizerWidgetBase):
         writing = self._canvas.get_writing().copy()
 
         if writing.get_n_strokes() > 0:
-            candidates = self._recognizer.recognize(writing, n=9)
-            candidates = [char for char, prob in candidates]
-            self._chartable.set_characters(candidates)
+            self._worker.recognize("_canvas", self._recognizer, writing, 9,
+                                   self._on_results)
+        else:
+            self._worker.cancel("_canvas")
+
+    def _on_results(self, candidates):
+        candidates = [char for char, prob in candidates]
+        self._chartable.set_characters(candidates)
 
     def get_writing(self):
         self._canvas.get_writing()
@@ -391,9 +413,15 @@ class SmartRecognizerWidget(RecognizerWidgetBase):
             return
 
         writing = writing.copy()
-        candidates = self._recognizer.recognize(writing)
-        candidates = [char for char, prob in candidates]     
-        
+        # canvases are reused for successive characters: the generation
+        # tells requests for the new character from those for the old one
+        key = (canvas, self._generations[canvas])
+        self._worker.recognize(key, self._recognizer, writing, 10,
+                               self._on_results, canvas, writing)
+
+    def _on_results(self, candidates, canvas, writing):
+        candidates = [char for char, prob in candidates]
+
         if candidates:
             candidate_list = CandidateList(candidates)
 
@@ -431,6 +459,7 @@ class SmartRecognizerWidget(RecognizerWidgetBase):
 
         if self._focused_canvas == othr_canv:
             getattr(self, curr_canv).clear()
+            self._generations[curr_canv] += 1
 
             if getattr(self, othr_canv).get_writing().get_n_strokes() > 0 and \
                self._last_completed_canvas != othr_canv and \
@@ -513,6 +542,8 @@ class SmartRecognizerWidget(RecognizerWidgetBase):
         self._chartable.unselect()
 
     def clear_canvas(self):
+        self._worker.cancel()
+        self._generations = {"_canvas1" : 0, "_canvas2" : 0}
         self._canvas1.clear()
             
         if self._canvas2:
@@ -718,6 +749,128 @@ class CandidateList(list):
         except ValueError:
             pass
 
+class RecognizerWorker(object):
+    """
+    Recognize writings in a background thread.
+
+    Results are passed to callbacks in the main loop so that recognition
+    doesn't block the canvas. Requests are identified by a key (e.g. the
+    canvas): a request which hasn't started yet is replaced by newer ones
+    with the same key, and the results of a request are discarded if a
+    newer one with the same key was made in the meantime.
+    """
+
+    #: number of latencies kept for statistics
+    MAX_LATENCIES = 1000
+
+    def __init__(self):
+        gobject.threads_init()
+
+        self._cond = threading.Condition()
+        self._pending = OrderedDict() # key => request, shared with the thread
+        self._latest = {} # key => id of the latest request, main loop only
+        self._last_id = 0
+        self._thread = None
+
+        self._n_requests = 0
+        self._n_dropped = 0
+        self._latencies = deque(maxlen=self.MAX_LATENCIES)
+
+    def recognize(self, key, recognizer, writing, n, callback, *args):
+        """
+        Request a recognition.
+
+        callback(results, *args) is called in the main loop, unless the
+        request is superseded or cancelled.
+        """
+        self._last_id += 1
+        self._latest[key] = self._last_id
+        self._n_requests += 1
+
+        request = (self._last_id, time.time(), recognizer, writing, n,
+                   callback, args)
+
+        with self._cond:
+            if key in self._pending:
+                self._n_dropped += 1
+            self._pending[key] = request
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._cond.notify()
+
+    def cancel(self, key=None):
+        """
+        Cancel the requests with the given key (all requests if None).
+        """
+        if key is None:
+            self._latest.clear()
+        elif key in self._latest:
+            del self._latest[key]
+
+        with self._cond:
+            if key is None:
+                self._pending.clear()
+            elif key in self._pending:
+                del self._pending[key]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key, request = self._pending.popitem(last=False)
+
+            req_id, start, recognizer, writing, n, callback, args = request
+
+            try:
+                results = recognizer.recognize(writing, n)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                continue
+
+            gobject.idle_add(self._deliver, key, req_id, start, results,
+                             callback, args)
+
+    def _deliver(self, key, req_id, start, results, callback, args):
+        if self._latest.get(key) != req_id:
+            # superseded or cancelled while being recognized
+            self._n_dropped += 1
+            return False
+
+        del self._latest[key]
+        self._latencies.append(time.time() - start)
+        callback(results, *args)
+
+        return False # don't call again
+
+    def get_stats(self):
+        """
+        Return the number of requests, the number of requests dropped
+        because they were superseded or cancelled and latency statistics
+        (in ms, from the request to the delivery of results) for recent
+        requests.
+
+        @rtype: dict
+        """
+        latencies = sorted(self._latencies)
+        stats = {"requests": self._n_requests,
+                 "dropped": self._n_dropped,
+                 "delivered": len(latencies)}
+
+        if latencies:
+            stats["mean"] = sum(latencies) / len(latencies) * 1000
+            for p in (50, 90):
+                stats["p%d" % p] = \
+                    latencies[int(round(p / 100.0 * (len(latencies) - 1)))] \
+                    * 1000
+            stats["max"] = latencies[-1] * 1000
+
+        return stats
+
 class ErrorDialog(gtk.MessageDialog):
 
     def __init__(self, parent, msg):
@@ -5,4 +5,6 @@ import tegaki.character
 import tegaki.charcol
 import tegaki.recognizer
 import tegaki.trainer
-import tegaki.arrayutils
\ No newline at end of file
+import tegaki.arrayutils
+import tegaki.compact
+import tegaki.preprocessing
\ No newline at end of file
@@ -455,8 +455,8 @@ class Stroke(list):
                 sinalpha = sin(alpha)
 
             d = euclidean_distance([x1, y1], [x2, y2])
-            signx = cmp(dx, 0)
-            signy = cmp(dy, 0)
+            signx = (dx > 0) - (dx < 0)
+            signy = (dy > 0) - (dy < 0)
 
             n = func(d)
 
@@ -1025,9 +1025,9 @@ class _IOBase(object):
         Other parameters are identical to L{read}.
         """
         if gzip:
-            io = io.StringIO(string)
-            io = gzipm.GzipFile(fileobj=io, compresslevel=compresslevel)
-            string = io.read()
+            buf = io.BytesIO(string)
+            buf = gzipm.GzipFile(fileobj=buf, compresslevel=compresslevel)
+            string = buf.read()
         elif bz2:
             try:
                 string = bz2m.decompress(string)
@@ -1083,12 +1083,12 @@ class _IOBase(object):
             except NameError:
                 raise NotImplementedError
         elif gzip:
-            io = io.StringIO()
-            f = gzipm.GzipFile(fileobj=io, mode="w",
+            buf = io.BytesIO()
+            f = gzipm.GzipFile(fileobj=buf, mode="w",
                                compresslevel=compresslevel)
-            f.write(self.to_str())
+            f.write(self.to_str().encode("utf-8"))
             f.close()
-            return io.getvalue()
+            return buf.getvalue()
         else:
             return self.to_str()
 
@@ -1325,7 +1325,7 @@ class Character(_XmlBase):
         """
         Return a sha1 digest for that character.
         """
-        return hashlib.sha1(self.to_xml()).hexdigest()
+        return hashlib.sha1(self.to_xml().encode("utf-8")).hexdigest()
 
     def to_str(self):
         return self.to_xml()
@@ -22,12 +22,26 @@
 import sqlite3
 import base64
 import tempfile
+import struct
+import hashlib
+import sys
 import re
 import os
+import multiprocessing
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+from array import array
 
 from tegaki.dictutils import SortedDict
 from tegaki.character import _XmlBase, Point, Stroke, Writing, Character
 
+#: Version of the .chardb schema written by this module.
+#:  - 0: characters.data contains base64-encoded gzip-compressed XML
+#:  - 1: characters.data contains packed little-endian stroke arrays
+SCHEMA_VERSION = 1
+
 def _dict_factory(cursor, row):
     d = {}
     for idx, col in enumerate(cursor.description):
@@ -63,11 +77,16 @@ class ObjectProxy(object):
         if attr_ in self.WRITE_METHODS:
             write = True
         elif not attr_ in self.READ_METHODS:
+            if callable(attr):
+                # methods don't change: next calls won't go through
+                # __getattr__
+                self.__dict__[attr_] = attr
             return attr
         def wrapper(*args, **kw):
             if write: self._charpool.add_char(self._charobj)
             return _apply_proxy(self._charpool, attr(*args, **kw),
 self._charobj)
+        self.__dict__[attr_] = wrapper
         return wrapper
 
 
@@ -163,41 +182,257 @@ class _CharPool(dict):
     be updated.
     """
 
-    def __init__(self, cursor):
+    def __init__(self, cursor, version=0):
         self._c = cursor
+        self._version = version
+
+    def set_version(self, version):
+        self._version = version
 
     def add_char(self, char):
         self[char.charid] = char
 
-    def _update_character(self, char):
-        self._c.execute("""UPDATE characters
+    def update_characters(self, chars):
+        self._c.executemany("""UPDATE characters
 SET utf8=?, n_strokes=?, data=?, sha1=?
-WHERE charid=?""", (char.get_utf8(), char.get_writing().get_n_strokes(),
-                    _adapt_character(char), char.hash(), char.charid))
+WHERE charid=?""", [(char.get_utf8(), char.get_writing().get_n_strokes(),
+                     _adapt_character(char, self._version), char.hash(),
+                     char.charid) for char in chars])
 
     def clear_pool_threshold(self, threshold=100):
         if len(self) > threshold:
             self.clear_pool()
 
     def clear_pool(self):
-        for charid, char in list(self.items()):
-            self._update_character(char)
+        if len(self) == 0:
+            return
+        # the pool is emptied first as updating may trigger other queries
+        chars = list(self.values())
         self.clear()
+        self.update_characters(chars)
+
+# Packed writing format (schema version 1)
+#
+# All fields are little-endian.
+#
+# header        flags (uint8), width (int32), height (int32),
+#               n_strokes (uint32)
+# stroke sizes  n_strokes * uint32, the number of points of each stroke
+# coordinates   n_points * (x, y) as int16, or as int32 if _FLAG_INT32 is set
+# timestamps    n_points * int32, or int64 if _FLAG_INT64 is set,
+#               if _FLAG_TIMESTAMP is set
+# pressure      n_points * float32, or float64 if _FLAG_FLOAT64 is set,
+#               if _FLAG_PRESSURE is set
+# xtilt         same as pressure, if _FLAG_XTILT is set
+# ytilt         same as pressure, if _FLAG_YTILT is set
+#
+# Missing timestamps are stored as the smallest integer of their type and
+# missing float values as NaN, so that points with and without optional
+# attributes can be mixed. Float values are always written as float64 so
+# that characters are read back unchanged.
+
+_HEADER = struct.Struct("<BiiI")
+
+_FLAG_INT32 = 1
+_FLAG_TIMESTAMP = 2
+_FLAG_PRESSURE = 4
+_FLAG_XTILT = 8
+_FLAG_YTILT = 16
+_FLAG_INT64 = 32
+_FLAG_FLOAT64 = 64
+
+_MISSING_INT = {"i" : -2**31, "q" : -2**63}
+_NAN = float("nan")
+
+# name, flag and whether the column holds integers
+_OPTIONAL_COLUMNS = (("timestamp", _FLAG_TIMESTAMP, True),
+                     ("pressure", _FLAG_PRESSURE, False),
+                     ("xtilt", _FLAG_XTILT, False),
+                     ("ytilt", _FLAG_YTILT, False))
+
+def _get_column_typecode(flags, integer):
+    if integer:
+        return "q" if flags & _FLAG_INT64 else "i"
+    else:
+        return "d" if flags & _FLAG_FLOAT64 else "f"
+
+_BIG_ENDIAN = sys.byteorder == "big"
+
+def _array_to_bytes(arr):
+    if _BIG_ENDIAN:
+        arr.byteswap()
+    return arr.tobytes()
+
+def _array_from_bytes(typecode, data, start, n):
+    arr = array(typecode)
+    end = start + n * arr.itemsize
+    arr.frombytes(data[start:end])
+    if _BIG_ENDIAN:
+        arr.byteswap()
+    return arr, end
+
+def _pack_writing(writing):
+    """
+    Convert a L{Writing} to the packed binary format.
+
+    @rtype: bytes
+    """
+    strokes = writing.get_strokes(full=True)
+    points = [p for s in strokes for p in s]
+
+    coords = array("i")
+    for p in points:
+        coords.append(int(p.x))
+        coords.append(int(p.y))
+
+    flags = _FLAG_FLOAT64
+    if len(coords) > 0 and (min(coords) < -32768 or max(coords) > 32767):
+        flags |= _FLAG_INT32
+    else:
+        coords = array("h", coords)
+
+    columns = []
+    for key, flag, integer in _OPTIONAL_COLUMNS:
+        values = [p[key] for p in points]
+        if all(v is None for v in values):
+            continue
+        flags |= flag
+        if integer:
+            values = [None if v is None else int(v) for v in values]
+            ints = [v for v in values if v is not None]
+            if min(ints) <= _MISSING_INT["i"] or max(ints) >= 2**31:
+                flags |= _FLAG_INT64
+            typecode = _get_column_typecode(flags, integer)
+            values = [_MISSING_INT[typecode] if v is None else v \
+                          for v in values]
+        else:
+            typecode = _get_column_typecode(flags, integer)
+            values = [_NAN if v is None else float(v) for v in values]
+        columns.append(array(typecode, values))
+
+    sizes = array("I", [len(s) for s in strokes])
+
+    buf = [_HEADER.pack(flags, writing.get_width(), writing.get_height(),
+                        len(strokes)),
+           _array_to_bytes(sizes),
+           _array_to_bytes(coords)]
+    buf += [_array_to_bytes(col) for col in columns]
 
-def _convert_character(data):
+    return b"".join(buf)
+
+def _unpack_writing(data):
+    """
+    Convert packed binary data back to a L{Writing}.
+
+    @type data: bytes
+    @rtype: L{Writing}
+    """
+    flags, width, height, n_strokes = _HEADER.unpack_from(data, 0)
+    offset = _HEADER.size
+
+    sizes, offset = _array_from_bytes("I", data, offset, n_strokes)
+    n_points = sum(sizes)
+
+    typecode = "i" if flags & _FLAG_INT32 else "h"
+    coords, offset = _array_from_bytes(typecode, data, offset, n_points * 2)
+
+    columns = {}
+    for key, flag, integer in _OPTIONAL_COLUMNS:
+        if flags & flag:
+            columns[key], offset = _array_from_bytes(
+                    _get_column_typecode(flags, integer), data, offset,
+                    n_points)
+
+    timestamps = columns.get("timestamp")
+    pressures = columns.get("pressure")
+    xtilts = columns.get("xtilt")
+    ytilts = columns.get("ytilt")
+
+    writing = Writing()
+    writing.set_width(width)
+    writing.set_height(height)
+
+    start = 0
+    for size in sizes:
+        stroke = Stroke()
+        for k in range(start, start + size):
+            point = Point(coords[2*k], coords[2*k+1])
+            if timestamps is not None and \
+               timestamps[k] != _MISSING_INT[timestamps.typecode]:
+                point.timestamp = timestamps[k]
+            if pressures is not None and pressures[k] == pressures[k]:
+                point.pressure = pressures[k]
+            if xtilts is not None and xtilts[k] == xtilts[k]:
+                point.xtilt = xtilts[k]
+            if ytilts is not None and ytilts[k] == ytilts[k]:
+                point.ytilt = ytilts[k]
+            stroke.append_point(point)
+        start += size
+        writing.append_stroke(stroke)
+
+    return writing
+
+def _convert_character(data, version=0, utf8=None):
     # converts a BLOB into an object
     char = Character()
-    char.read_string(base64.b64decode(data), gzip=True)
+    if version == 0:
+        char.read_string(base64.b64decode(data), gzip=True)
+    else:
+        char.set_utf8(utf8)
+        char.set_writing(_unpack_writing(data))
     return char
 
-def _adapt_character(char):
+def _adapt_character(char, version=0):
     # converts an object into a BLOB
-    return base64.b64encode(char.write_string(gzip=True))
+    if version == 0:
+        return base64.b64encode(char.write_string(gzip=True))
+    else:
+        return sqlite3.Binary(_pack_writing(char.get_writing()))
 
 def _gzipbz2(path):
    return (True if path.endswith(".gz") or path.endswith(".gzip") else False,
            True if path.endswith(".bz2") or path.endswith(".bzip2") else False)
 
+def _find_character_files(directory, regexp, recursive=True):
+    # yield the paths of the files matching regexp, walking the tree once
+    for dirpath, dirnames, filenames in os.walk(directory):
+        if recursive:
+            dirnames.sort()
+        else:
+            del dirnames[:]
+        for name in sorted(filenames):
+            full_path = os.path.join(dirpath, name)
+            if regexp.search(full_path):
+                yield full_path
+
+def _read_character_file(args):
+    # return the row of a character file, or None if the file is malformed
+    # (called from the worker processes of import_character_directory)
+    path, version = args
+    char = Character()
+    gzip = False; bz2 = False
+    if path.endswith(".gz"): gzip = True
+    if path.endswith(".bz2"): bz2 = True
+
+    try:
+        char.read(path, gzip=gzip, bz2=bz2)
+    except ValueError:
+        return None # ignore malformed XML files
+
+    return {'utf8':char.get_utf8(),
+            'n_strokes':char.get_writing().get_n_strokes(),
+            'data':bytes(_adapt_character(char, version)),
+            'sha1':char.hash()}
+
+# indexes of the characters table (name, columns)
+# utf8 and n_strokes go together so that metadata queries can be answered
+# from the index alone, without reading the data column
+_INDEXES = (("character_setid_index", "setid"),
+            ("character_utf8_index", "utf8, n_strokes"),
+            ("character_n_strokes_index", "n_strokes"),
+            ("character_sha1_index", "sha1"),
+            ("character_setid_sha1_index", "setid, sha1"))
+
 class CharacterCollection(_XmlBase):
     """
     A collection of L{Characters<Character>}.
@@ -286,6 +521,14 @@ class CharacterCollection(_XmlBase):
     >>> charcol.save()
 
     The .chardb extension is required.
+
+    New .chardb files store handwriting data as packed binary arrays, which
+    are much faster to load than the compressed XML used by older versions.
+    Older .chardb files can still be read and written transparently and can
+    be converted to the new format with L{upgrade}.
+
+    >>> charcol = CharacterCollection("old.chardb")
+    >>> charcol.upgrade()
     """
 
     #: With WRITE_BACK set to True, proxy objects are returned in place of
@@ -294,6 +537,14 @@ class CharacterCollection(_XmlBase):
     #: However, there is probably overhead usigng them.
     WRITE_BACK = True
 
+    #: Number of rows fetched from the db at a time by the generator methods
+    #: (get_characters_gen, get_all_characters_gen, ...).
+    FETCH_SIZE = 500
+
+    #: Number of characters written per transaction when importing
+    #: character files (see import_character_directory).
+    IMPORT_BATCH_SIZE = 10000
+
     def get_auto_commit(self):
         return True if self._con.isolation_level is None else False
 
@@ -327,12 +578,15 @@ class CharacterCollection(_XmlBase):
 <!ATTLIST point ytilt CDATA #IMPLIED>
 """
 
-    def __init__(self, path=":memory:"):
+    def __init__(self, path=":memory:", read_only=False):
         """
         Construct a collection.
 
         @type path: str
         @param path: an XML file or a DB file (see also L{bind})
+
+        @type read_only: bool
+        @param read_only: whether the collection is read-only (see L{bind})
         """
         if path is None:
             path = ":memory:"
@@ -346,15 +600,19 @@ class CharacterCollection(_XmlBase):
 
             self.read(path, gzip=gzip, bz2=bz2)
 
+            if read_only:
+                self._set_read_only()
+
             self._path = path # contains the path to the xml file
         else:
             # this should be either a .chardb, ":memory:" or ""
-            self.bind(path)
+            self.bind(path, read_only)
             self._path = None
 
     # DB utils
 
     def _e(self, req, *a, **kw):
+        # write back modified characters so that queries see them
         self._charpool.clear_pool()
         #print req, a, kw
         return self._c.execute(req, *a, **kw)
@@ -378,6 +636,26 @@ class CharacterCollection(_XmlBase):
         self._e(req, *a, **kw)
         return self._fa()
 
+    def _egen(self, req, *a, **kw):
+        """
+        Execute a query and yield the rows as they are fetched.
+
+        Rows are read FETCH_SIZE at a time from a dedicated cursor so that
+        other queries can be run while iterating.
+        """
+        self._charpool.clear_pool()
+        cursor = self._con.cursor()
+        try:
+            cursor.execute(req, *a, **kw)
+            while True:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
     def _has_tables(self):
         self._e("SELECT count(type) FROM sqlite_master WHERE type = 'table'")
         return self._fo()[0] > 0
@@ -394,18 +672,38 @@ CREATE TABLE characters(
   setid      INTEGER REFERENCES character_sets,
   utf8       TEXT,
   n_strokes  INTEGER,
-  data       BLOB, -- gz xml
+  data       BLOB, -- packed strokes (see _pack_writing)
   sha1       TEXT
 );
-
-CREATE INDEX character_setid_index ON characters(setid);
 """)
+        self._create_indexes()
+        self._set_schema_version(SCHEMA_VERSION)
+
+    def _create_indexes(self):
+        for name, columns in _INDEXES:
+            self._e("CREATE INDEX IF NOT EXISTS %s ON characters(%s)" % \
+                        (name, columns))
+
+    def _drop_indexes(self, keep=()):
+        for name, columns in _INDEXES:
+            if not name in keep:
+                self._e("DROP INDEX IF EXISTS %s" % name)
 
-    def get_character_from_row(self, row):
+    def _get_schema_version(self):
+        return self._efo("PRAGMA user_version")[0]
+
+    def _set_schema_version(self, version):
+        # PRAGMA statements can't take parameters
+        self._e("PRAGMA user_version = %d" % int(version))
+        self._schema_version = version
+        self._charpool.set_version(version)
+
+    def get_character_from_row(self, row, read_only=False):
         # charid, setid, utf8, n_strokes, data, sha1
-        char = _convert_character(row['data'])
+        char = _convert_character(row['data'], self._schema_version,
+                                  row['utf8'])
         char.charid = row['charid']
-        if self.WRITE_BACK:
+        if self.WRITE_BACK and not read_only and not self._read_only:
             return CharacterProxy(self._charpool, char)
         else:
             return char
@@ -421,7 +719,7 @@ CREATE INDEX character_setid_index ON characters(setid);
         return "<CharacterCollection %d characters (ref %d)>" % \
                     (self.get_total_n_characters(), id(self))
 
-    def bind(self, path):
+    def bind(self, path, read_only=False):
         """
         Bind database to a db file.
 
@@ -437,8 +735,21 @@ CREATE INDEX character_setid_index ON characters(setid);
                                         temp files under pressure
 
             "/path/to/file.chardb"      for file-based database
+
+        @type read_only: bool
+        @param read_only: whether to open the database read-only
+
+        Read-only collections return plain L{Character} objects rather than
+        proxies and can be used from read-only media. Any attempt to modify
+        them raises sqlite3.OperationalError.
         """
-        self._con = sqlite3.connect(path)
+        self._read_only = False
+        if read_only and not path in ("", ":memory:"):
+            self._con = sqlite3.connect("file:%s?mode=ro" % \
+                                            pathname2url(os.path.abspath(path)),
+                                        uri=True)
+        else:
+            self._con = sqlite3.connect(path)
         self._con.text_factory = str
         self._con.row_factory = _dict_factory #sqlite3.Row
         self._c = self._con.cursor()
@@ -446,10 +757,78 @@ CREATE INDEX character_setid_index ON characters(setid);
 
         if not self._has_tables():
             self._create_tables()
+        else:
+            self._schema_version = self._get_schema_version()
+            if self._schema_version > SCHEMA_VERSION:
+                raise ValueError("Unsupported .chardb version %d" % \
+                                 self._schema_version)
+            self._charpool.set_version(self._schema_version)
+            if not read_only:
+                try:
+                    # databases created by older versions lack some indexes
+                    self._create_indexes()
+                except sqlite3.OperationalError:
+                    # read-only database
+                    pass
 
         self._update_set_ids()
         self._dbpath = path
 
+        if read_only:
+            self._set_read_only()
+
+    def _set_read_only(self):
+        self.commit()
+        self._e("PRAGMA query_only = ON")
+        self._read_only = True
+
+    def is_read_only(self):
+        """
+        Return whether the collection is read-only.
+
+        @rtype: bool
+        """
+        return self._read_only
+
+    def get_schema_version(self):
+        """
+        Return the version of the db schema used by the collection.
+
+        @rtype: int
+        """
+        return self._schema_version
+
+    def upgrade(self):
+        """
+        Convert the collection to the latest db schema version.
+
+        Handwriting data of older .chardb files is converted from compressed
+        XML to the packed binary format. Changes are committed and the
+        database file is compacted afterwards.
+        """
+        if self._schema_version >= SCHEMA_VERSION:
+            return
+
+        old_version = self._schema_version
+        last = -1
+
+        while True:
+            rows = self._efa("""SELECT charid, utf8, data FROM characters
+WHERE charid > ? ORDER BY charid LIMIT 1000""", (last,))
+            if not rows:
+                break
+            last = rows[-1]['charid']
+            self._em("UPDATE characters SET data=? WHERE charid=?",
+                     [(_adapt_character(_convert_character(r['data'],
+                                                           old_version,
+                                                           r['utf8']),
+                                        SCHEMA_VERSION),
+                       r['charid']) for r in rows])
+
+        self._set_schema_version(SCHEMA_VERSION)
+        self.commit()
+        self._e("VACUUM")
+
     def get_db_filename(self):
         """
         Returns the db file which is internally used by the collection.
@@ -492,14 +871,9 @@ CREATE INDEX character_setid_index ON characters(setid);
             if path.endswith(".chardb"):
                 if self._dbpath != path:
                     # the collection changed its database name
-                    # FIXME: this can rewritten more efficiently with
-                    # the ATTACH command
                     if os.path.exists(path):
                         os.unlink(path)
-                    newcc = CharacterCollection(path)
-                    newcc.merge([self])
-                    newcc.commit()
-                    del newcc
+                    self._copy_to_db(path)
                     self.bind(path)
             else:
                 gzip, bz2 = _gzipbz2(path)
@@ -507,6 +881,118 @@ CREATE INDEX character_setid_index ON characters(setid);
 
         self.commit()
 
+    def _attach(self, path):
+        # ATTACH can't be used within a transaction
+        self.commit()
+        self._e("ATTACH DATABASE ? AS other", (path,))
+
+    def _detach(self):
+        self.commit()
+        self._e("DETACH DATABASE other")
+
+    def _begin_bulk_load(self, keep_indexes=()):
+        # ideally, the whole db is kept in memory during bulk loads
+        # and indexes are rebuilt afterwards
+        self.commit()
+        pragmas = {}
+        for pragma in ("journal_mode", "synchronous", "cache_size"):
+            pragmas[pragma] = self._efo("PRAGMA %s" % pragma)[0]
+        self._e("PRAGMA journal_mode = WAL")
+        # NORMAL is safe with WAL
+        self._e("PRAGMA synchronous = NORMAL")
+        self._e("PRAGMA cache_size = -65536") # 64MB
+        self._drop_indexes(keep_indexes)
+        return pragmas
+
+    def _end_bulk_load(self, pragmas):
+        self._create_indexes()
+        self.commit()
+        # leave the db file in its original journal mode so that the file
+        # can be distributed and opened from read-only media
+        for pragma in ("journal_mode", "synchronous", "cache_size"):
+            self._e("PRAGMA %s = %s" % (pragma, pragmas[pragma]))
+
+    def _copy_to_db(self, path):
+        # copy the collection to a new db file
+        newcc = CharacterCollection(path)
+        newcc._drop_indexes()
+        newcc._con.close()
+        del newcc
+
+        self._attach(path)
+        try:
+            # the file is new, no need to care about consistency in case
+            # of a crash
+            self._e("PRAGMA other.synchronous = OFF")
+            self._e("PRAGMA other.journal_mode = OFF")
+            self._e("""INSERT INTO other.character_sets
+SELECT * FROM main.character_sets""")
+            self._e("""INSERT INTO other.characters
+SELECT * FROM main.characters""")
+        finally:
+            self._detach()
+        # indexes are recreated when binding the file
+
+    def _can_attach(self, charcol):
+        # whether charcol can be merged with INSERT ... SELECT statements
+        if charcol.get_db_filename() is None or \
+           charcol.get_schema_version() != self._schema_version or \
+           charcol.get_db_filename() == self.get_db_filename():
+            return False
+        # uncommitted changes wouldn't be seen through ATTACH
+        charcol._charpool.clear_pool()
+        return not charcol._con.in_transaction
+
+    def _merge_db(self, path, check_duplicate=False):
+        self._attach(path)
+        try:
+            self._e("""INSERT INTO character_sets(name)
+SELECT name FROM other.character_sets
+WHERE name NOT IN (SELECT name FROM main.character_sets)
+ORDER BY setid""")
+            # map the set ids of the other db to the set ids of this db
+            self._e("DROP TABLE IF EXISTS temp.setid_map")
+            self._e("""CREATE TEMP TABLE setid_map(
+  oldid  INTEGER PRIMARY KEY,
+  newid  INTEGER
+)""")
+            self._e("""INSERT INTO setid_map
+SELECT other.character_sets.setid, main.character_sets.setid
+FROM other.character_sets JOIN main.character_sets
+ON other.character_sets.name = main.character_sets.name""")
+            if check_duplicate:
+                # select the characters to copy first: reading the
+                # characters table while inserting into it would force sqlite
+                # to buffer the whole result, data included
+                self._e("DROP TABLE IF EXISTS temp.merge_charids")
+                self._e("""CREATE TEMP TABLE merge_charids(
+  charid  INTEGER PRIMARY KEY
+)""")
+                self._e("""INSERT INTO merge_charids
+SELECT charid FROM other.characters AS o JOIN setid_map ON o.setid = oldid
+WHERE o.sha1 IS NULL OR
+(NOT EXISTS (SELECT 1 FROM other.characters AS c
+             WHERE c.setid = o.setid AND c.sha1 = o.sha1
+             AND c.charid < o.charid) AND
+ NOT EXISTS (SELECT 1 FROM main.characters AS m
+             WHERE m.setid = newid AND m.sha1 = o.sha1))""")
+                where = "WHERE other.characters.charid IN temp.merge_charids"
+            else:
+                where = ""
+
+            self._e("""INSERT INTO main.characters
+(setid, utf8, n_strokes, data, sha1)
+SELECT setid_map.newid, utf8, n_strokes, data, sha1
+FROM other.characters JOIN setid_map
+ON other.characters.setid = setid_map.oldid
+%s
+ORDER BY other.characters.setid, other.characters.charid""" % where)
+            self._e("DROP TABLE setid_map")
+            self._e("DROP TABLE IF EXISTS temp.merge_charids")
+        finally:
+            self._detach()
+        self._update_set_ids()
+
     def to_stroke_collection(self, dictionary, silent=True):
         """
         @type dictionary: L{CharacterStrokeDictionary
@@ -541,39 +1027,120 @@ CREATE INDEX character_setid_index ON characters(setid);
     def from_character_directory(directory,
                                  extensions=["xml", "bz2", "gz"],
                                  recursive=True,
-                                 check_duplicate=False):
+                                 check_duplicate=False,
+                                 n_processes=None):
         """
         Creates a character collection from a directory containing
         individual character files.
+
+        See L{import_character_directory}.
         """
-        regexp = re.compile("\.(%s)$" % "|".join(extensions))
         charcol = CharacterCollection()
+        charcol.import_character_directory(directory, extensions, recursive,
+                                           check_duplicate, n_processes)
+        return charcol
 
-        for name in os.listdir(directory):
-            full_path = os.path.join(directory, name)
-            if os.path.isdir(full_path) and recursive:
-                charcol += CharacterCollection.from_character_directory(
-                               full_path, extensions)
-            elif regexp.search(full_path):
-                char = Character()
-                gzip = False; bz2 = False
-                if full_path.endswith(".gz"): gzip = True
-                if full_path.endswith(".bz2"): bz2 = True
+    def _get_pool(self, n_processes):
+        if n_processes is None:
+            n_processes = multiprocessing.cpu_count()
 
-                try:
-                    char.read(full_path, gzip=gzip, bz2=bz2)
-                except ValueError:
-                    continue # ignore malformed XML files
+        if n_processes <= 1:
+            return None
 
-                utf8 = char.get_utf8()
-                if utf8 is None: utf8 = "Unknown"
+        # tegaki tools are scripts without a __main__ guard, workers must
+        # therefore be forked rather than spawned
+        if not "fork" in multiprocessing.get_all_start_methods():
+            return None
 
-                charcol.add_set(utf8)
-                if not check_duplicate or \
-                   not char in charcol.get_characters(utf8):
-                    charcol.append_character(utf8, char)
+        return multiprocessing.get_context("fork").Pool(n_processes)
 
-        return charcol
+    def import_character_directory(self, directory,
+                                   extensions=["xml", "bz2", "gz"],
+                                   recursive=True,
+                                   check_duplicate=False,
+                                   n_processes=None):
+        """
+        Add the characters of a directory containing individual character
+        files to the collection.
+
+        @type directory: str
+        @param directory: the directory to import
+
+        @type extensions: list of str
+        @param extensions: the extensions of character files
+
+        @type recursive: bool
+        @param recursive: whether to import sub-directories too
+
+        @type check_duplicate: bool
+        @param check_duplicate: whether to skip characters which are already \
+                                in the collection
+
+        @type n_processes: int
+        @param n_processes: the number of processes used to parse files \
+                            (None to use all CPUs)
+
+        Characters are put in the set named after their utf8 value. Files are
+        parsed by a pool of processes and written to the db in large
+        transactions, as they are read.
+        """
+        regexp = re.compile("\.(%s)$" % "|".join(extensions))
+        paths = _find_character_files(directory, regexp, recursive)
+        args = ((path, self._schema_version) for path in paths)
+
+        pool = self._get_pool(n_processes)
+        if pool is None:
+            rows = map(_read_character_file, args)
+        else:
+            rows = pool.imap(_read_character_file, args, chunksize=64)
+
+        if check_duplicate:
+            keep_indexes = ("character_setid_sha1_index",)
+        else:
+            keep_indexes = ()
+
+        pragmas = self._begin_bulk_load(keep_indexes)
+        sha1s = {}
+        try:
+            batch = []
+            for row in rows:
+                if row is None:
+                    continue
+
+                set_name = row['utf8']
+                if set_name is None: set_name = "Unknown"
+
+                if check_duplicate:
+                    if not set_name in sha1s:
+                        if set_name in self._SETIDS:
+                            sha1s[set_name] = self._get_sha1s(set_name)
+                        else:
+                            sha1s[set_name] = set()
+                    if row['sha1'] in sha1s[set_name]:
+                        continue
+                    sha1s[set_name].add(row['sha1'])
+
+                batch.append((set_name, row))
+                if len(batch) >= self.IMPORT_BATCH_SIZE:
+                    self._append_set_rows(batch)
+                    self.commit()
+                    batch = []
+
+            self._append_set_rows(batch)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            self._end_bulk_load(pragmas)
+
+    def _append_set_rows(self, set_rows):
+        # append (set_name, row) tuples, adding sets when needed
+        self.add_sets([set_name for set_name, row in set_rows])
+        tupls = [(self._SETIDS[set_name], r['utf8'], r['n_strokes'],
+                  r['data'], r['sha1']) for set_name, r in set_rows]
+        self._em("""INSERT INTO
+characters (setid, utf8, n_strokes, data, sha1)
+VALUES (?,?,?,?,?)""", tupls)
 
     def concatenate(self, other, check_duplicate=False):
         """
@@ -591,28 +1158,86 @@ CREATE INDEX character_setid_index ON characters(setid);
 
         @type charcols: list
         @param charcols: a list of CharacterCollection to merge
+
+        @type check_duplicate: bool
+        @param check_duplicate: whether to skip characters which are already \
+                                in the set they would be added to
+
+        Collections stored in .chardb files are copied within sqlite,
+        without going through Python objects. Changes to the current
+        collection are committed.
+
+        Duplicates are detected thanks to the sha1 digest of characters
+        (see L{Character.hash}).
         """
+        if check_duplicate:
+            keep_indexes = ("character_setid_sha1_index",)
+        else:
+            keep_indexes = ()
 
+        pragmas = self._begin_bulk_load(keep_indexes)
         try:
-            # it's faster to delete the whole index and rewrite it afterwards
-            self._e("""DROP INDEX character_setid_index;""")
-
             for charcol in charcols:
+                if self._can_attach(charcol):
+                    self._merge_db(charcol.get_db_filename(), check_duplicate)
+                    continue
+
                 for set_name in charcol.get_set_list():
                     self.add_set(set_name)
 
+                    chars = charcol.get_character_rows(set_name)
                     if check_duplicate:
-                        existing_chars = self.get_characters(set_name)
-                        chars = charcol.get_characters(set_name)
-                        chars = [c for c in chars if not c in existing_chars]
-                        self.append_characters(set_name, chars)
-                    else:
-                        chars = charcol.get_character_rows(set_name)
-                        self.append_character_rows(set_name, chars)
+                        chars = self._remove_duplicate_rows(set_name, chars)
+                    if charcol.get_schema_version() != self._schema_version:
+                        chars = self._convert_rows(chars,
+                                                   charcol.get_schema_version())
+                    self.append_character_rows(set_name, chars)
 
         finally:
-            self._e("""CREATE INDEX character_setid_index
-ON characters(setid);""")
+            self._end_bulk_load(pragmas)
+
+    def _get_sha1s(self, set_name):
+        i = self._SETIDS[set_name]
+        rows = self._efa("SELECT sha1 FROM characters WHERE setid=?", (i,))
+        return set(row['sha1'] for row in rows)
+
+    def _remove_duplicate_rows(self, set_name, rows):
+        # remove rows which are already in the set or which appear twice
+        sha1s = self._get_sha1s(set_name)
+        ret = []
+        for row in rows:
+            if row['sha1'] is not None:
+                if row['sha1'] in sha1s:
+                    continue
+                sha1s.add(row['sha1'])
+            ret.append(row)
+        return ret
+
+    def dedupe(self):
+        """
+        Remove duplicate characters within each set.
+
+        The first occurrence of a character is kept. Duplicates are
+        detected thanks to the sha1 digest of characters (see
+        L{Character.hash}).
+
+        @rtype: int
+        @return: the number of removed characters
+        """
+        self._e("""DELETE FROM characters
+WHERE sha1 IS NOT NULL AND EXISTS
+(SELECT 1 FROM characters AS c
+ WHERE c.setid = characters.setid AND c.sha1 = characters.sha1
+ AND c.charid < characters.charid)""")
+        return self._c.rowcount
+
+    def _convert_rows(self, rows, version):
+        # re-encode rows coming from a db with a different schema version
+        for row in rows:
+            char = _convert_character(row['data'], version, row['utf8'])
+            row = dict(row)
+            row['data'] = _adapt_character(char, self._schema_version)
+            yield row
 
     def __add__(self, other):
         return self.concatenate(other)
@@ -631,9 +1256,16 @@ ON characters(setid);""")
 
         @type set_names: list of str
         """
-        set_names = [(set_name,) for set_name in set_names  \
-                        if not set_name in self._SETIDS]
-        self._em("INSERT INTO character_sets(name) VALUES (?)", set_names)
+        new_names = []
+        seen = set()
+        for set_name in set_names:
+            if not set_name in self._SETIDS and not set_name in seen:
+                new_names.append(set_name)
+                seen.add(set_name)
+        if not new_names:
+            return
+        self._em("INSERT INTO character_sets(name) VALUES (?)",
+                 [(set_name,) for set_name in new_names])
         self._update_set_ids()
 
     def remove_set(self, set_name):
@@ -670,7 +1302,7 @@ ON characters(setid);""")
         """
         return len(self._SETIDS)
 
-    def get_characters(self, set_name, limit=-1, offset=0):
+    def get_characters(self, set_name, limit=-1, offset=0, read_only=False):
         """
         Return character belonging to a set.
 
@@ -683,16 +1315,27 @@ ON characters(setid);""")
         @type offset: int
         @param offset: the offset to start from (0 if from beginning)
 
+        @type read_only: bool
+        @param read_only: whether to return plain L{Character} objects \
+                          rather than proxies (changes to them are not \
+                          written back unless L{mark_dirty} is used)
+
         @rtype: list of L{Character}
         """
-        return list(self.get_characters_gen(set_name, limit, offset))
+        return list(self.get_characters_gen(set_name, limit, offset,
+                                            read_only))
 
-    def get_characters_gen(self, set_name, limit=-1, offset=0):
+    def get_characters_gen(self, set_name, limit=-1, offset=0,
+                           read_only=False):
         """
         Return a generator to iterate over characters. See L{get_characters).
+
+        Characters are read from the db as the iteration goes.
         """
-        rows = self.get_character_rows(set_name, limit, offset)
-        return (self.get_character_from_row(r) for r in rows)
+        i = self._SETIDS[set_name]
+        rows = self._egen("""SELECT * FROM characters
+WHERE setid=? ORDER BY charid LIMIT ? OFFSET ?""", (i, int(limit), int(offset)))
+        return (self.get_character_from_row(r, read_only) for r in rows)
 
     def get_character_rows(self, set_name, limit=-1, offset=0):
         i = self._SETIDS[set_name]
@@ -700,23 +1343,31 @@ ON characters(setid);""")
 WHERE setid=? ORDER BY charid LIMIT ? OFFSET ?""", (i, int(limit), int(offset)))
         return self._fa()
 
-    def get_random_characters(self, n):
+    def get_random_characters(self, n, read_only=False):
         """
         Return characters at random.
 
         @type n: int
         @param n: number of random characters needed.
+
+        @type read_only: bool
+        @param read_only: whether to return plain L{Character} objects \
+                          rather than proxies (changes to them are not \
+                          written back unless L{mark_dirty} is used)
         """
-        return list(self.get_random_characters_gen(n))
+        return list(self.get_random_characters_gen(n, read_only))
 
-    def get_random_characters_gen(self, n):
+    def get_random_characters_gen(self, n, read_only=False):
         """
         Return a generator to iterate over random characters. See \
         L{get_random_characters).
         """
-        self._e("""SELECT DISTINCT * from characters
-ORDER BY RANDOM() LIMIT ?""", (int(n),))
-        return (self.get_character_from_row(r) for r in self._fa())
+        # only the ids are shuffled, not the whole rows
+        rows = self._egen("""SELECT characters.* FROM
+(SELECT charid, RANDOM() AS r FROM characters ORDER BY r LIMIT ?) AS rand
+JOIN characters ON characters.charid = rand.charid
+ORDER BY rand.r""", (int(n),))
+        return (self.get_character_from_row(r, read_only) for r in rows)
 
     def get_n_characters(self, set_name):
         """
@@ -735,7 +1386,7 @@ WHERE setid=?""", (i,))[0]
         except KeyError:
             return 0
 
-    def get_all_characters(self, limit=-1, offset=0):
+    def get_all_characters(self, limit=-1, offset=0, read_only=False):
         """
         Return all characters in collection.
 
@@ -745,18 +1396,25 @@ WHERE setid=?""", (i,))[0]
         @type offset: int
         @param offset: the offset to start from (0 if from beginning)
 
+        @type read_only: bool
+        @param read_only: whether to return plain L{Character} objects \
+                          rather than proxies (changes to them are not \
+                          written back unless L{mark_dirty} is used)
+
         @rtype: list of L{Character}
         """
-        return list(self.get_all_characters_gen(limit=-1, offset=0))
+        return list(self.get_all_characters_gen(limit, offset, read_only))
 
-    def get_all_characters_gen(self, limit=-1, offset=0):
+    def get_all_characters_gen(self, limit=-1, offset=0, read_only=False):
         """
         Return a generator to iterate over all characters. See \
         L{get_all_characters).
+
+        Characters are read from the db as the iteration goes.
         """
-        self._e("""SELECT * FROM characters
+        rows = self._egen("""SELECT * FROM characters
 ORDER BY charid LIMIT ? OFFSET ?""", (int(limit), int(offset)))
-        return (self.get_character_from_row(r) for r in self._fa())
+        return (self.get_character_from_row(r, read_only) for r in rows)
 
     def get_total_n_characters(self):
         """
@@ -782,6 +1440,98 @@ ORDER BY charid LIMIT ? OFFSET ?""", (int(limit), int(offset)))
         return self._efo("""SELECT AVG(n_strokes) FROM characters
 WHERE setid=?""", (i,))[0]
 
+    # Metadata API
+    # The following methods only read the utf8, n_strokes and sha1 columns
+    # and are therefore much faster than loading the characters.
+
+    def get_character_info_gen(self, set_name=None):
+        """
+        Return a generator to iterate over the metadata of characters.
+
+        @type set_name: str
+        @param set_name: the set characters belong to or None if all
+
+        @rtype: generator of dict
+        @return: dicts with charid, setid, utf8, n_strokes and sha1 keys
+        """
+        keys = ("charid", "setid", "utf8", "n_strokes", "sha1")
+
+        if set_name is None:
+            rows = self._egen("""SELECT charid, setid, utf8, n_strokes, sha1
+FROM characters ORDER BY charid""")
+        else:
+            i = self._SETIDS[set_name]
+            rows = self._egen("""SELECT charid, setid, utf8, n_strokes, sha1
+FROM characters WHERE setid=? ORDER BY charid""", (i,))
+
+        # rows also have integer keys, see _dict_factory
+        return (dict((k, row[k]) for k in keys) for row in rows)
+
+    def get_utf8_counts(self):
+        """
+        Return the number of samples of each character.
+
+        @rtype: dict
+        @return: a dict mapping utf8 values to numbers of samples
+        """
+        rows = self._efa("""SELECT utf8, COUNT(*) AS n_chars FROM characters
+GROUP BY utf8""")
+        return dict((row['utf8'], row['n_chars']) for row in rows)
+
+    def get_n_strokes_counts(self):
+        """
+        Return the number of samples of each character for each stroke count.
+
+        @rtype: list of tuples
+        @return: (utf8, n_strokes, number of samples) tuples, sorted by utf8 \
+                 then n_strokes
+        """
+        rows = self._efa("""SELECT utf8, n_strokes, COUNT(*) AS n_chars
+FROM characters GROUP BY utf8, n_strokes ORDER BY utf8, n_strokes""")
+        return [(row['utf8'], row['n_strokes'], row['n_chars']) \
+                    for row in rows]
+
+    def get_set_sizes(self):
+        """
+        Return the number of characters in each set.
+
+        @rtype: dict
+        @return: a dict mapping set names to numbers of characters
+        """
+        charcounts = self._get_set_char_counts()
+        return dict((set_name, charcounts.get(setid, 0)) \
+                        for set_name, setid in self._SETIDS.items())
+
+    def get_set_digests(self):
+        """
+        Return a sha1 digest of the contents of each set.
+
+        The digest of a set changes when characters are added to it,
+        removed from it or modified. It can be used to tell which sets
+        changed between two versions of a collection.
+
+        @rtype: dict
+        @return: a dict mapping set names to hexadecimal sha1 digests
+        """
+        digests = dict((setid, hashlib.sha1()) \
+                        for setid in self._SETIDS.values())
+
+        for row in self._egen("""SELECT charid, setid, sha1 FROM characters
+ORDER BY setid, charid"""):
+            if not row['setid'] in digests:
+                # remove_sets() leaves the characters of the sets removed
+                continue
+            sha1 = row['sha1']
+            if sha1 is None:
+                # collections made before the sha1 column was filled in
+                data = self._efo("SELECT data FROM characters WHERE charid=?",
+                                 (row['charid'],))[0]
+                sha1 = hashlib.sha1(data).hexdigest()
+            digests[row['setid']].update(sha1.encode("ascii") + b"\n")
+
+        return dict((set_name, digests[setid].hexdigest()) \
+                        for set_name, setid in self._SETIDS.items())
+
     def set_characters(self, set_name, characters):
         """
         Set/Replace the characters of a set.
@@ -810,7 +1560,7 @@ WHERE setid=?""", (i,))[0]
     def append_characters(self, set_name, characters):
         rows = [{'utf8':c.get_utf8(),
                  'n_strokes':c.get_writing().get_n_strokes(),
-                 'data':_adapt_character(c),
+                 'data':_adapt_character(c, self._schema_version),
                  'sha1':c.hash()} for c in characters]
 
         self.append_character_rows(set_name, rows)
@@ -877,15 +1627,37 @@ WHERE setid=? ORDER BY charid DESC LIMIT 1""", (setid,))[0]
 
         character must have been previously retrieved from the collection.
         """
+        self.update_character_objects([character])
+
+    def update_character_objects(self, characters):
+        """
+        Update several characters at once.
+
+        @type characters: list of L{Character}
+
+        characters must have been previously retrieved from the collection.
+        """
+        for character in characters:
+            if not hasattr(character, "charid"):
+                raise ValueError("The character object needs a charid " \
+                                 "attribute")
+        self._charpool.clear_pool()
+        self._charpool.update_characters(characters)
+
+    def mark_dirty(self, character):
+        """
+        Mark a character as modified.
+
+        @type character: L{Character}
+
+        character must have been previously retrieved from the collection.
+        Modified characters are written back in batch to the db before the
+        next query or commit. This is what proxies do when WRITE_BACK is
+        True; with plain characters, mark_dirty must be called explicitly.
+        """
         if not hasattr(character, "charid"):
             raise ValueError("The character object needs a charid attribute")
-        self._e("""UPDATE characters
-SET utf8=?, n_strokes=?, data=?, sha1=?
-WHERE charid=?""", (character.get_utf8(),
-                    character.get_writing().get_n_strokes(),
-                    _adapt_character(character),
-                    character.hash(),
-                    character.charid))
+        self._charpool.add_char(character)
 
     def replace_character(self, set_name, i, character):
         """
@@ -975,13 +1747,12 @@ WHERE setid=? ORDER BY charid LIMIT 1 OFFSET ?""", (setid, i))[0]
 
         @type keep_at_most: the maximum number of samples to keep.
         """
-        for set_name in self.get_set_list():
-            if self.get_n_characters(set_name) > keep_at_most:
-                setid = self._SETIDS[set_name]
-                self._e("""DELETE FROM characters
+        charcounts = self._get_set_char_counts()
+        setids = [(setid, keep_at_most) for setid, n_chars in charcounts.items()
+                  if n_chars > keep_at_most]
+        self._em("""DELETE FROM characters
 WHERE charid IN(SELECT charid FROM characters
-                WHERE setid=? ORDER BY charid LIMIT -1 OFFSET ?)""",
-                        (setid, keep_at_most))
+                WHERE setid=? ORDER BY charid LIMIT -1 OFFSET ?)""", setids)
 
     def _get_set_char_counts(self):
         rows = self._efa("""SELECT setid, COUNT(charid) AS n_chars
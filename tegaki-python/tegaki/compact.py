@@ -0,0 +1,601 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Memory-efficient handwriting representation.
+
+A L{Writing} is a list of L{Stroke} objects, themselves lists of L{Point}
+dictionaries. This is convenient but memory-hungry and slow to process.
+
+A L{CompactWriting} stores the coordinates of all its points in a single
+contiguous array, along with the offset of each stroke in that array.
+It supports the most common L{Writing} methods and can be converted from and
+to a L{Writing}. Only (x,y) coordinates are kept.
+
+>>> cw = CompactWriting.from_writing(writing)
+>>> cw.normalize()
+>>> cw.downsample_threshold(50)
+>>> writing = cw.to_writing()
+"""
+
+from array import array
+from math import floor, atan, sin, cos, sqrt
+
+from tegaki.character import Point, Stroke, Writing
+
+# Stroke-level algorithms
+#
+# They take a flat sequence of coordinates [x0, y0, x1, y1, ...] and return a
+# new flat list. They follow the Stroke methods of the same name point by
+# point, so that both representations give the same results. Coordinates
+# are kept as floats and only truncated where L{Point} truncates them.
+
+def _downsample(coords, n):
+    return [v for i in range(0, len(coords) // 2, n) \
+              for v in coords[2*i:2*i+2]]
+
+def _downsample_threshold(coords, threshold):
+    n_points = len(coords) // 2
+
+    if n_points == 0:
+        return []
+
+    new = [coords[0], coords[1]]
+
+    lx, ly = coords[0], coords[1]
+    for i in range(1, n_points - 2):
+        x, y = coords[2*i], coords[2*i+1]
+        dx = x - lx
+        dy = y - ly
+        if sqrt(dx * dx + dy * dy) > threshold:
+            new.append(x)
+            new.append(y)
+            lx, ly = x, y
+
+    new.append(coords[-2])
+    new.append(coords[-1])
+
+    return new
+
+def _upsample(coords, func):
+    n_points = len(coords) // 2
+
+    if n_points == 0:
+        return []
+
+    new = []
+
+    for i in range(n_points - 1):
+        x1, y1, x2, y2 = coords[2*i:2*i+4]
+
+        new.append(x1)
+        new.append(y1)
+
+        dx = x2 - x1
+        dy = y2 - y1
+
+        if dx == 0:
+            cosalpha = 0.0
+            sinalpha = 1.0
+        else:
+            alpha = atan(float(abs(dy)) / abs(dx))
+            cosalpha = cos(alpha)
+            sinalpha = sin(alpha)
+
+        d = sqrt(dx * dx + dy * dy)
+        signx = (dx > 0) - (dx < 0)
+        signy = (dy > 0) - (dy < 0)
+
+        n = func(d)
+
+        for j in range(1, n+1):
+            dx = cosalpha * 1.0 / (n + 1) * d
+            dy = sinalpha * 1.0 / (n + 1) * d
+            new.append(int(x1+j*dx*signx))
+            new.append(int(y1+j*dy*signy))
+
+    new.append(coords[-2])
+    new.append(coords[-1])
+
+    return new
+
+_SMOOTH_WEIGHTS = (1, 1, 2, 1, 1)
+_SMOOTH_TIMES = 3
+
+def _smooth(coords):
+    n_points = len(coords) // 2
+    weights = _SMOOTH_WEIGHTS
+
+    if n_points < len(weights):
+        return list(coords)
+
+    offset = len(weights) // 2
+    wsum = sum(weights)
+    new = list(coords)
+
+    for n in range(_SMOOTH_TIMES):
+        s = list(new)
+
+        for i in range(offset, n_points - offset):
+            x = 0
+            y = 0
+            for j in range(len(weights)):
+                k = 2 * (i + j - offset)
+                x += weights[j] * s[k]
+                y += weights[j] * s[k+1]
+
+            new[2*i] = int(round(x / wsum))
+            new[2*i+1] = int(round(y / wsum))
+
+    return new
+
+class CompactStroke(object):
+    """
+    A view on one stroke of a L{CompactWriting}.
+
+    Points are returned as new L{Point} objects: modifying them doesn't
+    modify the writing.
+    """
+
+    __slots__ = ("_writing", "_i")
+
+    def __init__(self, writing, i):
+        self._writing = writing
+        self._i = i
+
+    def _get_coords(self):
+        return self._writing._get_stroke_coords(self._i)
+
+    def _set_coords(self, coords):
+        self._writing._set_stroke_coords(self._i, coords)
+
+    def __len__(self):
+        start, end = self._writing._get_stroke_range(self._i)
+        return end - start
+
+    def __getitem__(self, i):
+        coords = self._get_coords()
+        if i < 0: i += len(coords) // 2
+        if i < 0 or i >= len(coords) // 2:
+            raise IndexError("point index out of range")
+        return Point(coords[2*i], coords[2*i+1])
+
+    def __iter__(self):
+        coords = self._get_coords()
+        for i in range(0, len(coords), 2):
+            yield Point(coords[i], coords[i+1])
+
+    def get_coordinates(self):
+        """
+        Return (x,y) coordinates.
+
+        @rtype: a list of tuples
+        """
+        coords = self._get_coords()
+        return list(zip(coords[0::2], coords[1::2]))
+
+    def get_is_smoothed(self):
+        """
+        Return whether the stroke has been smoothed already or not.
+
+        @rtype: boolean
+        """
+        return bool(self._writing._smoothed[self._i])
+
+    def smooth(self):
+        """
+        See L{Stroke.smooth}.
+        """
+        if self.get_is_smoothed():
+            return
+        self._set_coords(_smooth(self._get_coords()))
+        self._writing._smoothed[self._i] = 1
+
+    def downsample(self, n):
+        """
+        See L{Stroke.downsample}.
+        """
+        self._set_coords(_downsample(self._get_coords(), n))
+
+    def downsample_threshold(self, threshold):
+        """
+        See L{Stroke.downsample_threshold}.
+        """
+        self._set_coords(_downsample_threshold(self._get_coords(), threshold))
+
+    def upsample(self, n):
+        """
+        See L{Stroke.upsample}.
+        """
+        self._set_coords(_upsample(self._get_coords(), lambda d: n))
+
+    def upsample_threshold(self, threshold):
+        """
+        See L{Stroke.upsample_threshold}.
+        """
+        self._set_coords(_upsample(self._get_coords(),
+                         lambda d: int(floor(float(d) / threshold - 1))))
+
+    def to_stroke(self):
+        """
+        Convert to a L{Stroke} object.
+
+        @rtype: L{Stroke}
+        """
+        stroke = Stroke()
+        stroke.append_points(list(self))
+        stroke._is_smoothed = self.get_is_smoothed()
+        return stroke
+
+    def __repr__(self):
+        return "<CompactStroke %d pts (ref %d)>" % (len(self), id(self))
+
+class CompactWriting(object):
+    """
+    A sequence of strokes stored in contiguous arrays.
+
+    Coordinates are stored as doubles in a flat array
+    [x0, y0, x1, y1, ...], like the L{Point} coordinates which become
+    floats when moved by a non-integer distance. The i-th stroke spans the points
+    offsets[i] to offsets[i+1] - 1.
+    """
+
+    __slots__ = ("_width", "_height", "_coords", "_offsets", "_smoothed")
+
+    def __init__(self):
+        self._width = Writing.WIDTH
+        self._height = Writing.HEIGHT
+        self.clear()
+
+    @classmethod
+    def from_writing(cls, writing):
+        """
+        Create a compact writing from a L{Writing}.
+
+        @type writing: L{Writing}
+        @rtype: L{CompactWriting}
+        """
+        cw = cls()
+        cw.set_size(writing.get_width(), writing.get_height())
+        for stroke in writing.get_strokes(full=True):
+            cw.append_stroke(stroke)
+        return cw
+
+    def to_writing(self):
+        """
+        Convert to a L{Writing}.
+
+        @rtype: L{Writing}
+        """
+        writing = Writing()
+        writing.set_size(self._width, self._height)
+        for stroke in self.get_strokes(full=True):
+            writing.append_stroke(stroke.to_stroke())
+        return writing
+
+    def clear(self):
+        """
+        Remove all strokes from writing.
+        """
+        self._coords = array("d")
+        self._offsets = array("I", [0])
+        self._smoothed = array("B")
+
+    # Internal helpers
+
+    def _get_stroke_range(self, i):
+        return (self._offsets[i], self._offsets[i+1])
+
+    def _get_stroke_coords(self, i):
+        start, end = self._get_stroke_range(i)
+        return self._coords[2*start:2*end]
+
+    def _set_stroke_coords(self, i, coords):
+        start, end = self._get_stroke_range(i)
+        self._coords[2*start:2*end] = array("d", coords)
+        diff = len(coords) // 2 - (end - start)
+        if diff != 0:
+            for j in range(i + 1, len(self._offsets)):
+                self._offsets[j] += diff
+
+    def _map_strokes(self, func):
+        coords = array("d")
+        offsets = array("I", [0])
+        for i in range(self.get_n_strokes()):
+            coords.extend(array("d", func(self._get_stroke_coords(i))))
+            offsets.append(len(coords) // 2)
+        self._coords = coords
+        self._offsets = offsets
+
+    # Public API
+
+    def get_n_strokes(self):
+        """
+        Return the number of strokes.
+
+        @rtype: int
+        """
+        return len(self._offsets) - 1
+
+    def get_n_points(self):
+        """
+        Return the total number of points.
+        """
+        return len(self._coords) // 2
+
+    def get_strokes(self, full=False):
+        """
+        Return strokes.
+
+        @type full: boolean
+        @param full: whether to return strokes as L{CompactStroke} views \
+                     or as (x,y) pairs
+        """
+        if not full:
+            c = [int(v) for v in self._coords]
+            return [list(zip(c[2*s:2*e:2], c[2*s+1:2*e:2])) \
+                        for s, e in zip(self._offsets, self._offsets[1:])]
+        else:
+            return [CompactStroke(self, i) \
+                        for i in range(self.get_n_strokes())]
+
+    def move_to(self, x, y):
+        """
+        Start a new stroke at (x,y).
+        """
+        self._coords.append(x)
+        self._coords.append(y)
+        self._offsets.append(len(self._coords) // 2)
+        self._smoothed.append(0)
+
+    def line_to(self, x, y):
+        """
+        Add point with coordinates (x,y) to the current stroke.
+        """
+        self._coords.append(x)
+        self._coords.append(y)
+        self._offsets[-1] += 1
+
+    def append_stroke(self, stroke):
+        """
+        Add a new stroke.
+
+        @type stroke: L{Stroke}, L{CompactStroke} or list of (x,y) pairs
+        """
+        if isinstance(stroke, (Stroke, CompactStroke)):
+            smoothed = stroke.get_is_smoothed()
+            stroke = stroke.get_coordinates()
+        else:
+            smoothed = False
+
+        for x, y in stroke:
+            self._coords.append(x)
+            self._coords.append(y)
+        self._offsets.append(len(self._coords) // 2)
+        self._smoothed.append(1 if smoothed else 0)
+
+    def remove_stroke(self, i):
+        """
+        Remove the ith stroke.
+
+        @type i: int
+        @param i: position at which to delete a stroke (starts at 0)
+        """
+        if self.get_n_strokes() - 1 >= i:
+            self._set_stroke_coords(i, [])
+            del self._offsets[i+1]
+            del self._smoothed[i]
+
+    def remove_last_stroke(self):
+        """
+        Remove last stroke.
+        """
+        if self.get_n_strokes() > 0:
+            self.remove_stroke(self.get_n_strokes() - 1)
+
+    def resize(self, xrate, yrate):
+        """
+        Scale writing.
+
+        @type xrate: float
+        @param xrate: the x scaling factor
+        @type yrate: float
+        @param yrate: the y scaling factor
+        """
+        c = self._coords
+        for i in range(0, len(c), 2):
+            c[i] = int(c[i] * xrate)
+            c[i+1] = int(c[i+1] * yrate)
+
+    def move_rel(self, dx, dy):
+        """
+        Translate writing.
+
+        @type dx: int
+        @param dx: relative distance from current position
+        @type dy: int
+        @param yrate: relative distance from current position
+        """
+        c = self._coords
+        for i in range(0, len(c), 2):
+            c[i] += dx
+            c[i+1] += dy
+
+    def size(self):
+        """
+        Return writing size.
+
+        @rtype: (x, y, width, height)
+        @return: (x,y) are the coordinates of the upper-left point
+        """
+        xmin, ymin = 4294967296, 4294967296 # 2^32
+        xmax, ymax = 0, 0
+
+        if len(self._coords) > 0:
+            xs = self._coords[0::2]
+            ys = self._coords[1::2]
+            xmin, ymin = min(xmin, min(xs)), min(ymin, min(ys))
+            xmax, ymax = max(xmax, max(xs)), max(ymax, max(ys))
+
+        return (xmin, ymin, xmax-xmin, ymax-ymin)
+
+    def is_small(self):
+        """
+        See L{Writing.is_small}.
+        """
+        x, y, w, h = self.size()
+        return ((x+w <= self._width * 0.56 and
+                 y+h <= 0.56 * self._height) or # top-left
+                (x >= 0.44 * self._width and
+                 y+h <= 0.56 * self._height) or # top-right
+                (x+w <= self._width * 0.56 and
+                 y >= 0.44 * self._height) or # bottom-left
+                (x >= 0.44 * self._width and
+                 y >= 0.44 * self._height)) # bottom-right
+
+    def normalize(self):
+        """
+        Call L{normalize_size} and L{normalize_position} consecutively.
+        """
+        self.normalize_size()
+        self.normalize_position()
+
+    def normalize_position(self):
+        """
+        See L{Writing.normalize_position}.
+        """
+        x, y, width, height = self.size()
+
+        dx = (self._width - width) / 2 - x
+        dy = (self._height - height) / 2 - y
+
+        self.move_rel(dx, dy)
+
+    def normalize_size(self):
+        """
+        See L{Writing.normalize_size}.
+        """
+        x, y, width, height = self.size()
+
+        if float(width) / self._width > Writing.NORMALIZE_MIN_SIZE:
+            xrate = self._width * Writing.NORMALIZE_PROPORTION / width
+        else:
+            xrate = 1.0
+
+        if float(height) / self._height > Writing.NORMALIZE_MIN_SIZE:
+            yrate = self._height * Writing.NORMALIZE_PROPORTION / height
+        else:
+            yrate = 1.0
+
+        self.resize(xrate, yrate)
+
+    def downsample(self, n):
+        """
+        Downsample by keeping only 1 sample every n samples.
+
+        @type n: int
+        """
+        self._map_strokes(lambda c: _downsample(c, n))
+
+    def downsample_threshold(self, threshold):
+        """
+        Downsample by removing consecutive samples for which
+        the euclidean distance is inferior to threshold.
+
+        @type threshod: int
+        """
+        self._map_strokes(lambda c: _downsample_threshold(c, threshold))
+
+    def upsample(self, n):
+        """
+        'Artificially' increase sampling by adding n linearly spaced points
+        between consecutive points.
+
+        @type n: int
+        """
+        self._map_strokes(lambda c: _upsample(c, lambda d: n))
+
+    def upsample_threshold(self, threshold):
+        """
+        'Artificially' increase sampling, using threshold to determine
+        how many samples to add between consecutive points.
+
+        @type threshold: int
+        """
+        func = lambda d: int(floor(float(d) / threshold - 1))
+        self._map_strokes(lambda c: _upsample(c, func))
+
+    def smooth(self):
+        """
+        Smooth all strokes. See L{Stroke.smooth}.
+        """
+        for stroke in self.get_strokes(full=True):
+            stroke.smooth()
+
+    def get_size(self):
+        """
+        Return the size of the drawing box.
+
+        @rtype: tuple
+        """
+        return (self._width, self._height)
+
+    def set_size(self, w, h):
+        self._width = w
+        self._height = h
+
+    def get_width(self):
+        return self._width
+
+    def set_width(self, width):
+        self._width = width
+
+    def get_height(self):
+        return self._height
+
+    def set_height(self, height):
+        self._height = height
+
+    def copy(self):
+        """
+        Return a copy of writing.
+
+        @rtype: L{CompactWriting}
+        """
+        c = CompactWriting()
+        c._width = self._width
+        c._height = self._height
+        c._coords = array("d", self._coords)
+        c._offsets = array("I", self._offsets)
+        c._smoothed = array("B", self._smoothed)
+        return c
+
+    def __eq__(self, othr):
+        if not hasattr(othr, "get_strokes") or \
+           not hasattr(othr, "get_size"):
+            return False
+
+        return self.get_size() == othr.get_size() and \
+               self.get_strokes() == othr.get_strokes()
+
+    def __ne__(self, othr):
+        return not(self == othr)
+
+    def __repr__(self):
+        return "<CompactWriting %d strokes (ref %d)>" % (self.get_n_strokes(),
+                                                         id(self))
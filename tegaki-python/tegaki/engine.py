@@ -17,15 +17,129 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import os
+import sys
+import glob
+import imp
+import json
 import platform
 
 from tegaki.dictutils import SortedDict
 
+#: Name of the index file that can be created in engine and model directories
+#: at install time, see L{Engine.build_index}.
+INDEX_FILE = "tegaki.index"
+
+# engine modules loaded so far, by path
+_engine_modules = {}
+
+def _load_engine_module(path):
+    # engine modules are loaded only once, by the first engine which needs it
+    if not path in _engine_modules:
+        module_name = os.path.basename(path).replace(".py", "") + "engine"
+        _engine_modules[path] = imp.load_source(module_name, path)
+    return _engine_modules[path]
+
+def _read_index_file(path):
+    try:
+        f = open(path)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return None
+
+def _write_index_file(path, index):
+    # the file is written atomically since several processes may share it
+    tmp_path = "%s.%d" % (path, os.getpid())
+    f = open(tmp_path, "w")
+    try:
+        json.dump(index, f)
+    finally:
+        f.close()
+    os.replace(tmp_path, path)
+
+class _EngineRef(object):
+    """
+    Reference to an engine class whose module is not loaded yet.
+    """
+
+    def __init__(self, path, attr):
+        self.path = path
+        self.attr = attr
+
+    def load(self):
+        return getattr(_load_engine_module(self.path), self.attr)
+
+class _EngineDict(SortedDict):
+    """
+    A dict of engine classes whose modules are only loaded when a class is
+    actually retrieved.
+    """
+
+    def __getitem__(self, key):
+        value = SortedDict.__getitem__(self, key)
+        if isinstance(value, _EngineRef):
+            try:
+                value = value.load()
+            except AttributeError:
+                # the index is out of date
+                # (e.g., the library used by the engine was removed)
+                Engine._forget_directory(os.path.dirname(value.path),
+                                         "engines")
+                del self[key]
+                raise KeyError(key)
+            SortedDict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def iteritems(self):
+        for key in self.keys():
+            try:
+                yield key, self[key]
+            except KeyError:
+                pass
+
 class Engine(object):
     """
     Base class for Recognizer and Trainer.
+
+    Engines and models are found by scanning the directories of the search
+    path. So as to avoid importing every engine module and reading every
+    .meta file each time, what is found in a directory is cached in
+    ~/.tegaki/cache/index until the directory is modified. Directories
+    can also be indexed at install time with L{build_index}.
     """
 
+    # the contents of ~/.tegaki/cache/index
+    _user_index = None
+
+    @classmethod
+    def _get_user_dir(cls, what):
+        try:
+            # UNIX
+            homedir = os.environ['HOME']
+            return homedir, os.path.join(homedir, ".tegaki", what)
+        except KeyError:
+            # Windows
+            homedir = os.environ['USERPROFILE']
+            return homedir, os.path.join(homedir, "tegaki", what)
+
     @classmethod
     def _get_search_path(cls, what):
         """
@@ -36,14 +150,7 @@ class Engine(object):
         """
         libdir = os.path.dirname(os.path.abspath(__file__))
 
-        try:
-            # UNIX
-            homedir = os.environ['HOME']
-            homeengines = os.path.join(homedir, ".tegaki", what)
-        except KeyError:
-            # Windows
-            homedir = os.environ['USERPROFILE']
-            homeengines = os.path.join(homedir, "tegaki", what)
+        homedir, homeengines = cls._get_user_dir(what)
 
         search_path = [# For Unix
                        "/usr/local/share/tegaki/%s/" % what,
@@ -105,3 +212,168 @@ class Engine(object):
                 continue
         f.close()
         return ret
+
+    @classmethod
+    def _get_user_index_path(cls):
+        return os.path.join(cls._get_user_dir("cache")[1], "index")
+
+    @classmethod
+    def _get_user_index(cls):
+        if Engine._user_index is None:
+            index = _read_index_file(cls._get_user_index_path())
+            if not isinstance(index, dict):
+                index = {}
+            Engine._user_index = index
+        return Engine._user_index
+
+    @classmethod
+    def _save_user_index(cls):
+        path = cls._get_user_index_path()
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            _write_index_file(path, cls._get_user_index())
+        except (IOError, OSError):
+            pass # the cache is only an optimization
+
+    @classmethod
+    def _forget_directory(cls, directory, what):
+        index = cls._get_user_index()
+        if directory in index.get(what, {}):
+            del index[what][directory]
+            cls._save_user_index()
+
+    @classmethod
+    def _scan_engine_file(cls, path):
+        module = _load_engine_module(path)
+        entry = {"file": os.path.basename(path)}
+
+        try:
+            entry["recognizer"] = module.RECOGNIZER_CLASS.RECOGNIZER_NAME
+        except AttributeError:
+            entry["recognizer"] = None
+
+        try:
+            entry["trainer"] = module.TRAINER_CLASS.TRAINER_NAME
+        except AttributeError:
+            entry["trainer"] = None
+
+        return entry
+
+    @classmethod
+    def _scan_directory(cls, directory, what):
+        """
+        Return the entries of an engine or model directory.
+
+        Engine entries are dicts with file, recognizer and trainer keys,
+        model entries are dicts with file and meta keys.
+        """
+        entries = []
+
+        if what == "engines":
+            for f in sorted(glob.glob(os.path.join(directory, "*.py"))):
+                if f.endswith("__init__.py") or f.endswith("setup.py"):
+                    continue
+
+                entries.append(cls._scan_engine_file(f))
+        else:
+            for f in sorted(glob.glob(os.path.join(directory, "*.meta"))):
+                meta = cls.read_meta_file(f)
+                entries.append({"file": os.path.basename(f),
+                                "meta": list(meta.items())})
+
+        return entries
+
+    @classmethod
+    def _get_directory_entries(cls, directory, what):
+        """
+        Return the entries of an engine or model directory (see
+        L{_scan_directory}), from an index if it is up to date.
+        """
+        mtime = os.stat(directory).st_mtime
+
+        index = _read_index_file(os.path.join(directory, INDEX_FILE))
+        if isinstance(index, dict) and index.get("mtime") == mtime and \
+           what in index:
+            return cls._update_entries(directory, what, index[what])
+
+        user_index = cls._get_user_index().setdefault(what, {})
+        index = user_index.get(directory)
+        if isinstance(index, dict) and index.get("mtime") == mtime:
+            entries = cls._update_entries(directory, what, index["entries"])
+            if entries != index["entries"]:
+                index["entries"] = entries
+                cls._save_user_index()
+            return entries
+
+        entries = cls._scan_directory(directory, what)
+        user_index[directory] = {"mtime": mtime, "entries": entries}
+        cls._save_user_index()
+        return entries
+
+    @classmethod
+    def _update_entries(cls, directory, what, entries):
+        # Modules which provide no engine are usually missing a library,
+        # which may have been installed since then: check them again.
+        # Failing imports are cheap anyway.
+        if what != "engines":
+            return entries
+
+        ret = []
+        for entry in entries:
+            if entry["recognizer"] is None and entry["trainer"] is None:
+                entry = cls._scan_engine_file(os.path.join(directory,
+                                                           entry["file"]))
+            ret.append(entry)
+        return ret
+
+    @classmethod
+    def _get_engine_entries(cls):
+        """
+        Return (path, entry) tuples for all the engine modules of the search
+        path.
+        """
+        ret = []
+        for directory in cls._get_search_path("engines"):
+            if not os.path.isdir(directory):
+                continue
+
+            for entry in cls._get_directory_entries(directory, "engines"):
+                ret.append((os.path.join(directory, entry["file"]), entry))
+        return ret
+
+    @classmethod
+    def build_index(cls, directory, what):
+        """
+        Write an index of an engine or model directory in the directory
+        itself.
+
+        @type directory: str
+        @param directory: the directory to index
+
+        @type what: str
+        @param what: "engines" or "models"
+
+        This is meant to be used at install time, when the directory is not
+        writable by users. The index is used until the directory is
+        modified.
+        """
+        path = os.path.join(directory, INDEX_FILE)
+        # create the file first as it changes the directory mtime
+        _write_index_file(path, {})
+        entries = cls._scan_directory(directory, what)
+        f = open(path, "w")
+        try:
+            json.dump({"mtime": os.stat(directory).st_mtime, what: entries}, f)
+        finally:
+            f.close()
+
+if __name__ == "__main__":
+    # e.g. python -m tegaki.engine engines /usr/share/tegaki/engines
+    if len(sys.argv) < 3 or not sys.argv[1] in ("engines", "models"):
+        sys.stderr.write("usage: %s engines|models directories\n" % \
+                            sys.argv[0])
+        sys.exit(1)
+
+    for directory in sys.argv[2:]:
+        Engine.build_index(directory, sys.argv[1])
@@ -74,7 +74,8 @@ try:
             zinnia_char = zinnia.Character()
 
             for set_name in charcol.get_set_list():
-                for character in charcol.get_characters(set_name):      
+                for character in charcol.get_characters_gen(set_name,
+                                                            read_only=True):
                     if (not zinnia_char.parse(character.to_sexp())):
                         raise TrainerError(zinnia_char.what())
                     else:
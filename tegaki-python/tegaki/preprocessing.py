@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Vectorized preprocessing of handwriting.
+
+L{WritingBatch} holds the points of one or more writings in a single NumPy
+array and applies the preprocessing steps of L{Writing} (normalize,
+downsample, upsample, smooth) to all of them at once. Results are identical
+to the ones obtained by calling the L{Writing} methods on each writing.
+
+>>> batch = WritingBatch.from_writings(writings)
+>>> batch.normalize()
+>>> batch.downsample_threshold(50)
+>>> writings = batch.to_writings()
+
+NumPy is required. If it is not installed, NotImplementedError is raised.
+"""
+
+from math import atan, cos, sin
+
+try:
+    import numpy as np
+except ImportError:
+    pass
+
+from tegaki.character import Point, Stroke, Writing
+
+class WritingBatch(object):
+    """
+    Points of several writings stored in contiguous arrays.
+
+    points[k] are the (x,y) coordinates of the k-th point.
+    Stroke s spans the points stroke_offsets[s] to stroke_offsets[s+1] - 1.
+    Writing w spans the strokes writing_offsets[w] to writing_offsets[w+1] - 1.
+    """
+
+    def __init__(self, points, stroke_offsets, writing_offsets,
+                       widths, heights, smoothed=None):
+        try:
+            np
+        except NameError:
+            raise NotImplementedError
+
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.stroke_offsets = np.asarray(stroke_offsets, dtype=np.intp)
+        self.writing_offsets = np.asarray(writing_offsets, dtype=np.intp)
+        self.widths = np.asarray(widths, dtype=np.float64)
+        self.heights = np.asarray(heights, dtype=np.float64)
+
+        if smoothed is None:
+            smoothed = np.zeros(self.get_n_strokes(), dtype=bool)
+        self.smoothed = np.asarray(smoothed, dtype=bool)
+
+    @classmethod
+    def from_writings(cls, writings):
+        """
+        Create a batch from a list of L{Writing} objects.
+        """
+        coords = []
+        sizes = [0]
+        n_strokes = [0]
+        smoothed = []
+
+        for writing in writings:
+            strokes = writing.get_strokes(full=True)
+            n_strokes.append(len(strokes))
+            for stroke in strokes:
+                sizes.append(len(stroke))
+                smoothed.append(stroke.get_is_smoothed())
+                for p in stroke:
+                    coords.append(p.x)
+                    coords.append(p.y)
+
+        return cls(coords,
+                   np.cumsum(sizes),
+                   np.cumsum(n_strokes),
+                   [w.get_width() for w in writings],
+                   [w.get_height() for w in writings],
+                   smoothed)
+
+    @classmethod
+    def from_writing(cls, writing):
+        """
+        Create a batch containing only one L{Writing}.
+        """
+        return cls.from_writings([writing])
+
+    def get_n_writings(self):
+        return len(self.writing_offsets) - 1
+
+    def get_n_strokes(self):
+        return len(self.stroke_offsets) - 1
+
+    def get_n_points(self):
+        return len(self.points)
+
+    def get_stroke_sizes(self):
+        return np.diff(self.stroke_offsets)
+
+    def get_strokes(self, i):
+        """
+        Return the strokes of the ith writing as lists of (x,y) pairs,
+        like L{Writing.get_strokes}.
+        """
+        so = self.stroke_offsets
+        ints = np.trunc(self.points).astype(np.int64).tolist()
+        return [[tuple(p) for p in ints[so[s]:so[s+1]]] \
+                    for s in range(self.writing_offsets[i],
+                                   self.writing_offsets[i+1])]
+
+    def to_writings(self):
+        """
+        Convert the batch back to a list of L{Writing} objects.
+        """
+        writings = []
+        so = self.stroke_offsets
+        wo = self.writing_offsets
+        coords = self.points.tolist()
+
+        for w in range(self.get_n_writings()):
+            writing = Writing()
+            writing.set_width(_to_number(self.widths[w]))
+            writing.set_height(_to_number(self.heights[w]))
+
+            for s in range(wo[w], wo[w+1]):
+                stroke = Stroke()
+                stroke.append_points([Point(_to_number(x), _to_number(y)) \
+                                         for x, y in coords[so[s]:so[s+1]]])
+                stroke._is_smoothed = bool(self.smoothed[s])
+                writing.append_stroke(stroke)
+
+            writings.append(writing)
+
+        return writings
+
+    # Internal helpers
+
+    def _get_point_stroke_ids(self):
+        # the stroke each point belongs to
+        return np.repeat(np.arange(self.get_n_strokes()),
+                         self.get_stroke_sizes())
+
+    def _get_point_local_ids(self):
+        # the index of each point within its stroke
+        starts = np.repeat(self.stroke_offsets[:-1], self.get_stroke_sizes())
+        return np.arange(self.get_n_points()) - starts
+
+    def _get_point_writing_ids(self):
+        # the writing each point belongs to
+        n_points = np.diff(self.stroke_offsets[self.writing_offsets])
+        return np.repeat(np.arange(self.get_n_writings()), n_points)
+
+    def _get_writing_sizes(self):
+        # (x, y, width, height) for each writing with at least one point
+        pstarts = self.stroke_offsets[self.writing_offsets]
+        counts = np.diff(pstarts)
+        nonempty = counts > 0
+        starts = pstarts[:-1][nonempty]
+
+        # same initial values as Writing.size
+        xs = self.points[:,0]
+        ys = self.points[:,1]
+        xmin = np.minimum(np.minimum.reduceat(xs, starts), 4294967296)
+        xmax = np.maximum(np.maximum.reduceat(xs, starts), 0)
+        ymin = np.minimum(np.minimum.reduceat(ys, starts), 4294967296)
+        ymax = np.maximum(np.maximum.reduceat(ys, starts), 0)
+
+        return nonempty, xmin, ymin, xmax - xmin, ymax - ymin
+
+    def _set_points(self, keep_or_points, sizes):
+        sizes = np.asarray(sizes)
+        changed = sizes > 0
+        self.smoothed[changed] = False
+        self.points = keep_or_points
+        self.stroke_offsets = np.concatenate(([0], np.cumsum(sizes)))
+
+    # Public API
+
+    def normalize(self):
+        """
+        See L{Writing.normalize}.
+        """
+        self.normalize_size()
+        self.normalize_position()
+
+    def normalize_size(self):
+        """
+        See L{Writing.normalize_size}.
+        """
+        if self.get_n_points() == 0:
+            return
+
+        nonempty, x, y, width, height = self._get_writing_sizes()
+        canvas_w = self.widths[nonempty]
+        canvas_h = self.heights[nonempty]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            xrate = np.where(width / canvas_w > Writing.NORMALIZE_MIN_SIZE,
+                             canvas_w * Writing.NORMALIZE_PROPORTION / width,
+                             1.0)
+            yrate = np.where(height / canvas_h > Writing.NORMALIZE_MIN_SIZE,
+                             canvas_h * Writing.NORMALIZE_PROPORTION / height,
+                             1.0)
+
+        wids = np.cumsum(nonempty) - 1
+        pw = wids[self._get_point_writing_ids()]
+        self.points[:,0] = np.trunc(self.points[:,0] * xrate[pw])
+        self.points[:,1] = np.trunc(self.points[:,1] * yrate[pw])
+
+    def normalize_position(self):
+        """
+        See L{Writing.normalize_position}.
+        """
+        if self.get_n_points() == 0:
+            return
+
+        nonempty, x, y, width, height = self._get_writing_sizes()
+
+        dx = (self.widths[nonempty] - width) / 2 - x
+        dy = (self.heights[nonempty] - height) / 2 - y
+
+        wids = np.cumsum(nonempty) - 1
+        pw = wids[self._get_point_writing_ids()]
+        self.points[:,0] += dx[pw]
+        self.points[:,1] += dy[pw]
+
+    def downsample(self, n):
+        """
+        See L{Writing.downsample}.
+        """
+        keep = self._get_point_local_ids() % n == 0
+        sizes = np.bincount(self._get_point_stroke_ids()[keep],
+                            minlength=self.get_n_strokes())
+        self._set_points(self.points[keep], sizes)
+
+    def downsample_threshold(self, threshold, window=64):
+        """
+        See L{Writing.downsample_threshold}.
+
+        Kept points depend on the previously kept point, therefore
+        strokes are processed sequentially. Distances are computed
+        by blocks of window points.
+        """
+        points = self.points
+        so = self.stroke_offsets
+        indices = []
+        sizes = []
+
+        for s in range(self.get_n_strokes()):
+            start, end = so[s], so[s+1]
+
+            if start == end:
+                sizes.append(0)
+                continue
+
+            kept = [start]
+            last = start
+            # same candidate points as Stroke.downsample_threshold
+            cand_end = end - 2
+            i = start + 1
+
+            while i < cand_end:
+                j = min(i + window, cand_end)
+                d = points[i:j] - points[last]
+                dist = np.sqrt(d[:,0] * d[:,0] + d[:,1] * d[:,1])
+                over = np.flatnonzero(dist > threshold)
+                if len(over) == 0:
+                    i = j
+                else:
+                    last = i + over[0]
+                    kept.append(last)
+                    i = last + 1
+
+            kept.append(end - 1)
+            indices.extend(kept)
+            sizes.append(len(kept))
+
+        self._set_points(points[np.array(indices, dtype=np.intp)], sizes)
+
+    def upsample(self, n):
+        """
+        See L{Writing.upsample}.
+        """
+        self._upsample(lambda d: np.full(len(d), n, dtype=np.float64))
+
+    def upsample_threshold(self, threshold):
+        """
+        See L{Writing.upsample_threshold}.
+        """
+        self._upsample(lambda d: np.floor(d / threshold - 1))
+
+    def _upsample(self, func):
+        n_points = self.get_n_points()
+
+        if n_points == 0:
+            return
+
+        points = self.points
+        sizes = self.get_stroke_sizes()
+
+        # a segment starts at every point which is not the last of its stroke
+        is_last = np.zeros(n_points, dtype=bool)
+        is_last[self.stroke_offsets[1:][sizes > 0] - 1] = True
+        seg = np.flatnonzero(~is_last)
+
+        p1 = points[seg]
+        p2 = points[seg + 1]
+        dx = p2[:,0] - p1[:,0]
+        dy = p2[:,1] - p1[:,1]
+
+        # trigonometric functions are computed with the math module
+        # so as to give the very same results as Stroke._upsample
+        cosalpha = np.zeros(len(seg))
+        sinalpha = np.ones(len(seg))
+        for k in np.flatnonzero(dx != 0).tolist():
+            alpha = atan(float(abs(dy[k])) / abs(dx[k]))
+            cosalpha[k] = cos(alpha)
+            sinalpha[k] = sin(alpha)
+
+        d = np.sqrt(dx * dx + dy * dy)
+        n = np.maximum(func(d), 0).astype(np.intp)
+
+        # number of points added after each point
+        added = np.zeros(n_points, dtype=np.intp)
+        added[seg] = n
+
+        # new position of original points
+        pos = np.arange(n_points) + np.concatenate(([0], np.cumsum(added)[:-1]))
+
+        new = np.empty((n_points + added.sum(), 2), dtype=np.float64)
+        new[pos] = points
+
+        # interpolated points
+        segk = np.repeat(np.arange(len(seg)), n)
+        if len(segk) > 0:
+            first = np.concatenate(([0], np.cumsum(n)[:-1]))
+            j = (np.arange(len(segk)) - first[segk] + 1).astype(np.float64)
+            nk = n[segk]
+            sx = cosalpha[segk] * 1.0 / (nk + 1) * d[segk]
+            sy = sinalpha[segk] * 1.0 / (nk + 1) * d[segk]
+            signx = np.sign(dx[segk])
+            signy = np.sign(dy[segk])
+            ipos = pos[seg][segk] + j.astype(np.intp)
+            new[ipos, 0] = np.trunc(p1[segk, 0] + j * sx * signx)
+            new[ipos, 1] = np.trunc(p1[segk, 1] + j * sy * signy)
+
+        stroke_ids = self._get_point_stroke_ids()
+        new_sizes = sizes + np.bincount(stroke_ids, weights=added,
+                                        minlength=len(sizes)).astype(np.intp)
+
+        self._set_points(new, new_sizes)
+
+    def smooth(self, weights=(1, 1, 2, 1, 1), times=3):
+        """
+        See L{Writing.smooth}.
+        """
+        sizes = self.get_stroke_sizes()
+        eligible = (~self.smoothed) & (sizes >= len(weights))
+
+        if not eligible.any():
+            return
+
+        offset = len(weights) // 2
+        wsum = sum(weights)
+        local = self._get_point_local_ids()
+        stroke_ids = self._get_point_stroke_ids()
+        mask = eligible[stroke_ids] & (local >= offset) & \
+               (local < sizes[stroke_ids] - offset)
+        idx = np.flatnonzero(mask)
+
+        points = self.points.copy()
+
+        for t in range(times):
+            s = points.copy()
+            acc = np.zeros((len(idx), 2))
+            for j in range(len(weights)):
+                acc = acc + weights[j] * s[idx + j - offset]
+            points[idx] = np.round(acc / wsum)
+
+        self.points = points
+        self.smoothed[eligible] = True
+
+def _to_number(v):
+    # keep integers as int, like points read from XML
+    return int(v) if v == int(v) else v
@@ -19,11 +19,11 @@
 # Contributors to this file:
 # - Mathieu Blondel
 
-import glob
 import os
-import imp
+import threading
+from collections import OrderedDict
 
-from tegaki.engine import Engine
+from tegaki.engine import Engine, _EngineDict, _EngineRef
 from tegaki.dictutils import SortedDict
 
 SMALL_HIRAGANA = {
@@ -89,6 +89,9 @@ class Recognizer(Engine):
         @rtype: dict
         @return: a dict where keys are recognizer names and values \
                  are recognizer classes
+
+        Engine modules are only imported when their class is retrieved from
+        the dict.
         """
         if not "available_recognizers" in cls.__dict__:
             cls._load_available_recognizers()
@@ -96,25 +99,12 @@ class Recognizer(Engine):
 
     @classmethod
     def _load_available_recognizers(cls):
-        cls.available_recognizers  = SortedDict()
-
-        for directory in cls._get_search_path("engines"):
-            if not os.path.exists(directory):
-                continue
-
-            for f in glob.glob(os.path.join(directory, "*.py")):
-                if f.endswith("__init__.py") or f.endswith("setup.py"):
-                    continue
+        cls.available_recognizers  = _EngineDict()
 
-                module_name = os.path.basename(f).replace(".py", "")
-                module_name += "recognizer"
-                module = imp.load_source(module_name, f)
-
-                try:
-                    name = module.RECOGNIZER_CLASS.RECOGNIZER_NAME
-                    cls.available_recognizers[name] = module.RECOGNIZER_CLASS
-                except AttributeError:
-                    pass       
+        for path, entry in cls._get_engine_entries():
+            if entry["recognizer"] is not None:
+                cls.available_recognizers[entry["recognizer"]] = \
+                    _EngineRef(path, "RECOGNIZER_CLASS")
 
     @staticmethod
     def get_all_available_models():
@@ -125,8 +115,10 @@ class Recognizer(Engine):
         @return: a list of tuples (recognizer_name, model_name, meta_dict)
         """
         all_models = []
-        for r_name, klass in list(Recognizer.get_available_recognizers().items()):
-            for model_name, meta in list(klass.get_available_models().items()):
+        # no need to import the recognizers
+        for r_name in Recognizer.get_available_recognizers().keys():
+            models = Recognizer._get_cached_models(r_name)
+            for model_name, meta in list(models.items()):
                 all_models.append([r_name, model_name, meta])
         return all_models
 
@@ -142,9 +134,19 @@ class Recognizer(Engine):
             return cls.available_models
         else:
             name = cls.RECOGNIZER_NAME
-            cls.available_models = cls._get_available_models(name)
+            cls.available_models = Recognizer._get_cached_models(name)
             return cls.__dict__["available_models"]
 
+    # available models by recognizer name
+    _models = {}
+
+    @staticmethod
+    def _get_cached_models(recognizer):
+        if not recognizer in Recognizer._models:
+            Recognizer._models[recognizer] = \
+                Recognizer._get_available_models(recognizer)
+        return Recognizer._models[recognizer]
+
     @classmethod
     def _get_available_models(cls, recognizer):
         available_models = SortedDict()
@@ -152,13 +154,12 @@ class Recognizer(Engine):
         for directory in cls._get_search_path("models"):
             directory = os.path.join(directory, recognizer)
 
-            if not os.path.exists(directory):
+            if not os.path.isdir(directory):
                 continue
 
-            meta_files = glob.glob(os.path.join(directory, "*.meta"))
-
-            for meta_file in meta_files:
-                meta = Recognizer.read_meta_file(meta_file)
+            for entry in cls._get_directory_entries(directory, "models"):
+                meta_file = os.path.join(directory, entry["file"])
+                meta = SortedDict(entry["meta"])
 
                 if "name" not in meta or \
                     "shortname" not in meta:
@@ -257,6 +258,194 @@ class Recognizer(Engine):
         else:
             return results
 
+    def recognize_batch(self, writings, n=10):
+        """
+        Recognizes several handwritings at once.
+
+        @type writings: list of L{Writing}
+        @param writings: the handwritings to recognize
+
+        @type n: int
+        @param n: the number of candidates to return for each writing
+
+        @rtype: list
+        @return: a list of results, as returned by L{recognize}, \
+                 in the same order as writings
+
+        Recognizers may override L{_recognize_batch} to process all the
+        writings in one go, which avoids the per-call overhead.
+        """
+        if self._lang == "ja":
+            is_small = [writing.is_small() for writing in writings]
+        else:
+            is_small = [False] * len(writings)
+
+        all_results = self._recognize_batch(writings, n)
+
+        return [results.to_small_kana() if small else results \
+                    for results, small in zip(all_results, is_small)]
+
+    def _recognize_batch(self, writings, n=10):
+        return [self._recognize(writing, n) for writing in writings]
+
+
+class RecognizerRegistry(object):
+    """
+    Process-wide cache of recognizers with their model already opened.
+
+    Opening a model usually takes much longer than recognizing a character.
+    Long-running processes (web views, servers...) should therefore get
+    their recognizers from the registry rather than instantiating them and
+    calling L{Recognizer.set_model} each time.
+
+    Recognizers are keyed by (recognizer name, model name, options). When
+    there are more than max_models recognizers or when their models take
+    more than max_memory bytes, the least recently used ones are dropped.
+    The memory used by a model is estimated from the size of its file.
+
+    Recognizers handed out by the registry are shared: they must not be
+    modified (set_model, set_options...) by the caller.
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_models=4, max_memory=None):
+        """
+        @type max_models: int
+        @param max_models: maximum number of opened models
+
+        @type max_memory: int
+        @param max_memory: maximum memory used by opened models, in bytes \
+                           (None means no limit)
+        """
+        self.max_models = max_models
+        self.max_memory = max_memory
+        # key => (recognizer, size), least recently used first
+        self._recognizers = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_default(cls):
+        """
+        Return the registry shared by the whole process.
+
+        @rtype: L{RecognizerRegistry}
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    @staticmethod
+    def _get_key(recognizer_name, model_name, options):
+        if options is None:
+            options = {}
+        return (recognizer_name, model_name, tuple(sorted(options.items())))
+
+    def get_recognizer(self, recognizer_name, model_name, options=None):
+        """
+        Return a recognizer with the given model opened.
+
+        @type recognizer_name: str
+        @param recognizer_name: name of the recognizer (e.g. "zinnia")
+
+        @type model_name: str
+        @param model_name: name of the model (e.g. "Simplified Chinese")
+
+        @type options: dict
+        @param options: options to pass to L{Recognizer.set_options} after \
+                        the model is set
+
+        @rtype: L{Recognizer}
+
+        Raises RecognizerError if the recognizer or the model doesn't exist.
+        """
+        key = self._get_key(recognizer_name, model_name, options)
+
+        with self._lock:
+            if key in self._recognizers:
+                self._recognizers.move_to_end(key)
+                return self._recognizers[key][0]
+
+        # Don't hold the lock while the model is being opened, so that
+        # recognizers which are already loaded can still be retrieved.
+        recognizer, size = self._open(recognizer_name, model_name, options)
+
+        with self._lock:
+            if key in self._recognizers:
+                # opened concurrently by another thread
+                self._recognizers.move_to_end(key)
+                return self._recognizers[key][0]
+
+            self._recognizers[key] = (recognizer, size)
+            self._evict()
+
+        return recognizer
+
+    def _open(self, recognizer_name, model_name, options):
+        recognizers = Recognizer.get_available_recognizers()
+
+        if not recognizer_name in recognizers:
+            raise RecognizerError("Recognizer does not exist")
+
+        klass = recognizers[recognizer_name]
+        recognizer = klass()
+        recognizer.set_model(model_name)
+
+        if options:
+            recognizer.set_options(options)
+
+        try:
+            size = os.path.getsize(klass.get_available_models()[model_name]
+                                   ["path"])
+        except (OSError, KeyError):
+            size = 0
+
+        return recognizer, size
+
+    def _evict(self):
+        # The most recently used recognizer is always kept, even if its
+        # model alone is larger than max_memory.
+        while len(self._recognizers) > 1 and \
+              (len(self._recognizers) > self.max_models or \
+               (self.max_memory is not None and \
+                self._get_memory_usage() > self.max_memory)):
+            self._recognizers.popitem(last=False)
+
+    def _get_memory_usage(self):
+        return sum([size for recognizer, size in self._recognizers.values()])
+
+    def get_memory_usage(self):
+        """
+        Return the estimated memory used by opened models, in bytes.
+
+        @rtype: int
+        """
+        with self._lock:
+            return self._get_memory_usage()
+
+    def get_recognizer_keys(self):
+        """
+        Return the keys of cached recognizers, least recently used first.
+
+        @rtype: list of tuples
+        @return: (recognizer name, model name, options) tuples
+        """
+        with self._lock:
+            return list(self._recognizers.keys())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._recognizers)
+
+    def clear(self):
+        """
+        Drop all cached recognizers.
+        """
+        with self._lock:
+            self._recognizers.clear()
+
 
 if __name__ == "__main__":
     import sys
@@ -19,12 +19,10 @@
 # Contributors to this file:
 # - Mathieu Blondel
 
-import glob
 import os
-import imp
 from io import StringIO
 
-from tegaki.engine import Engine
+from tegaki.engine import Engine, _EngineDict, _EngineRef
 from tegaki.dictutils import SortedDict
 
 class TrainerError(Exception):
@@ -58,25 +56,12 @@ class Trainer(Engine):
 
     @classmethod
     def _load_available_trainers(cls):
-        cls.available_trainers  = SortedDict()
+        cls.available_trainers  = _EngineDict()
 
-        for directory in cls._get_search_path("engines"):
-            if not os.path.exists(directory):
-                continue
-
-            for f in glob.glob(os.path.join(directory, "*.py")):
-                if f.endswith("__init__.py") or f.endswith("setup.py"):
-                    continue
-
-                module_name = os.path.basename(f).replace(".py", "")
-                module_name += "trainer"
-                module = imp.load_source(module_name, f)
-
-                try:
-                    name = module.TRAINER_CLASS.TRAINER_NAME
-                    cls.available_trainers[name] = module.TRAINER_CLASS
-                except AttributeError:
-                    pass         
+        for path, entry in cls._get_engine_entries():
+            if entry["trainer"] is not None:
+                cls.available_trainers[entry["trainer"]] = \
+                    _EngineRef(path, "TRAINER_CLASS")
 
     def set_options(self, options):
         """
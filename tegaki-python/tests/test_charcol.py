@@ -23,6 +23,10 @@ import unittest
 import os
 import sys
 import io
+import tempfile
+import shutil
+import gzip
+import sqlite3
 
 from tegaki.character import Point, Stroke, Writing, Character
 from tegaki.charcol import CharacterCollection
@@ -314,3 +318,360 @@ class CharacterCollectionTest(unittest.TestCase):
     def testRemoveEmptySets(self):
         self.cc.remove_empty_sets()
         self.assertEqual(self.cc.get_set_list(), ["一", "三", "二"])
+
+class CharacterCollectionDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _get_collection(self, sizes):
+        charcol = CharacterCollection()
+        for set_name, n in sizes:
+            charcol.add_set(set_name)
+            for i in range(n):
+                writing = Writing()
+                writing.move_to(i, i)
+                writing.line_to(i + 10, i + 10)
+                if i % 2 == 1:
+                    writing.move_to(i, 0)
+                    writing.line_to(i, 10)
+                char = Character()
+                char.set_utf8(set_name)
+                char.set_writing(writing)
+                charcol.append_character(set_name, char)
+        return charcol
+
+    def testGetCharsGenInterleaved(self):
+        charcol = self._get_collection([("a", 3), ("b", 2)])
+        charcol.FETCH_SIZE = 1
+        all_ = charcol.get_all_characters()
+        chars = []
+        for char in charcol.get_all_characters_gen():
+            # other queries must not disturb the iteration
+            self.assertEqual(charcol.get_n_sets(), 2)
+            self.assertEqual(len(charcol.get_characters("a")), 3)
+            chars.append(char)
+        self.assertEqual(chars, all_)
+
+        gen1 = charcol.get_characters_gen("a")
+        gen2 = charcol.get_characters_gen("b")
+        self.assertEqual(next(gen1), all_[0])
+        self.assertEqual(next(gen2), all_[3])
+        self.assertEqual(next(gen1), all_[1])
+        self.assertEqual(list(gen2), all_[4:5])
+        self.assertEqual(list(gen1), all_[2:3])
+
+    def testGetRandomChars(self):
+        charcol = self._get_collection([("a", 3), ("b", 2)])
+        all_ = charcol.get_all_characters()
+        chars = charcol.get_random_characters(4)
+        self.assertEqual(len(chars), 4)
+        for char in chars:
+            self.assertTrue(char in all_)
+        self.assertEqual(len(charcol.get_random_characters(10)), 5)
+
+    def testSaveDb(self):
+        charcol = self._get_collection([("a", 3), ("b", 2), ("c", 0)])
+        all_ = charcol.get_all_characters()
+        path = os.path.join(self.tmpdir, "test.chardb")
+        charcol.save(path)
+        self.assertEqual(charcol.get_db_filename(), path)
+
+        charcol2 = CharacterCollection(path)
+        self.assertEqual(charcol2.get_set_list(), ["a", "b", "c"])
+        self.assertEqual(charcol2.get_all_characters(), all_)
+
+    def testMergeDb(self):
+        charcols = [self._get_collection([("a", 3), ("b", 2)]),
+                    self._get_collection([("c", 1), ("a", 2)])]
+        expected = CharacterCollection()
+        expected.merge(charcols)
+
+        for i, charcol in enumerate(charcols):
+            charcol.save(os.path.join(self.tmpdir, "%d.chardb" % i))
+
+        for path in (":memory:", os.path.join(self.tmpdir, "merged.chardb")):
+            merged = CharacterCollection(path)
+            merged.merge(charcols)
+            self.assertEqual(merged.get_set_list(), ["a", "b", "c"])
+            self.assertEqual(merged.get_all_characters(),
+                             expected.get_all_characters())
+            self.assertEqual(merged.get_set_sizes(),
+                             {"a" : 5, "b" : 2, "c" : 1})
+
+    def testMergeDuplicate(self):
+        charcol1 = self._get_collection([("a", 3), ("b", 2)])
+        charcol2 = self._get_collection([("c", 1), ("a", 4)])
+        # duplicates within the merged collection
+        charcol2.append_characters("c", charcol2.get_characters("c"))
+
+        for path in (None, os.path.join(self.tmpdir, "test.chardb")):
+            if path:
+                charcol2.save(path)
+            merged = CharacterCollection()
+            merged.merge([charcol1])
+            merged.merge([charcol2], check_duplicate=True)
+            self.assertEqual(merged.get_set_sizes(),
+                             {"a" : 4, "b" : 2, "c" : 1})
+            self.assertEqual(merged.get_characters("a"),
+                             charcol1.get_characters("a") +
+                             charcol2.get_characters("a")[3:])
+
+    def testDedupe(self):
+        charcol = self._get_collection([("a", 3), ("b", 2)])
+        all_ = charcol.get_all_characters()
+        charcol.append_characters("a", charcol.get_characters("a")[1:])
+        charcol.append_characters("b", charcol.get_characters("b"))
+        # same character but in another set
+        charcol.append_characters("b", charcol.get_characters("a")[0:1])
+        self.assertEqual(charcol.get_total_n_characters(), 10)
+        self.assertEqual(charcol.dedupe(), 4)
+        self.assertEqual(charcol.get_set_sizes(), {"a" : 3, "b" : 3})
+        self.assertEqual(charcol.get_characters("a"), all_[0:3])
+        self.assertEqual(charcol.dedupe(), 0)
+
+    def _write_gzip(self, path, char):
+        f = gzip.open(path, "wb")
+        f.write(char.to_xml().encode("utf-8"))
+        f.close()
+
+    def testImportCharDir(self):
+        charcol = self._get_collection([("a", 3), ("b", 2)])
+        all_ = charcol.get_all_characters()
+        os.makedirs(os.path.join(self.tmpdir, "sub"))
+        for i, char in enumerate(all_):
+            path = os.path.join(self.tmpdir, "sub" if i >= 3 else "",
+                                "%d.xml.gz" % i)
+            self._write_gzip(path, char)
+        # duplicate
+        self._write_gzip(os.path.join(self.tmpdir, "sub", "9.xml.gz"), all_[0])
+
+        writings = [char.get_writing() for char in all_]
+
+        def get_writings(charcol):
+            return [char.get_writing() for char in charcol.get_all_characters()]
+
+        for n_processes in (1, 2):
+            imported = CharacterCollection.from_character_directory(
+                                        self.tmpdir, ["gz"],
+                                        n_processes=n_processes)
+            self.assertEqual(imported.get_n_sets(), 2)
+            self.assertEqual(get_writings(imported), writings + writings[0:1])
+
+            imported = CharacterCollection.from_character_directory(
+                                        self.tmpdir, ["gz"],
+                                        check_duplicate=True,
+                                        n_processes=n_processes)
+            self.assertEqual(get_writings(imported), writings)
+
+        imported = CharacterCollection()
+        imported.import_character_directory(self.tmpdir, ["gz"],
+                                            recursive=False)
+        self.assertEqual(get_writings(imported), writings[0:3])
+
+    def testProxyWriteBack(self):
+        charcol = self._get_collection([("a", 3)])
+        char = charcol.get_all_characters()[0]
+        self.assertEqual(char.__class__.__name__, "CharacterProxy")
+        stroke = char.get_writing().get_strokes(full=True)[0]
+        stroke[0].x = 5
+        char.set_utf8("b")
+        char.set_utf8("c")
+
+        char2 = charcol.get_all_characters()[0]
+        self.assertEqual(char2.get_utf8(), "c")
+        self.assertEqual(char2.get_writing().get_strokes()[0][0], (5, 0))
+
+    def testReadOnlyChars(self):
+        charcol = self._get_collection([("a", 3)])
+        chars = charcol.get_all_characters(read_only=True)
+        self.assertEqual(chars[0].__class__, Character)
+        self.assertEqual(chars, charcol.get_all_characters())
+
+        for char in chars:
+            char.set_utf8("b")
+        self.assertEqual(charcol.get_utf8_counts(), {"a" : 3})
+
+        charcol.mark_dirty(chars[0])
+        self.assertEqual(charcol.get_utf8_counts(), {"a" : 2, "b" : 1})
+
+        charcol.update_character_objects(chars[1:])
+        self.assertEqual(charcol.get_utf8_counts(), {"b" : 3})
+        self.assertEqual(charcol.get_all_characters(), chars)
+
+        self.assertRaises(ValueError, charcol.mark_dirty, Character())
+
+    def testReadOnlyCollection(self):
+        path = os.path.join(self.tmpdir, "test.chardb")
+        charcol = self._get_collection([("a", 3), ("b", 2)])
+        all_ = charcol.get_all_characters()
+        charcol.save(path)
+
+        charcol = CharacterCollection(path, read_only=True)
+        self.assertTrue(charcol.is_read_only())
+        chars = charcol.get_all_characters()
+        self.assertEqual(chars, all_)
+        self.assertEqual(chars[0].__class__, Character)
+        self.assertRaises(sqlite3.OperationalError, charcol.append_character,
+                          "a", chars[0])
+        self.assertRaises(sqlite3.OperationalError, charcol.add_set, "c")
+
+        charcol = CharacterCollection(read_only=True)
+        self.assertTrue(charcol.is_read_only())
+        self.assertRaises(sqlite3.OperationalError, charcol.add_set, "c")
+
+    def testIndexes(self):
+        charcol = self._get_collection([("a", 3)])
+        rows = charcol._efa("""SELECT name FROM sqlite_master
+WHERE type = 'index'""")
+        names = sorted([row['name'] for row in rows])
+        self.assertEqual(names, ["character_n_strokes_index",
+                                 "character_setid_index",
+                                 "character_setid_sha1_index",
+                                 "character_sha1_index",
+                                 "character_utf8_index"])
+
+    def testGetCharacterInfo(self):
+        charcol = self._get_collection([("a", 3), ("b", 2)])
+        all_ = charcol.get_all_characters()
+        infos = list(charcol.get_character_info_gen())
+        self.assertEqual(len(infos), 5)
+        for char, info in zip(all_, infos):
+            self.assertEqual(sorted(info.keys()),
+                             ["charid", "n_strokes", "setid", "sha1", "utf8"])
+            self.assertEqual(info['charid'], char.charid)
+            self.assertEqual(info['utf8'], char.get_utf8())
+            self.assertEqual(info['n_strokes'],
+                             char.get_writing().get_n_strokes())
+            self.assertEqual(info['sha1'], char.hash())
+
+        infos = list(charcol.get_character_info_gen("b"))
+        self.assertEqual([info['utf8'] for info in infos], ["b", "b"])
+
+    def testGetUtf8Counts(self):
+        charcol = self._get_collection([("a", 3), ("b", 2), ("c", 0)])
+        self.assertEqual(charcol.get_utf8_counts(), {"a" : 3, "b" : 2})
+
+    def testGetNStrokesCounts(self):
+        charcol = self._get_collection([("a", 3), ("b", 2)])
+        self.assertEqual(charcol.get_n_strokes_counts(),
+                         [("a", 1, 2), ("a", 2, 1), ("b", 1, 1), ("b", 2, 1)])
+
+    def testGetSetSizes(self):
+        charcol = self._get_collection([("a", 3), ("b", 2), ("c", 0)])
+        self.assertEqual(charcol.get_set_sizes(), {"a" : 3, "b" : 2, "c" : 0})
+
+    def testGetSetDigests(self):
+        charcol = self._get_collection([("a", 3), ("b", 2), ("c", 0)])
+        digests = charcol.get_set_digests()
+        self.assertEqual(sorted(digests.keys()), ["a", "b", "c"])
+        self.assertEqual(len(set(digests.values())), 3)
+
+        # same contents, same digests
+        charcol2 = self._get_collection([("c", 0), ("b", 2), ("a", 3)])
+        self.assertEqual(charcol2.get_set_digests(), digests)
+
+        char = charcol.get_characters("a")[0]
+        charcol.append_character("b", char)
+        digests2 = charcol.get_set_digests()
+        self.assertEqual(digests2["a"], digests["a"])
+        self.assertNotEqual(digests2["b"], digests["b"])
+
+        charcol.remove_last_character("b")
+        self.assertEqual(charcol.get_set_digests(), digests)
+
+        charcol.remove_set("a")
+        self.assertEqual(charcol.get_set_digests(),
+                         {"b" : digests["b"], "c" : digests["c"]})
+
+    def testRemoveSamples(self):
+        charcol = self._get_collection([("a", 3), ("b", 2), ("c", 1)])
+        first = charcol.get_characters("a")[0:2]
+        charcol.remove_samples(keep_at_most=2)
+        self.assertEqual(charcol.get_set_sizes(), {"a" : 2, "b" : 2, "c" : 1})
+        self.assertEqual(charcol.get_characters("a"), first)
+
+class PackedWritingTest(unittest.TestCase):
+
+    def _get_character(self):
+        s = Stroke()
+        s.append_point(Point(1, 2, timestamp=0))
+        s.append_point(Point(400, 500, timestamp=20, pressure=0.5))
+        s.append_point(Point(70000, -3))
+        w = Writing()
+        w.set_width(1200)
+        w.append_stroke(s)
+        s = Stroke()
+        s.append_point(Point(7, 8))
+        w.append_stroke(s)
+        c = Character()
+        c.set_utf8("一")
+        c.set_writing(w)
+        return c
+
+    def testPackUnpack(self):
+        from tegaki.charcol import _pack_writing, _unpack_writing
+        w = self._get_character().get_writing()
+        self.assertEqual(_unpack_writing(_pack_writing(w)), w)
+        self.assertEqual(_unpack_writing(_pack_writing(Writing())), Writing())
+
+    def testPackUnpackExactValues(self):
+        from tegaki.charcol import _pack_writing, _unpack_writing
+        c = self._get_character()
+        s = c.get_writing().get_strokes(full=True)[1]
+        s.append_point(Point(9, 10, timestamp=2**31, pressure=0.3,
+                             xtilt=0.1, ytilt=-0.7))
+        s.append_point(Point(11, 12, timestamp=-2**31))
+        w = _unpack_writing(_pack_writing(c.get_writing()))
+        self.assertEqual(w, c.get_writing())
+        self.assertEqual(w.get_strokes(full=True)[1][1].pressure, 0.3)
+        self.assertEqual(w.get_strokes(full=True)[1][1].timestamp, 2**31)
+        self.assertEqual(w.get_strokes(full=True)[1][2].timestamp, -2**31)
+        self.assertEqual(w.get_strokes(full=True)[1][0].timestamp, None)
+
+        c2 = Character()
+        c2.set_utf8(c.get_utf8())
+        c2.set_writing(w)
+        self.assertEqual(c2.hash(), c.hash())
+
+    def testUnpackFloat32(self):
+        # writings packed before float values were stored as float64
+        import struct
+        from tegaki.charcol import _unpack_writing, _FLAG_PRESSURE
+        data = struct.pack("<BiiI", _FLAG_PRESSURE, 1000, 1000, 1)
+        data += struct.pack("<I", 1) + struct.pack("<hh", 1, 2)
+        data += struct.pack("<f", 0.5)
+        point = _unpack_writing(data).get_strokes(full=True)[0][0]
+        self.assertEqual((point.x, point.y, point.pressure), (1, 2, 0.5))
+
+    def testPackedCollection(self):
+        c = self._get_character()
+        charcol = CharacterCollection()
+        charcol.WRITE_BACK = False
+        self.assertEqual(charcol.get_schema_version(), 1)
+        charcol.add_set("一")
+        charcol.append_character("一", c)
+        self.assertEqual(charcol.get_all_characters(), [c])
+
+    def testUpgrade(self):
+        c = self._get_character()
+        charcol = CharacterCollection()
+        charcol.WRITE_BACK = False
+        charcol._set_schema_version(0)
+        charcol.add_set("一")
+        charcol.append_character("一", c)
+        self.assertEqual(charcol.get_all_characters()[0].get_writing(),
+                         c.get_writing())
+
+        charcol2 = CharacterCollection()
+        charcol2.merge([charcol])
+        self.assertEqual(charcol2.get_all_characters()[0].get_writing(),
+                         c.get_writing())
+
+        charcol.upgrade()
+        self.assertEqual(charcol.get_schema_version(), 1)
+        self.assertEqual(charcol.get_all_characters()[0].get_writing(),
+                         c.get_writing())
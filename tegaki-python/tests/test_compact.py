@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest
+import random
+import os
+
+from tegaki.character import Point, Stroke, Writing, Character
+from tegaki.compact import CompactWriting
+
+class CompactWritingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.currdir = os.path.dirname(os.path.abspath(__file__))
+        path = os.path.join(self.currdir, "data", "character.xml")
+        f = open(path, "rb")
+        char = Character()
+        char.read_string(f.read())
+        f.close()
+        self.writing = char.get_writing()
+
+        # a single-point stroke
+        stroke = Stroke()
+        stroke.append_point(Point(500, 500))
+        self.writing.append_stroke(stroke)
+
+    def _assertSame(self, writing, cw):
+        self.assertEqual(cw.get_n_strokes(), writing.get_n_strokes())
+        self.assertEqual(cw.get_n_points(), writing.get_n_points())
+        self.assertEqual(cw.get_strokes(), writing.get_strokes())
+        # get_strokes() truncates coordinates, which may hide differences
+        self.assertEqual([s.get_coordinates() \
+                              for s in cw.get_strokes(full=True)],
+                         [s.get_coordinates() \
+                              for s in writing.get_strokes(full=True)])
+        self.assertEqual(cw, writing)
+
+    def _getRandomWritings(self, n):
+        rnd = random.Random(0)
+        writings = []
+        for i in range(n):
+            writing = Writing()
+            # thin writings are not resized by normalize() so they may be
+            # moved by half units
+            width, height = rnd.randint(1, 1000), rnd.randint(1, 1000)
+            for j in range(rnd.randint(1, 4)):
+                stroke = Stroke()
+                for k in range(rnd.randint(1, 30)):
+                    stroke.append_point(Point(rnd.randint(0, width),
+                                              rnd.randint(0, height)))
+                writing.append_stroke(stroke)
+            writings.append(writing)
+        return writings
+
+    def testConversion(self):
+        cw = CompactWriting.from_writing(self.writing)
+        self._assertSame(self.writing, cw)
+        self.assertEqual(cw.to_writing(), self.writing)
+        self.assertEqual(cw.size(), self.writing.size())
+
+    def testEmpty(self):
+        cw = CompactWriting()
+        self.assertEqual(cw.size(), Writing().size())
+        self.assertEqual(cw.get_strokes(), [])
+        cw.normalize()
+        cw.smooth()
+        self.assertEqual(cw.to_writing(), Writing())
+
+    def testMoveToLineTo(self):
+        cw = CompactWriting()
+        writing = Writing()
+        for obj in (cw, writing):
+            obj.move_to(0, 0)
+            obj.line_to(10, 20)
+            obj.move_to(30, 30)
+            obj.line_to(40, 40)
+            obj.line_to(50, 50)
+        self._assertSame(writing, cw)
+
+    def testResizeMoveRel(self):
+        cw = CompactWriting.from_writing(self.writing)
+        for obj in (cw, self.writing):
+            obj.resize(0.5, 1.5)
+            obj.move_rel(10, -20)
+        self._assertSame(self.writing, cw)
+
+    def testNormalize(self):
+        cw = CompactWriting.from_writing(self.writing)
+        cw.normalize()
+        self.writing.normalize()
+        self._assertSame(self.writing, cw)
+
+    def testDownsample(self):
+        cw = CompactWriting.from_writing(self.writing)
+        cw.downsample(3)
+        self.writing.downsample(3)
+        self._assertSame(self.writing, cw)
+
+    def testDownsampleThreshold(self):
+        cw = CompactWriting.from_writing(self.writing)
+        cw.downsample_threshold(50)
+        self.writing.downsample_threshold(50)
+        self._assertSame(self.writing, cw)
+
+    def testUpsample(self):
+        cw = CompactWriting.from_writing(self.writing)
+        cw.upsample(2)
+        self.writing.upsample(2)
+        self._assertSame(self.writing, cw)
+
+    def testUpsampleThreshold(self):
+        cw = CompactWriting.from_writing(self.writing)
+        cw.upsample_threshold(10)
+        self.writing.upsample_threshold(10)
+        self._assertSame(self.writing, cw)
+
+    def testSmooth(self):
+        cw = CompactWriting.from_writing(self.writing)
+        cw.smooth()
+        cw.smooth()
+        self.writing.smooth()
+        self._assertSame(self.writing, cw)
+
+    def testStrokeView(self):
+        cw = CompactWriting.from_writing(self.writing)
+        strokes = cw.get_strokes(full=True)
+        orig = self.writing.get_strokes(full=True)
+        self.assertEqual(len(strokes), len(orig))
+        self.assertEqual(strokes[0][0], orig[0][0])
+        self.assertEqual(strokes[0][-1], orig[0][-1])
+        self.assertEqual(list(strokes[1]), list(orig[1]))
+
+        strokes[0].downsample_threshold(50)
+        orig[0].downsample_threshold(50)
+        self._assertSame(self.writing, cw)
+
+    def testRemoveStroke(self):
+        cw = CompactWriting.from_writing(self.writing)
+        cw.remove_stroke(1)
+        self.writing.remove_stroke(1)
+        cw.remove_last_stroke()
+        self.writing.remove_last_stroke()
+        self._assertSame(self.writing, cw)
+
+    def testCopy(self):
+        cw = CompactWriting.from_writing(self.writing)
+        cw2 = cw.copy()
+        cw2.move_rel(1, 1)
+        self.assertNotEqual(cw, cw2)
+        self._assertSame(self.writing, cw)
+
+    def testNormalizeSmooth(self):
+        for writing in [self.writing] + self._getRandomWritings(100):
+            cw = CompactWriting.from_writing(writing)
+            for obj in (cw, writing):
+                obj.normalize()
+                obj.smooth()
+            self._assertSame(writing, cw)
+
+    def testNormalizeDownsampleUpsample(self):
+        for writing in [self.writing] + self._getRandomWritings(100):
+            cw = CompactWriting.from_writing(writing)
+            for obj in (cw, writing):
+                obj.normalize()
+                obj.downsample_threshold(50)
+                obj.upsample_threshold(10)
+            self._assertSame(writing, cw)
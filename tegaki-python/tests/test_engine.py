@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest
+import os
+import shutil
+import tempfile
+
+from tegaki import engine
+from tegaki.engine import Engine, INDEX_FILE
+from tegaki.recognizer import Recognizer
+from tegaki.trainer import Trainer
+
+ENGINE_MODULE = """
+from tegaki.recognizer import Recognizer
+from tegaki.trainer import Trainer
+
+f = open(%(log)r, "a")
+f.write("%(name)s\\n")
+f.close()
+
+class _Recognizer(Recognizer):
+    RECOGNIZER_NAME = "%(name)s"
+
+class _Trainer(Trainer):
+    TRAINER_NAME = "%(name)s"
+
+RECOGNIZER_CLASS = _Recognizer
+TRAINER_CLASS = _Trainer
+"""
+
+class EngineDiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine_dir = os.path.join(self.tmpdir, "engines")
+        self.model_dir = os.path.join(self.tmpdir, "models")
+        self.log = os.path.join(self.tmpdir, "imports.log")
+        os.makedirs(self.engine_dir)
+        os.makedirs(os.path.join(self.model_dir, "fake"))
+
+        self.environ = dict(os.environ)
+        os.environ["HOME"] = self.tmpdir
+        os.environ["TEGAKI_ENGINE_PATH"] = self.engine_dir
+        os.environ["TEGAKI_MODEL_PATH"] = self.model_dir
+
+        self._add_engine("fake")
+        self._add_model("fake", "Fake model")
+        self._reset()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self._reset()
+        shutil.rmtree(self.tmpdir)
+
+    def _reset(self):
+        # forget what has been loaded in this process
+        Engine._user_index = None
+        engine._engine_modules.clear()
+        Recognizer._models.clear()
+        for klass, attr in ((Recognizer, "available_recognizers"),
+                            (Trainer, "available_trainers")):
+            if attr in klass.__dict__:
+                delattr(klass, attr)
+
+    def _add_engine(self, name):
+        f = open(os.path.join(self.engine_dir, "tegaki%s.py" % name), "w")
+        f.write(ENGINE_MODULE % {"log": self.log, "name": name})
+        f.close()
+        self._touch(self.engine_dir)
+
+    def _add_model(self, recognizer, name):
+        directory = os.path.join(self.model_dir, recognizer)
+        f = open(os.path.join(directory, "model.meta"), "w")
+        f.write("name = %s\nshortname = fk\n" % name)
+        f.close()
+        f = open(os.path.join(directory, "model.model"), "w")
+        f.close()
+        self._touch(directory)
+
+    def _touch(self, directory):
+        # make sure the mtime changes whatever the file system resolution
+        st = os.stat(directory)
+        os.utime(directory, (st.st_atime, st.st_mtime + 10))
+
+    def _get_imports(self):
+        if not os.path.exists(self.log):
+            return []
+        f = open(self.log)
+        imports = f.read().split()
+        f.close()
+        return imports
+
+    def testLazyImport(self):
+        self.assertTrue("fake" in Recognizer.get_available_recognizers())
+        self.assertTrue("fake" in Trainer.get_available_trainers())
+        # first discovery
+        self.assertEqual(self._get_imports(), ["fake"])
+
+        self._reset()
+        self.assertTrue("fake" in Recognizer.get_available_recognizers())
+        self.assertTrue("fake" in Trainer.get_available_trainers())
+        models = Recognizer.get_all_available_models()
+        self.assertEqual([m[:2] for m in models], [["fake", "Fake model"]])
+        self.assertEqual(models[0][2]["path"],
+                         os.path.join(self.model_dir, "fake", "model.model"))
+        # nothing imported thanks to the cache
+        self.assertEqual(self._get_imports(), ["fake"])
+
+        klass = Recognizer.get_available_recognizers()["fake"]
+        self.assertEqual(klass.RECOGNIZER_NAME, "fake")
+        self.assertEqual(list(klass.get_available_models().keys()),
+                         ["Fake model"])
+        klass = Trainer.get_available_trainers()["fake"]
+        self.assertEqual(klass.TRAINER_NAME, "fake")
+        # the module is imported only once
+        self.assertEqual(self._get_imports(), ["fake", "fake"])
+
+    def testModifiedDirectory(self):
+        Recognizer.get_available_recognizers()
+        self._add_engine("fake2")
+        self._add_model("fake", "Fake model 2")
+
+        self._reset()
+        self.assertEqual(sorted(Recognizer.get_available_recognizers().keys()),
+                         ["fake", "fake2"])
+        self.assertEqual([m[1] for m in Recognizer.get_all_available_models()],
+                         ["Fake model 2"])
+
+    def testMissingLibrary(self):
+        f = open(os.path.join(self.engine_dir, "tegakinolib.py"), "w")
+        f.write("try:\n    import tegakinolibnative\nexcept ImportError:\n"
+                "    pass\n")
+        f.close()
+        self._touch(self.engine_dir)
+        self.assertEqual(list(Recognizer.get_available_recognizers().keys()),
+                         ["fake"])
+
+        # the library gets installed
+        f = open(os.path.join(self.engine_dir, "tegakinolib.py"), "a")
+        f.write(ENGINE_MODULE % {"log": self.log, "name": "nolib"})
+        f.close()
+
+        self._reset()
+        self.assertEqual(list(Recognizer.get_available_recognizers().keys()),
+                         ["fake", "nolib"])
+
+    def testBuildIndex(self):
+        Engine.build_index(self.engine_dir, "engines")
+        Engine.build_index(os.path.join(self.model_dir, "fake"), "models")
+        self.assertTrue(os.path.exists(os.path.join(self.engine_dir,
+                                                    INDEX_FILE)))
+        self.assertEqual(self._get_imports(), ["fake"])
+
+        self._reset()
+        shutil.rmtree(os.path.join(self.tmpdir, ".tegaki"), True)
+        self.assertEqual(list(Recognizer.get_available_recognizers().keys()),
+                         ["fake"])
+        self.assertEqual([m[1] for m in Recognizer.get_all_available_models()],
+                         ["Fake model"])
+        self.assertEqual(self._get_imports(), ["fake"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest
+import os
+import sys
+
+from tegaki.character import Point, Stroke, Writing, Character
+from tegaki.preprocessing import WritingBatch
+
+class WritingBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.currdir = os.path.dirname(os.path.abspath(__file__))
+        path = os.path.join(self.currdir, "data", "character.xml")
+        f = open(path, "rb")
+        char = Character()
+        char.read_string(f.read())
+        f.close()
+
+        writing = char.get_writing()
+
+        # a single-point stroke
+        stroke = Stroke()
+        stroke.append_point(Point(500, 500))
+        writing.append_stroke(stroke)
+
+        # a smaller writing on a different canvas
+        small = Writing()
+        small.set_width(500)
+        small.set_height(400)
+        small.move_to(10, 10)
+        small.line_to(20, 15)
+        small.line_to(35, 18)
+        small.line_to(36, 60)
+        small.line_to(40, 90)
+        small.line_to(90, 95)
+        small.move_to(50, 50)
+        small.line_to(50, 80)
+
+        self.writings = [writing, Writing(), small]
+
+    def _copies(self):
+        return [w.copy() for w in self.writings]
+
+    def _getPoints(self, writing):
+        return [[(p.x, p.y) for p in s] for s in writing.get_strokes(full=True)]
+
+    def _assertSame(self, writings, batch):
+        self.assertEqual(batch.get_n_writings(), len(writings))
+        converted = batch.to_writings()
+
+        for i, writing in enumerate(writings):
+            self.assertEqual(batch.get_strokes(i), writing.get_strokes())
+            self.assertEqual(self._getPoints(converted[i]),
+                             self._getPoints(writing))
+            self.assertEqual([s.get_is_smoothed() for s in
+                                converted[i].get_strokes(full=True)],
+                             [s.get_is_smoothed() for s in
+                                writing.get_strokes(full=True)])
+
+    def _testMethod(self, name, *args):
+        try:
+            batch = WritingBatch.from_writings(self.writings)
+        except NotImplementedError:
+            sys.stderr.write("numpy missing!\n")
+            return
+
+        writings = self._copies()
+
+        for writing in writings:
+            getattr(writing, name)(*args)
+        getattr(batch, name)(*args)
+
+        self._assertSame(writings, batch)
+
+    def testConversion(self):
+        try:
+            batch = WritingBatch.from_writings(self.writings)
+        except NotImplementedError:
+            sys.stderr.write("numpy missing!\n")
+            return
+
+        self._assertSame(self.writings, batch)
+        self.assertEqual(batch.to_writings(), self.writings)
+
+    def testNormalize(self):
+        self._testMethod("normalize")
+
+    def testDownsample(self):
+        self._testMethod("downsample", 3)
+
+    def testDownsampleThreshold(self):
+        self._testMethod("downsample_threshold", 50)
+
+    def testUpsample(self):
+        self._testMethod("upsample", 2)
+
+    def testUpsampleThreshold(self):
+        self._testMethod("upsample_threshold", 10)
+
+    def testSmooth(self):
+        self._testMethod("smooth")
+
+    def testPipeline(self):
+        try:
+            batch = WritingBatch.from_writings(self.writings)
+        except NotImplementedError:
+            sys.stderr.write("numpy missing!\n")
+            return
+
+        writings = self._copies()
+
+        for obj in writings + [batch]:
+            obj.normalize()
+            obj.upsample_threshold(10)
+            obj.smooth()
+            obj.downsample_threshold(20)
+
+        self._assertSame(writings, batch)
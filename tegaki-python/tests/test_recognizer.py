@@ -20,8 +20,12 @@
 # - Mathieu Blondel
 
 import unittest
+import os
+import shutil
+import tempfile
 
 from tegaki.recognizer import *
+from tegaki.dictutils import SortedDict
 
 class ResultsTest(unittest.TestCase):
 
@@ -30,4 +34,126 @@ class ResultsTest(unittest.TestCase):
         res2 = Results([("ま",1),("ち",2),("ゆ",3),("ー",4)]).to_small_kana()
         self.assertEqual(res[2][0], "ュ")
         self.assertEqual(res2[2][0], "ゅ")
-        
\ No newline at end of file
+        
+class _DummyRecognizer(Recognizer):
+
+    def _recognize(self, writing, n=10):
+        return Results([("つ", writing.get_n_strokes()), ("ま", 100)][:n])
+
+class RecognizerTest(unittest.TestCase):
+
+    def testRecognizeBatch(self):
+        from tegaki.character import Writing
+
+        writings = []
+        for n_strokes in range(3):
+            writing = Writing()
+            for i in range(n_strokes):
+                writing.move_to(100 * i, 100 * i)
+                writing.line_to(100 * i + 500, 100 * i + 500)
+            writings.append(writing)
+
+        recognizer = _DummyRecognizer()
+        recognizer._lang = "ja"
+
+        self.assertEqual(recognizer.recognize_batch([]), [])
+        self.assertEqual(recognizer.recognize_batch(writings, n=1),
+                         [recognizer.recognize(w, n=1) for w in writings])
+
+        small = Writing()
+        small.move_to(0, 0)
+        small.line_to(100, 100)
+        self.assertEqual(recognizer.recognize_batch([small])[0][0][0], "っ")
+
+class _ModelRecognizer(_DummyRecognizer):
+
+    available_models = SortedDict()
+
+    def __init__(self):
+        _DummyRecognizer.__init__(self)
+        self.options = {}
+
+    def open(self, path):
+        self.path = path
+
+    def set_options(self, options):
+        self.options.update(options)
+
+class RecognizerRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        _ModelRecognizer.available_models = SortedDict()
+        for name, size in (("small", 10), ("medium", 100), ("large", 1000)):
+            path = os.path.join(self.tmpdir, name + ".model")
+            f = open(path, "wb")
+            f.write(b"\0" * size)
+            f.close()
+            _ModelRecognizer.available_models[name] = {"name": name,
+                                                       "path": path,
+                                                       "language": "ja"}
+
+        self._recognizers = Recognizer.get_available_recognizers()
+        Recognizer.available_recognizers = {"dummy": _ModelRecognizer}
+
+    def tearDown(self):
+        Recognizer.available_recognizers = self._recognizers
+        shutil.rmtree(self.tmpdir)
+
+    def testSharedRecognizer(self):
+        registry = RecognizerRegistry()
+
+        rec = registry.get_recognizer("dummy", "small")
+        self.assertTrue(isinstance(rec, _ModelRecognizer))
+        self.assertEqual(rec.get_model(), "small")
+        self.assertEqual(rec.path, os.path.join(self.tmpdir, "small.model"))
+        self.assertTrue(registry.get_recognizer("dummy", "small") is rec)
+
+        rec2 = registry.get_recognizer("dummy", "small", {"alpha": "0.5"})
+        self.assertFalse(rec2 is rec)
+        self.assertEqual(rec2.options["alpha"], "0.5")
+        self.assertTrue(registry.get_recognizer("dummy", "small",
+                                                {"alpha": "0.5"}) is rec2)
+        self.assertEqual(len(registry), 2)
+
+    def testUnknown(self):
+        registry = RecognizerRegistry()
+        self.assertRaises(RecognizerError, registry.get_recognizer,
+                          "unknown", "small")
+        self.assertRaises(RecognizerError, registry.get_recognizer,
+                          "dummy", "unknown")
+        self.assertEqual(len(registry), 0)
+
+    def testMaxModels(self):
+        registry = RecognizerRegistry(max_models=2)
+
+        small = registry.get_recognizer("dummy", "small")
+        registry.get_recognizer("dummy", "medium")
+        # small becomes the most recently used
+        self.assertTrue(registry.get_recognizer("dummy", "small") is small)
+        registry.get_recognizer("dummy", "large")
+
+        self.assertEqual(registry.get_recognizer_keys(),
+                         [("dummy", "small", ()), ("dummy", "large", ())])
+
+    def testMaxMemory(self):
+        registry = RecognizerRegistry(max_memory=150)
+
+        registry.get_recognizer("dummy", "small")
+        registry.get_recognizer("dummy", "medium")
+        self.assertEqual(registry.get_memory_usage(), 110)
+
+        # too large: everything else is evicted but large is kept
+        registry.get_recognizer("dummy", "large")
+        self.assertEqual(registry.get_recognizer_keys(),
+                         [("dummy", "large", ())])
+        self.assertEqual(registry.get_memory_usage(), 1000)
+
+        registry.clear()
+        self.assertEqual(len(registry), 0)
+        self.assertEqual(registry.get_memory_usage(), 0)
+
+    def testDefault(self):
+        self.assertTrue(RecognizerRegistry.get_default() is
+                        RecognizerRegistry.get_default())
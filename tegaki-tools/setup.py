@@ -20,7 +20,10 @@ def getversion():
     render = _getversion('src/tegaki-render')
     bootstrap = _getversion('src/tegaki-bootstrap')
     stats = _getversion('src/tegaki-stats')
-    return max(convert, eval_, build, render, bootstrap, stats)
+    upgrade = _getversion('src/tegaki-upgrade')
+    server = _getversion('src/tegaki-server')
+    return max(convert, eval_, build, render, bootstrap, stats, upgrade,
+               server)
 
 # Please run
 # python setup.py install   
@@ -35,7 +38,8 @@ setup(
     license='GPL',
     scripts = ['src/tegaki-convert', 'src/tegaki-build', 
                'src/tegaki-eval', 'src/tegaki-render',
-               'src/tegaki-bootstrap', 'src/tegaki-stats'],
+               'src/tegaki-bootstrap', 'src/tegaki-stats',
+               'src/tegaki-upgrade', 'src/tegaki-server'],
     packages = ['tegakitools'],
     package_dir = {'tegakitools':'src/tegakitools'}
 )
@@ -51,7 +51,25 @@ def _get_charcol(charcol_type, charcol_path):
 
     elif charcol_type == TYPE_KANJIVG:
         return kanjivg_to_character_collection(charcol_path)
-    
+
+def _add_to_charcol(charcol, charcol_type, charcol_path):
+    # characters of directories and converted files are written to charcol
+    # directly, without intermediate collection
+    if charcol_type == TYPE_DIRECTORY:
+        charcol.import_character_directory(charcol_path)
+
+    elif charcol_type == TYPE_TOMOE:
+        tomoe_dict_to_character_collection(charcol_path, charcol)
+
+    elif charcol_type == TYPE_KUCHIBUE:
+        kuchibue_to_character_collection(charcol_path, charcol)
+
+    elif charcol_type == TYPE_KANJIVG:
+        kanjivg_to_character_collection(charcol_path, charcol)
+
+    else:
+        charcol.merge([_get_charcol(charcol_type, charcol_path)])
+
 
 def get_aggregated_charcol(tuples, dbpath=None):
     """
@@ -92,9 +110,10 @@ def get_aggregated_charcol(tuples, dbpath=None):
     else:
         charcol = CharacterCollection() # in memory db
 
-    charcols = [_get_charcol(typ, path) \
-                    for typ, paths in tuples for path in paths]
-
-    charcol.merge(charcols)
+    # add collections one at a time so that at most one of them is loaded
+    # at once (.chardb files are merged by sqlite directly)
+    for typ, paths in tuples:
+        for path in paths:
+            _add_to_charcol(charcol, typ, path)
 
     return charcol
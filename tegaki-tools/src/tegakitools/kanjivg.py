@@ -155,8 +155,10 @@ class SVG_Parser:
     
 class KVGXmlDictionaryReader(_XmlBase):
 
-    def __init__(self):
-        self._charcol = CharacterCollection()
+    def __init__(self, charcol=None):
+        if charcol is None:
+            charcol = CharacterCollection()
+        self._charcol = charcol
 
     def get_character_collection(self):
         return self._charcol
@@ -209,8 +211,12 @@ class KVGXmlDictionaryReader(_XmlBase):
         elif self._tag == "height":
             self._writing.set_height(int(data))
 
-def kanjivg_to_character_collection(path):
-    reader = KVGXmlDictionaryReader()
+def kanjivg_to_character_collection(path, charcol=None):
+    """
+    Read characters from path and add them to charcol, or to a new
+    collection if charcol is None.
+    """
+    reader = KVGXmlDictionaryReader(charcol)
     gzip = False; bz2 = False
     if path.endswith(".gz"): gzip = True
     if path.endswith(".bz2"): bz2 = True
@@ -148,10 +148,14 @@ class KuchibueParser(UnipenParser):
         strokes = writing.get_strokes()
         strokes[-1].append(Point(x,y))
 
-def kuchibue_to_character_collection(path):
+def kuchibue_to_character_collection(path, charcol=None):
+    """
+    Read characters from path and add them to charcol, or to a new
+    collection if charcol is None.
+    """
     parser = KuchibueParser()
     parser.parse_file(path)
-    return parser.get_character_collection()
+    return parser.get_character_collection(charcol)
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+HTTP/JSON recognition server.
+
+Clients POST a character, either as XML (L{Character.to_xml}) or as JSON
+(L{Writing.to_json} or L{Character.to_json}), to /recognize. The body may
+also be form-encoded with an "xml" field, like the requests of the hwdb
+recognize view. The recognizer, the model and the number of candidates can
+be chosen with the "recognizer", "model" and "n" query parameters (at most
+L{RecognitionServer.MAX_CANDIDATES} candidates).
+
+Concurrent requests for the same model are grouped into batches which are
+passed to L{Recognizer.recognize_batch} in a pool of workers (threads or
+processes). Models are opened once, when the server starts.
+
+Other resources:
+    - GET /models: models served
+    - GET /metrics: request counts, throughput and latency percentiles
+    - GET /health: returns "ok"
+"""
+
+import asyncio
+import collections
+import json
+import multiprocessing
+import time
+import xml.parsers.expat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from urlparse import urlsplit, parse_qs
+
+from tegaki.character import Character, Writing, Stroke, Point
+from tegaki.recognizer import RecognizerRegistry
+
+HTTP_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request",
+                404: "Not Found", 405: "Method Not Allowed",
+                413: "Request Entity Too Large",
+                500: "Internal Server Error"}
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+def percentile(values, p):
+    """
+    Return the p-th percentile of values (nearest-rank method).
+
+    @type values: list
+    @param values: sorted values
+    @type p: float
+    @param p: percentage between 0 and 100
+    """
+    if not values:
+        return 0.0
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+def parse_writing(data):
+    """
+    Return a L{Writing} from a character in XML or JSON format.
+
+    @type data: str
+
+    Raises ValueError if data can't be parsed.
+    """
+    data = data.strip()
+
+    if data.startswith("{"):
+        try:
+            obj = json.loads(data)
+            if "writing" in obj:
+                # Character.to_json()
+                obj = obj["writing"]
+
+            writing = Writing()
+            if "width" in obj: writing.set_width(int(obj["width"]))
+            if "height" in obj: writing.set_height(int(obj["height"]))
+
+            for s in obj["strokes"]:
+                stroke = Stroke()
+                for p in s["points"]:
+                    point = Point()
+                    for key in Point.KEYS:
+                        if key in p:
+                            if not isinstance(p[key], (int, float)):
+                                raise TypeError("%s is not a number" % key)
+                            point[key] = p[key]
+                    stroke.append_point(point)
+                writing.append_stroke(stroke)
+        except (TypeError, KeyError, AttributeError) as e:
+            raise ValueError("Invalid JSON writing: %s" % e)
+    else:
+        char = Character()
+        try:
+            char.read_string(data)
+        except xml.parsers.expat.ExpatError as e:
+            raise ValueError("Invalid XML character: %s" % e)
+        writing = char.get_writing()
+
+    if writing.get_n_strokes() == 0:
+        raise ValueError("Empty writing")
+
+    return writing
+
+def _results_to_list(results):
+    ret = []
+    for char, score in results:
+        if isinstance(char, bytes):
+            char = char.decode("utf-8")
+        ret.append({"character": char, "score": score})
+    return ret
+
+def _preload_models(models):
+    registry = RecognizerRegistry.get_default()
+    registry.max_models = max(registry.max_models, len(models))
+
+    for recognizer_name, model_name in models:
+        registry.get_recognizer(recognizer_name, model_name)
+
+def _recognize_batch(recognizer_name, model_name, data, n):
+    """
+    Parse and recognize a batch of characters, in a worker.
+
+    Return a list of (error message, results) tuples, in the same order as
+    data. Parsing and recognition errors only affect the character
+    concerned.
+    """
+    recognizer = RecognizerRegistry.get_default().get_recognizer(
+                                                recognizer_name, model_name)
+    ret = [None] * len(data)
+    writings = []
+    indices = []
+
+    for i, d in enumerate(data):
+        try:
+            writings.append(parse_writing(d))
+            indices.append(i)
+        except ValueError as e:
+            ret[i] = (str(e) or "Invalid character", None)
+
+    if not writings:
+        return ret
+
+    try:
+        all_results = recognizer.recognize_batch(writings, n)
+    except Exception:
+        # find out which characters can't be recognized
+        all_results = []
+        for writing in writings:
+            try:
+                all_results.append(recognizer.recognize(writing, n))
+            except Exception as e:
+                all_results.append(e)
+
+    for i, results in zip(indices, all_results):
+        if isinstance(results, Exception):
+            ret[i] = (str(results) or "Recognition error", None)
+        else:
+            ret[i] = (None, _results_to_list(results))
+
+    return ret
+
+class Metrics(object):
+    """
+    Server statistics.
+
+    Latencies are kept for the last max_latencies requests and throughput
+    is computed over the last window seconds.
+    """
+
+    def __init__(self, max_latencies=10000, window=60):
+        self._start = time.time()
+        self._window = window
+        self._latencies = collections.deque(maxlen=max_latencies)
+        # recognitions per second, for the last window seconds
+        self._recent = collections.deque()
+        self.requests = 0
+        self.errors = 0
+        self.recognitions = 0
+        self.batches = 0
+
+    def add_batch(self, size):
+        self.batches += 1
+        self.recognitions += size
+
+        now = int(time.time())
+        if self._recent and self._recent[-1][0] == now:
+            self._recent[-1][1] += size
+        else:
+            self._recent.append([now, size])
+        while self._recent[0][0] <= now - self._window:
+            self._recent.popleft()
+
+    def add_request(self, latency, error=False):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        else:
+            self._latencies.append(latency)
+
+    def to_dict(self):
+        uptime = time.time() - self._start
+        latencies = sorted(self._latencies)
+        now = int(time.time())
+        recent = sum([n for t, n in self._recent if t > now - self._window])
+
+        return {"uptime": uptime,
+                "requests": self.requests,
+                "errors": self.errors,
+                "recognitions": self.recognitions,
+                "batches": self.batches,
+                "mean_batch_size": float(self.recognitions) /
+                                   max(self.batches, 1),
+                "throughput": float(recent) / min(self._window,
+                                                  max(uptime, 1)),
+                "latency_ms": dict([("p%d" % p,
+                                     percentile(latencies, p) * 1000)
+                                    for p in (50, 90, 99)] +
+                                   [("max", latencies[-1] * 1000
+                                            if latencies else 0.0)])}
+
+class _Batcher(object):
+    """
+    Group the characters waiting to be recognized with a model.
+
+    A batch is sent to the workers as soon as one of them is available:
+    under load, characters accumulate while all workers are busy so batches
+    grow naturally. When idle, the batcher waits max_delay seconds for more
+    characters to arrive.
+    """
+
+    def __init__(self, server, recognizer_name, model_name):
+        self._server = server
+        self._recognizer_name = recognizer_name
+        self._model_name = model_name
+        self._queue = asyncio.Queue()
+
+    async def recognize(self, data, n):
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((data, n, future))
+        return await future
+
+    def _drain(self, batch):
+        while len(batch) < self._server.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+    async def run(self):
+        while True:
+            batch = [await self._queue.get()]
+
+            await self._server._workers.acquire()
+
+            self._drain(batch)
+            if len(batch) < self._server.max_batch_size and \
+               self._server.max_delay > 0:
+                await asyncio.sleep(self._server.max_delay)
+                self._drain(batch)
+
+            asyncio.ensure_future(self._process(batch))
+
+    async def _process(self, batch):
+        loop = asyncio.get_event_loop()
+        n = max([item[1] for item in batch])
+
+        try:
+            ret = await loop.run_in_executor(self._server._executor,
+                                             _recognize_batch,
+                                             self._recognizer_name,
+                                             self._model_name,
+                                             [item[0] for item in batch],
+                                             n)
+            self._server.metrics.add_batch(len(batch))
+
+            for (data, n_, future), (error, results) in zip(batch, ret):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(results[:n_])
+                else:
+                    future.set_exception(HTTPError(400, error))
+        except Exception as e:
+            for data, n_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._server._workers.release()
+
+class RecognitionServer(object):
+    """
+    Asynchronous HTTP/JSON recognition server.
+    """
+
+    #: maximum size of request bodies, in bytes
+    MAX_BODY_SIZE = 1024 * 1024
+
+    #: maximum number of candidates returned for a character
+    MAX_CANDIDATES = 100
+
+    def __init__(self, models, n_threads=None, n_processes=None,
+                 max_batch_size=64, max_delay=0.002):
+        """
+        @type models: list
+        @param models: (recognizer name, model name) tuples to serve, \
+                       the first one is used by default
+        @type n_threads: int
+        @param n_threads: number of worker threads (default: number of CPUs)
+        @type n_processes: int
+        @param n_processes: number of worker processes, used instead of \
+                            threads if given (for recognizers which don't \
+                            release the GIL)
+        @type max_batch_size: int
+        @param max_batch_size: maximum number of characters in a batch
+        @type max_delay: float
+        @param max_delay: time to wait for more characters before sending \
+                          a batch when workers are idle, in seconds
+        """
+        if not models:
+            raise ValueError("At least one model must be served")
+
+        self.models = list(models)
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.metrics = Metrics()
+
+        # models are opened before any worker starts: worker processes are
+        # forked with them already loaded
+        _preload_models(self.models)
+
+        if n_processes:
+            self.n_workers = n_processes
+            try:
+                context = multiprocessing.get_context("fork")
+                self._executor = ProcessPoolExecutor(n_processes,
+                                                     mp_context=context)
+            except ValueError:
+                # no fork on this platform: load models in each worker
+                self._executor = ProcessPoolExecutor(n_processes,
+                                                initializer=_preload_models,
+                                                initargs=(self.models,))
+        else:
+            self.n_workers = n_threads or multiprocessing.cpu_count()
+            self._executor = ThreadPoolExecutor(self.n_workers)
+
+        self._batchers = {}
+        self._workers = None
+
+    def _get_batcher(self, recognizer_name, model_name):
+        key = (recognizer_name, model_name)
+
+        if not key in self._batchers:
+            if not key in self.models:
+                raise HTTPError(404, "Model not served: %s (%s)" % \
+                                     (model_name, recognizer_name))
+            batcher = _Batcher(self, recognizer_name, model_name)
+            self._batchers[key] = batcher
+            asyncio.ensure_future(batcher.run())
+
+        return self._batchers[key]
+
+    async def _recognize(self, query, headers, body):
+        try:
+            body = body.decode("utf-8")
+        except UnicodeDecodeError:
+            raise HTTPError(400, "Body must be UTF-8")
+
+        # curl and many HTTP libraries send raw bodies as form-encoded data
+        # by default, so only bodies with an xml field are treated as forms
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/x-www-form-urlencoded") and \
+           not body.lstrip().startswith(("<", "{")):
+            form = parse_qs(body)
+            if not "xml" in form:
+                raise HTTPError(400, "Missing xml field")
+            body = form["xml"][0]
+            for key in form:
+                query.setdefault(key, form[key])
+
+        recognizer_name, model_name = self.models[0]
+        if "recognizer" in query or "model" in query:
+            recognizer_name = query.get("recognizer", [recognizer_name])[0]
+            model_name = query.get("model", [model_name])[0]
+
+        try:
+            n = int(query.get("n", ["10"])[0])
+        except ValueError:
+            raise HTTPError(400, "n must be an integer")
+
+        if n < 1 or n > self.MAX_CANDIDATES:
+            raise HTTPError(400, "n must be between 1 and %d" % \
+                                 self.MAX_CANDIDATES)
+
+        batcher = self._get_batcher(recognizer_name, model_name)
+        return 200, await batcher.recognize(body, n)
+
+    async def _dispatch(self, method, target, headers, body):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+
+        if url.path == "/recognize":
+            if method != "POST":
+                raise HTTPError(405, "Use POST")
+            return await self._recognize(query, headers, body)
+        elif url.path == "/models":
+            return 200, [{"recognizer": r, "model": m} for r, m in self.models]
+        elif url.path == "/metrics":
+            return 200, self.metrics.to_dict()
+        elif url.path == "/health":
+            return 200, "ok"
+        else:
+            raise HTTPError(404, "Not found")
+
+    def _write_response(self, writer, status, payload, keep_alive):
+        body = b""
+        if status != 204:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+        headers = ["HTTP/1.1 %d %s" % (status, HTTP_REASONS[status]),
+                   "Content-Type: application/json; charset=utf-8",
+                   "Content-Length: %d" % len(body),
+                   # tegaki-webcanvas pages are usually served elsewhere
+                   "Access-Control-Allow-Origin: *",
+                   "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+                   "Access-Control-Allow-Headers: Content-Type",
+                   "Connection: %s" % ("keep-alive" if keep_alive
+                                       else "close")]
+
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1"))
+        writer.write(body)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                start = time.time()
+                method, target, version = line.decode("latin-1").split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, sep, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                connection = headers.get("connection", "").lower()
+                if version == "HTTP/1.1":
+                    keep_alive = connection != "close"
+                else:
+                    keep_alive = connection == "keep-alive"
+
+                length = int(headers.get("content-length", 0))
+                if length > self.MAX_BODY_SIZE:
+                    self._write_response(writer, 413,
+                                         {"error": "Request too large"},
+                                         False)
+                    self.metrics.add_request(0, error=True)
+                    break
+                body = await reader.readexactly(length)
+
+                error = False
+                if method == "OPTIONS":
+                    status, payload = 204, None
+                else:
+                    try:
+                        status, payload = await self._dispatch(method, target,
+                                                               headers, body)
+                    except HTTPError as e:
+                        status, payload = e.status, {"error": str(e)}
+                        error = True
+                    except Exception as e:
+                        status, payload = 500, {"error": str(e)}
+                        error = True
+
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                self.metrics.add_request(time.time() - start, error)
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8000):
+        """
+        Start listening, return the asyncio server.
+        """
+        self._workers = asyncio.Semaphore(self.n_workers)
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    def serve_forever(self, host="127.0.0.1", port=8000):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            server = loop.run_until_complete(self.start(host, port))
+            loop.run_until_complete(server.serve_forever())
+        finally:
+            self._executor.shutdown(wait=False)
+            loop.close()
@@ -144,8 +144,9 @@ class UnipenParser(UnipenEventParser):
         else:
             func(args)
 
-    def get_character_collection(self):
-        charcol = CharacterCollection()
+    def get_character_collection(self, charcol=None):
+        if charcol is None:
+            charcol = CharacterCollection()
         assert(len(self._labels) == len(self._characters))
 
         # group characters with the same label into sets
@@ -153,7 +154,7 @@ class UnipenParser(UnipenEventParser):
         for i in range(len(self._characters)):
             utf8 = self._labels[i]
             self._characters[i].set_utf8(utf8)
-            sets[utf8] = sets.get(utf8, []) + [self._characters[i]]
+            sets.setdefault(utf8, []).append(self._characters[i])
 
         charcol.add_sets(list(sets.keys()))
 
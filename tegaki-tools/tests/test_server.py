@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import unittest
+
+from tegaki.character import Character, Writing
+from tegaki.recognizer import Recognizer, RecognizerRegistry, \
+                              RecognizerError, Results
+
+from tegakitools import server
+
+class _DummyRecognizer(Recognizer):
+
+    available_models = {"dummy": {"name": "dummy", "path": "dummy.model",
+                                  "language": "en"}}
+
+    def open(self, path):
+        pass
+
+    def _recognize(self, writing, n=10):
+        if writing.get_n_strokes() > 3:
+            raise RecognizerError("Too many strokes")
+        return Results([("つ", writing.get_n_strokes()), ("ま", 100)][:n])
+
+def get_writing(n_strokes):
+    writing = Writing()
+    for i in range(n_strokes):
+        writing.move_to(100 * i, 100 * i)
+        writing.line_to(100 * i + 500, 100 * i + 500)
+    return writing
+
+class ParseWritingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.writing = get_writing(2)
+
+    def testXML(self):
+        char = Character()
+        char.set_utf8("つ")
+        char.set_writing(self.writing)
+        self.assertEqual(server.parse_writing(char.to_xml()), self.writing)
+        self.assertEqual(server.parse_writing("\n" + char.to_xml() + "\n"),
+                         self.writing)
+
+    def testWritingJSON(self):
+        self.assertEqual(server.parse_writing(self.writing.to_json()),
+                         self.writing)
+
+    def testCharacterJSON(self):
+        char = Character()
+        char.set_utf8("つ")
+        char.set_writing(self.writing)
+        self.assertEqual(server.parse_writing(char.to_json()), self.writing)
+
+    def testInvalid(self):
+        for data in ("", "garbage", "<character>", "{not json",
+                     "{}", '{"strokes": 3}', '{"strokes": []}',
+                     '{"strokes": [{"points": [1]}]}',
+                     '{"strokes": [{"points": [{"x": "a", "y": 1}]}]}',
+                     '{"width": "w", "strokes": [{"points": [{"x": 1}]}]}',
+                     Writing().to_xml()):
+            self.assertRaises(ValueError, server.parse_writing, data)
+
+class MetricsTest(unittest.TestCase):
+
+    def testPercentile(self):
+        self.assertEqual(server.percentile([], 50), 0.0)
+        self.assertEqual(server.percentile([3], 99), 3)
+        values = list(range(101))
+        self.assertEqual(server.percentile(values, 0), 0)
+        self.assertEqual(server.percentile(values, 50), 50)
+        self.assertEqual(server.percentile(values, 90), 90)
+        self.assertEqual(server.percentile(values, 100), 100)
+
+    def testToDict(self):
+        metrics = server.Metrics()
+        d = metrics.to_dict()
+        self.assertEqual((d["requests"], d["errors"], d["batches"]), (0, 0, 0))
+        self.assertEqual(d["mean_batch_size"], 0.0)
+        self.assertEqual(d["latency_ms"],
+                         {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0})
+
+        metrics.add_batch(3)
+        metrics.add_batch(1)
+        for latency in (0.004, 0.001, 0.002, 0.003):
+            metrics.add_request(latency)
+        metrics.add_request(10.0, error=True)
+
+        d = metrics.to_dict()
+        self.assertEqual(d["requests"], 5)
+        self.assertEqual(d["errors"], 1)
+        self.assertEqual(d["recognitions"], 4)
+        self.assertEqual(d["batches"], 2)
+        self.assertEqual(d["mean_batch_size"], 2.0)
+        self.assertTrue(d["throughput"] > 0)
+        # failed requests don't count in latencies
+        self.assertAlmostEqual(d["latency_ms"]["max"], 4.0)
+        self.assertAlmostEqual(d["latency_ms"]["p50"], 3.0)
+
+    def testMaxLatencies(self):
+        metrics = server.Metrics(max_latencies=2)
+        for latency in (5.0, 0.001, 0.002):
+            metrics.add_request(latency)
+        self.assertAlmostEqual(metrics.to_dict()["latency_ms"]["max"], 2.0)
+
+class _DummyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._recognizers = Recognizer.get_available_recognizers()
+        Recognizer.available_recognizers = {"dummy": _DummyRecognizer}
+        self._registry = RecognizerRegistry._default
+        RecognizerRegistry._default = RecognizerRegistry()
+
+    def tearDown(self):
+        Recognizer.available_recognizers = self._recognizers
+        RecognizerRegistry._default = self._registry
+
+class RecognizeBatchTest(_DummyTestCase):
+
+    def _recognize(self, data, n=10):
+        return server._recognize_batch("dummy", "dummy", data, n)
+
+    def testBatch(self):
+        data = [get_writing(i).to_json() for i in (1, 2, 3)]
+        self.assertEqual(self._recognize(data, n=1),
+                         [(None, [{"character": "つ", "score": i}])
+                          for i in (1, 2, 3)])
+
+    def testInvalidCharacter(self):
+        char = Character()
+        char.set_writing(get_writing(2))
+        data = [get_writing(1).to_json(), "garbage", char.to_xml()]
+        ret = self._recognize(data)
+        self.assertEqual(ret[0][0], None)
+        self.assertEqual(ret[0][1][0], {"character": "つ", "score": 1})
+        self.assertEqual(ret[1], ("Empty writing", None))
+        self.assertEqual(ret[2][0], None)
+        self.assertEqual(ret[2][1][0], {"character": "つ", "score": 2})
+
+    def testRecognitionError(self):
+        data = [get_writing(i).to_json() for i in (1, 5, 2)]
+        ret = self._recognize(data)
+        self.assertEqual(ret[1], ("Too many strokes", None))
+        self.assertEqual([r[1][0]["score"] for r in (ret[0], ret[2])], [1, 2])
+
+    def testAllInvalid(self):
+        self.assertEqual(self._recognize(["", "{}"]),
+                         [("Empty writing", None),
+                          ("Invalid JSON writing: 'strokes'", None)])
+        self.assertEqual(self._recognize([]), [])
+
+class RecognitionServerTest(_DummyTestCase):
+
+    def setUp(self):
+        _DummyTestCase.setUp(self)
+        self.server = server.RecognitionServer([("dummy", "dummy")],
+                                               n_threads=1, max_delay=0)
+        # batchers run in the loop of the first request
+        self.loop = asyncio.new_event_loop()
+
+        async def start():
+            self.server._workers = asyncio.Semaphore(1)
+        self.loop.run_until_complete(start())
+
+    def tearDown(self):
+        async def stop():
+            tasks = [t for t in asyncio.all_tasks()
+                     if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.run_until_complete(stop())
+        self.loop.close()
+        self.server._executor.shutdown()
+        _DummyTestCase.tearDown(self)
+
+    def _recognize(self, n):
+        body = get_writing(2).to_json().encode("utf-8")
+        return self.loop.run_until_complete(
+                    self.server._recognize({"n": [n]}, {}, body))
+
+    def testRecognize(self):
+        self.assertEqual(self._recognize("1"),
+                         (200, [{"character": "つ", "score": 2}]))
+        self.assertEqual(len(self._recognize("100")[1]), 2)
+
+    def testInvalidN(self):
+        # large values would make the recognizer allocate huge results
+        for n in ("0", "-1", "101", "67108865", "4294967295", "ten"):
+            try:
+                self._recognize(n)
+            except server.HTTPError as e:
+                self.assertEqual(e.status, 400)
+            else:
+                self.fail("n=%s accepted" % n)